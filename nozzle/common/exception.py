@@ -138,6 +138,10 @@ class LoadBalancerInstanceAssociationNotFound(NozzleException):
                 "with %(instance_uuid)s could not be found")
 
 
+class InstanceFixedIpNotFound(NozzleException):
+    message = _("Fixed ip of instance %(instance_uuid)s could not be found.")
+
+
 class CommandError(Exception):
     pass
 
@@ -273,6 +277,10 @@ class HaproxyDeleteError(HaproxyConfigureError):
     message = "Could not delete the haproxy proxy: %(explanation)s"
 
 
+class HaproxyRuntimeError(HaproxyConfigureError):
+    message = _("Could not change haproxy at runtime: %(explanation)s")
+
+
 class HaproxyLBExists(Invalid):
     message = _("The supplied load balancer (%(name)s) "
                 "already exists, it is expected not to exist.")
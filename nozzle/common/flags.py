@@ -65,6 +65,9 @@ api_opts = [
     cfg.IntOpt('server_listen_port',
                default=5557,
                help='Port for nozzle server to listen.'),
+    cfg.IntOpt('server_pool_size',
+               default=64,
+               help='Max number of client requests served concurrently.'),
     cfg.StrOpt('broadcast_listen',
                default='127.0.0.1',
                help='IP address for nozzle worker to listen.'),
@@ -77,6 +80,26 @@ api_opts = [
     cfg.IntOpt('feedback_listen_port',
                default=5559,
                help='Port for nozzle server to get response from worker.'),
+    cfg.StrOpt('snapshot_listen',
+               default='127.0.0.1',
+               help='IP address for workers to fetch the snapshot from.'),
+    cfg.IntOpt('snapshot_listen_port',
+               default=5560,
+               help='Port for workers to fetch the snapshot from.'),
+    cfg.IntOpt('snapshot_chunk_size',
+               default=500,
+               help='Number of load balancers sent per snapshot frame.'),
+    cfg.IntOpt('feedback_batch_size',
+               default=256,
+               help='Max number of worker feedbacks applied at once.'),
+    cfg.IntOpt('checker_interval',
+               default=6,
+               help='Seconds between two scans for load balancers in '
+                    'transient states.'),
+    cfg.IntOpt('checker_batch_size',
+               default=100,
+               help='Number of load balancers fetched per db call by the '
+                    'checker.'),
 ]
 
 
@@ -93,6 +116,16 @@ sql_opts = [
     cfg.StrOpt('reconnect_interval',
                default=3,
                help='Retry interval when database connection error occur'),
+    cfg.IntOpt('sql_max_pool_size',
+               default=5,
+               help='Size of the SQLAlchemy connection pool, it also '
+                    'bounds the number of concurrent database calls'),
+    cfg.StrOpt('db_execution_mode',
+               default='direct',
+               help="How nozzle-server runs database calls: 'direct' in "
+                    "the calling green thread, 'tpool' in a native thread "
+                    "pool, 'green' through a pure python driver such as "
+                    "mysql+pymysql:// on green sockets"),
 ]
 
 
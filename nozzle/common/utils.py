@@ -26,6 +26,7 @@ import shutil
 import shlex
 import subprocess
 import sys
+import threading
 import uuid
 
 from paste import deploy
@@ -133,18 +134,45 @@ def backup_config(filepath, backup_dir):
         raise
 
 
-def execute(cmd):
+def execute(cmd, timeout=None):
+    """Run `cmd`, return its output.
+
+    :param timeout: seconds after which the command is killed, it then
+                    fails like a command exiting with an error
+    """
     # NOTE(wenjianhn): shlex supports ascii only
     cmd = cmd.encode('ascii')
 
+    LOG.debug('Running cmd (subprocess): %s', cmd)
+    process = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    expired = []
+
+    def kill():
+        expired.append(True)
+        try:
+            process.kill()
+        except OSError:
+            # exited meanwhile
+            pass
+
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
     try:
-        LOG.debug('Running cmd (subprocess): %s', cmd)
-        return subprocess.check_output(shlex.split(cmd),
-                                       stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        LOG.warning('[%s] failed: %s' % (cmd, e.output))
-        raise exception.ProcessExecutionError(exit_code=e.returncode,
-                                              output=e.output, cmd=cmd)
+        output = process.communicate()[0]
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+    if expired:
+        output = 'killed after %s seconds\n%s' % (timeout, output)
+    if process.returncode:
+        LOG.warning('[%s] failed: %s' % (cmd, output))
+        raise exception.ProcessExecutionError(exit_code=process.returncode,
+                                              output=output, cmd=cmd)
+    return output
 
 
 def synchronized(name):
@@ -202,6 +230,24 @@ def check_input_parameters(expect_keys, **kwargs):
             raise exception.MissingParameter(key=key)
 
 
+def check_optional_configs(ranges, config):
+    """Check the integer settings of `ranges` present in `config`.
+
+    :param ranges: list of (key, low, high)
+    :returns: dict of the settings present
+    """
+    values = dict()
+    for key, low, high in ranges:
+        if key not in config:
+            continue
+        value = config[key]
+        if not isinstance(value, int) or not low <= value <= high:
+            raise exception.InvalidParameter(
+                msg='invalid %s, should between %d~%d' % (key, low, high))
+        values[key] = value
+    return values
+
+
 def gen_dns_prefix():
     ctxt = context.get_admin_context(read_deleted="yes")
     all_load_balancers = db.load_balancer_get_all(ctxt)
@@ -231,18 +277,29 @@ def get_all_load_balancers(filters=None):
     return all_load_balancers
 
 
+def new_nova_client():
+    return client.Client(FLAGS.nova_admin_username,
+                         FLAGS.nova_admin_password,
+                         FLAGS.nova_admin_tenant_name,
+                         FLAGS.nova_admin_auth_url,
+                         region_name=FLAGS.nova_region_name,
+                         service_type="compute",
+                         no_cache=True)
+
+
+def get_instance_fixed_ip(instance):
+    for ip_group, addresses in instance.addresses.items():
+        for address in addresses:
+            return address['addr']
+    return None
+
+
 def get_fixed_ip_by_instance_uuid(uuid):
     global nova_client
     if nova_client is None:
-        nova_client = client.Client(FLAGS.nova_admin_username,
-                                    FLAGS.nova_admin_password,
-                                    FLAGS.nova_admin_tenant_name,
-                                    FLAGS.nova_admin_auth_url,
-                                    region_name=FLAGS.nova_region_name,
-                                    service_type="compute",
-                                    no_cache=True)
+        nova_client = new_nova_client()
     instance = nova_client.servers.get(uuid)
-    for ip_group, addresses in instance.addresses.items():
-        for address in addresses:
-            return address['addr']
-    raise Exception('failed to ip address of instance: %s' % uuid)
+    fixed_ip = get_instance_fixed_ip(instance)
+    if fixed_ip is None:
+        raise Exception('failed to ip address of instance: %s' % uuid)
+    return fixed_ip
@@ -72,8 +72,8 @@ def _is_valid_server_names(server_names):
         raise exception.BadRequest(explanation=msg)
 
     if len(server_names) == 0:
-        # TODO(wenjianhn)
-        # http://wiki.nginx.org/NginxHttpCoreModule#server_names_hash_max_size
+        # NOTE: the hash tables of nginx are sized for all the names
+        # bound by the worker, see [nginx] hash_sizes_config.
         msg = "No server_name in request"
         raise exception.BadRequest(explanation=msg)
 
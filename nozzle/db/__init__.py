@@ -1 +1,60 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 Ustack Corporation
+# All Rights Reserved.
+# Author: Jiajun Liu <iamljj@gmail.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Database api, every load_balancer_* call goes through db_execution_mode.
+"""
+import functools
+
+from eventlet import semaphore
+from eventlet import tpool
+
+from nozzle.common import flags
+from nozzle.db.sqlalchemy import api as IMPL
 from nozzle.db.sqlalchemy.api import *
+
+FLAGS = flags.FLAGS
+
+_SEMAPHORE = None
+
+
+def _get_semaphore():
+    global _SEMAPHORE
+    if _SEMAPHORE is None:
+        _SEMAPHORE = semaphore.Semaphore(FLAGS.sql_max_pool_size)
+    return _SEMAPHORE
+
+
+def _execute(f):
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        mode = FLAGS.db_execution_mode
+        if mode == 'direct':
+            return f(*args, **kwargs)
+        # NOTE: never have more calls in flight than pooled connections,
+        # the extra ones would just block on pool checkout.
+        with _get_semaphore():
+            if mode == 'tpool':
+                return tpool.execute(f, *args, **kwargs)
+            return f(*args, **kwargs)
+    return wrapper
+
+
+for _name in dir(IMPL):
+    if _name.startswith('load_balancer_'):
+        globals()[_name] = _execute(getattr(IMPL, _name))
@@ -19,6 +19,10 @@
 """Implementation of SQLAlchemy backend."""
 import datetime
 
+from sqlalchemy import and_
+from sqlalchemy import or_
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import subqueryload
 from sqlalchemy.sql.expression import literal_column
 
 from nozzle.common import exception
@@ -73,8 +77,22 @@ def model_query(context, model, **kwargs):
     return query
 
 
+def _load_balancer_query(context, **kwargs):
+    """Query load balancers with their relations loaded up front.
+
+    Callers may run outside the thread that issued the query (see
+    db_execution_mode), so nothing should be left to lazy loading.
+    Sessions do not expire on commit, so refresh what the session
+    already holds instead of handing back stale state.
+    """
+    return model_query(context, models.LoadBalancer, **kwargs).options(
+        joinedload('config'),
+        subqueryload('instances'),
+        subqueryload('domains')).populate_existing()
+
+
 def load_balancer_get(context, load_balancer_id):
-    result = model_query(context, models.LoadBalancer).filter_by(
+    result = _load_balancer_query(context).filter_by(
         id=load_balancer_id).first()
     if not result:
         raise exception.LoadBalancerNotFound(load_balancer_id=load_balancer_id)
@@ -82,7 +100,7 @@ def load_balancer_get(context, load_balancer_id):
 
 
 def load_balancer_get_by_uuid(context, uuid):
-    result = model_query(context, models.LoadBalancer).filter_by(
+    result = _load_balancer_query(context).filter_by(
         uuid=uuid).first()
     if not result:
         raise exception.LoadBalancerNotFoundByUUID(uuid=uuid)
@@ -90,7 +108,7 @@ def load_balancer_get_by_uuid(context, uuid):
 
 
 def load_balancer_get_by_name(context, name):
-    result = model_query(context, models.LoadBalancer).filter_by(
+    result = _load_balancer_query(context).filter_by(
         name=name).first()
     if not result:
         raise exception.LoadBalancerNotFoundByName(load_balancer_name=name)
@@ -100,7 +118,110 @@ def load_balancer_get_by_name(context, name):
 @require_admin_context
 def load_balancer_get_all(context, filters=None):
     filters = filters or dict()
-    return model_query(context, models.LoadBalancer).filter_by(**filters).all()
+    return _load_balancer_query(context).filter_by(**filters).all()
+
+
+@require_admin_context
+def load_balancer_get_all_by_states(context, states, batch_size=None,
+                                    marker=None):
+    """Get load balancers in any of `states` through the state index.
+
+    With `batch_size`, return a page of at most `batch_size` of them
+    ordered by id, the ones after the id `marker`. The next page starts
+    after the id of the last one.
+    """
+    query = _load_balancer_query(context).filter(
+        models.LoadBalancer.state.in_(states))
+    if batch_size is None:
+        return query.all()
+    if marker is not None:
+        query = query.filter(models.LoadBalancer.id > marker)
+    return query.order_by(models.LoadBalancer.id).limit(batch_size).all()
+
+
+@require_admin_context
+def load_balancer_get_all_by_uuids(context, uuids):
+    if not uuids:
+        return []
+    return _load_balancer_query(context).filter(
+        models.LoadBalancer.uuid.in_(uuids)).all()
+
+
+def _filter_expected(query, column, expected):
+    """Filter `query` on load balancers still as `expected`.
+
+    :param expected: list of (`column` value, state, revision)
+    """
+    return query.filter(or_(*[and_(column == value,
+                                   models.LoadBalancer.state == state,
+                                   models.LoadBalancer.revision == revision)
+                              for value, state, revision in expected]))
+
+
+@require_admin_context
+def load_balancer_update_states(context, states, destroys=None):
+    """Apply state changes and hard deletes in one transaction.
+
+    Load balancers are changed only while they still are in the state
+    and revision they were read in, the ones changed meanwhile are left
+    alone.
+
+    :param states: dict of new state to list of (uuid, state, revision)
+    :param destroys: list of (id, state, revision) of load balancers to
+                     destroy together with their config, domains and
+                     instance associations
+    :returns: set of uuids of the load balancers actually changed
+    """
+    changed = set()
+    session = context.session
+    with session.begin(subtransactions=True):
+        for new_state, expected in states.iteritems():
+            if not expected:
+                continue
+            query = _filter_expected(
+                session.query(models.LoadBalancer.uuid),
+                models.LoadBalancer.uuid, expected)
+            uuids = [uuid for (uuid,) in query.with_lockmode('update')]
+            if not uuids:
+                continue
+            session.query(models.LoadBalancer).filter(
+                models.LoadBalancer.uuid.in_(uuids)).update(
+                    {'state': new_state,
+                     'revision': models.LoadBalancer.revision + 1,
+                     'updated_at': literal_column('updated_at')},
+                    synchronize_session=False)
+            changed.update(uuids)
+
+        if not destroys:
+            return changed
+        query = _filter_expected(
+            session.query(models.LoadBalancer.id, models.LoadBalancer.uuid),
+            models.LoadBalancer.id, destroys)
+        destroy_ids = []
+        for load_balancer_id, uuid in query.with_lockmode('update'):
+            destroy_ids.append(load_balancer_id)
+            changed.add(uuid)
+        if not destroy_ids:
+            return changed
+        now = utcnow()
+        model = models.LoadBalancerInstanceAssociation
+        session.query(model).filter(
+            model.load_balancer_id.in_(destroy_ids)).delete(
+                synchronize_session=False)
+        for model in [models.LoadBalancerDomain,
+                      models.LoadBalancerConfig]:
+            session.query(model).filter_by(deleted=False).filter(
+                model.load_balancer_id.in_(destroy_ids)).update(
+                    {'deleted': True,
+                     'deleted_at': now},
+                    synchronize_session=False)
+        session.query(models.LoadBalancer).filter(
+            models.LoadBalancer.id.in_(destroy_ids)).update(
+                {'deleted': True,
+                 'state': 'deleted',
+                 'deleted_at': now},
+                synchronize_session=False)
+    return changed
 
 
 def load_balancer_create(context, values):
@@ -131,12 +252,14 @@ def load_balancer_destroy(context, load_balancer_id):
 
 
 def load_balancer_update_state(context, load_balancer_uuid, state):
+    """Every state change starts a new revision of the load balancer."""
     with context.session.begin():
         context.session.query(models.LoadBalancer).filter_by(
             uuid=load_balancer_uuid).update(
                 {'state': state,
-                 'updated_at': literal_column('updated_at')}
-            )
+                 'revision': models.LoadBalancer.revision + 1,
+                 'updated_at': literal_column('updated_at')},
+                synchronize_session=False)
 
 
 # load_balancer_config
@@ -277,6 +400,31 @@ def load_balancer_instance_association_create(context, values):
     return association_ref
 
 
+def load_balancer_instance_association_get_stale(context, before,
+                                                 limit=None):
+    """Associations whose ip is unknown or was resolved before `before`."""
+    model = models.LoadBalancerInstanceAssociation
+    # NOTE: column.is_() needs sqlalchemy 0.7.9, pip-requires allows 0.6
+    query = model_query(context, model).filter(
+        or_(model.instance_ip_resolved_at == None,  # noqa
+            model.instance_ip_resolved_at < before)).order_by(
+                model.instance_ip_resolved_at)
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+
+def load_balancer_instance_association_update(context,
+                                              load_balancer_id,
+                                              instance_uuid,
+                                              values):
+    with context.session.begin():
+        model = models.LoadBalancerInstanceAssociation
+        context.session.query(model).filter_by(
+            load_balancer_id=load_balancer_id).filter_by(
+                instance_uuid=instance_uuid).update(values)
+
+
 def load_balancer_instance_association_destroy(context,
                                                load_balancer_id,
                                                instance_uuid):
@@ -85,7 +85,8 @@ class LoadBalancer(BASE, ShuntBase):
     project_id = Column(String(255), nullable=False)
     free = Column(Boolean, default=False)
     uuid = Column(String(36), nullable=False)
-    state = Column(String(255), nullable=False)
+    state = Column(String(255), nullable=False, index=True)
+    revision = Column(Integer, nullable=False, default=1)
     protocol = Column(String(255), nullable=False)
     dns_prefix = Column(String(255), nullable=False)
     listen_port = Column(Integer, nullable=False)
@@ -104,6 +105,20 @@ class LoadBalancerConfig(BASE, ShuntBase):
     health_check_target_path = Column(String(255))
     health_check_unhealthy_threshold = Column(Integer)
     health_check_healthy_threshold = Column(Integer)
+    # idle connections kept open to the backends by each nginx worker,
+    # 0 disables keepalive
+    keepalive_connections = Column(Integer, nullable=False, default=0)
+    keepalive_timeout_ms = Column(Integer, nullable=False, default=60000)
+    keepalive_requests = Column(Integer, nullable=False, default=100)
+    # timeout and retry policy, NULL leaves it to the driver
+    connect_timeout_ms = Column(Integer)
+    client_timeout_ms = Column(Integer)
+    server_timeout_ms = Column(Integer)
+    retries = Column(Integer)
+    redispatch = Column(Boolean)
+    next_upstream = Column(String(255))
+    max_fails = Column(Integer)
+    fail_timeout_ms = Column(Integer)
 
     load_balancer = relationship(
         LoadBalancer,
@@ -137,6 +152,8 @@ class LoadBalancerInstanceAssociation(BASE, ShuntBase):
     __tablename__ = 'load_balancer_instance_association'
     load_balancer_id = Column(Integer, primary_key=True)
     instance_uuid = Column(String(36), primary_key=True)
+    instance_ip = Column(String(64))
+    instance_ip_resolved_at = Column(DateTime, index=True)
 
     load_balancer = relationship(
         LoadBalancer,
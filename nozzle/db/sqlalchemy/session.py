@@ -82,6 +82,9 @@ def get_engine():
         if 'mysql' in connection_dict.drivername:
             engine_args['listeners'] = [MySQLPingListener()]
 
+        if 'sqlite' not in connection_dict.drivername:
+            engine_args['pool_size'] = FLAGS.sql_max_pool_size
+
         _ENGINE = create_engine(FLAGS.sql_connection, **engine_args)
 
         sql_max_retries = FLAGS.get('sql_max_retries', 3)
@@ -99,8 +102,10 @@ def get_engine():
     return _ENGINE
 
 
-def get_session(autocommit=True, expire_on_commit=True):
+def get_session(autocommit=True, expire_on_commit=False):
     """Helper method to grab session"""
+    # NOTE: refs returned by the db api are read after the call, outside
+    # db_execution_mode; expiring them on commit would reload them there.
     global _MAKER, _ENGINE
     if not _MAKER:
         engine = get_engine()
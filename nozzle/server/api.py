@@ -17,11 +17,15 @@
 #    under the License.
 
 """nozzle api."""
+import datetime
+
 from nozzle import db
 from nozzle.common import exception
 from nozzle.common import flags
 from nozzle.common import utils
 from nozzle.server import protocol
+from nozzle.server import resolver
+from nozzle.server import retry
 from nozzle.server import state
 from nozzle.openstack.common.notifier import api as notifier
 from nozzle.openstack.common import log as logging
@@ -29,6 +33,9 @@ from nozzle.openstack.common import log as logging
 FLAGS = flags.FLAGS
 LOG = logging.getLogger(__name__)
 
+# last stats reported by each worker, by host name
+_worker_stats = dict()
+
 
 def format_msg_to_client(load_balancer_ref):
     result = dict()
@@ -47,6 +54,17 @@ def format_msg_to_client(load_balancer_ref):
         'health_check_target_path',
         'health_check_healthy_threshold',
         'health_check_unhealthy_threshold',
+        'keepalive_connections',
+        'keepalive_timeout_ms',
+        'keepalive_requests',
+        'connect_timeout_ms',
+        'client_timeout_ms',
+        'server_timeout_ms',
+        'retries',
+        'redispatch',
+        'next_upstream',
+        'max_fails',
+        'fail_timeout_ms',
     ]
     config = dict()
     for key in expect_configs:
@@ -81,6 +99,7 @@ def format_msg_to_worker(load_balancer_ref):
     result['tenant_id'] = load_balancer_ref.project_id
     result['uuid'] = load_balancer_ref.uuid
     result['protocol'] = load_balancer_ref.protocol
+    result['revision'] = load_balancer_ref.revision
     expect_keys = [
         'dns_prefix', 'instance_port', 'listen_port',
     ]
@@ -93,6 +112,17 @@ def format_msg_to_worker(load_balancer_ref):
         'health_check_target_path',
         'health_check_healthy_threshold',
         'health_check_unhealthy_threshold',
+        'keepalive_connections',
+        'keepalive_timeout_ms',
+        'keepalive_requests',
+        'connect_timeout_ms',
+        'client_timeout_ms',
+        'server_timeout_ms',
+        'retries',
+        'redispatch',
+        'next_upstream',
+        'max_fails',
+        'fail_timeout_ms',
     ]
     for key in expect_configs:
         result[key] = getattr(load_balancer_ref.config, key)
@@ -112,9 +142,16 @@ def format_msg_to_worker(load_balancer_ref):
     for postfix in postfixs:
         dns_name = '%s%s' % (prefix, postfix)
         dns_names.append(dns_name)
-    instance_ips = []
-    for uuid in instance_uuids:
-        instance_ips.append(utils.get_fixed_ip_by_instance_uuid(uuid))
+    # NOTE: ips are stored when backends are associated, only rows
+    # created before that have to be resolved here.
+    unresolved = [x['instance_uuid'] for x in load_balancer_ref.instances
+                  if not x['instance_ip']]
+    fixed_ips = dict()
+    if unresolved:
+        fixed_ips = resolver.get_resolver().resolve(unresolved)
+    instance_ips = map(lambda x: x['instance_ip'] or
+                       fixed_ips[x['instance_uuid']],
+                       load_balancer_ref.instances)
 
     result['dns_names'] = dns_names
     result['instance_ips'] = instance_ips
@@ -123,16 +160,45 @@ def format_msg_to_worker(load_balancer_ref):
     return result
 
 
+def format_delete_msg_to_worker(load_balancer_ref):
+    result = dict()
+    result['user_id'] = load_balancer_ref.user_id
+    result['tenant_id'] = load_balancer_ref.project_id
+    result['uuid'] = load_balancer_ref.uuid
+    result['protocol'] = load_balancer_ref.protocol
+    result['revision'] = load_balancer_ref.revision
+    return result
+
+
+def get_snapshot(context, chunk_size):
+    """Yield worker messages of all live load balancers, in chunks."""
+    states = [state.ACTIVE, state.CREATING, state.UPDATING]
+    chunk = []
+    all_load_balancers = db.load_balancer_get_all_by_states(
+        context, states, batch_size=None)
+    for load_balancer_ref in all_load_balancers:
+        try:
+            chunk.append({'cmd': 'create_lb',
+                          'args': format_msg_to_worker(load_balancer_ref)})
+        except Exception, exp:
+            LOG.exception(str(exp))
+            continue
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def get_msg_to_worker(context, method, **kwargs):
     result = dict()
     message = dict()
     load_balancer_ref = None
     if method == 'delete_load_balancer':
         result['cmd'] = 'delete_lb'
-        message['user_id'] = kwargs['user_id']
-        message['tenant_id'] = kwargs['tenant_id']
-        message['uuid'] = kwargs['uuid']
-        message['protocol'] = kwargs['protocol']
+        load_balancer_ref = db.load_balancer_get_by_uuid(context,
+                                                         kwargs['uuid'])
+        message = format_delete_msg_to_worker(load_balancer_ref)
     elif method == 'create_load_balancer':
         result['cmd'] = 'create_lb'
         load_balancer_ref = db.load_balancer_get_by_name(context,
@@ -248,6 +314,8 @@ def delete_for_instance(context, **kwargs):
     utils.check_input_parameters(expect_keys, **kwargs)
 
     instance_uuid = kwargs['instance_uuid']
+    # the instance is going away, its fixed ip may be handed out again.
+    resolver.get_resolver().invalidate([instance_uuid])
     try:
         load_balancers = db.load_balancer_get_by_instance_uuid(context,
                                                                instance_uuid)
@@ -404,43 +472,150 @@ def get_all_http_servers(context, **kwargs):
     return {'data': result}
 
 
-def delete_load_balancer_hard(context, load_balancer_ref):
-    try:
-        for association_ref in load_balancer_ref.instances:
-            db.load_balancer_instance_association_destroy(
-                context, load_balancer_ref.id, association_ref.instance_uuid)
+def refresh_instance_ips(context):
+    """Reconcile stored backend ips with nova.
 
-        for domain_ref in load_balancer_ref.domains:
-            db.load_balancer_domain_destroy(context, domain_ref.id)
+    Load balancers whose backend ips changed start a new revision, so
+    the new configuration gets pushed to workers. Active ones are moved
+    to UPDATING, creating and updating ones stay in their state.
+    """
+    before = utils.utcnow() - datetime.timedelta(
+        seconds=FLAGS.instance_ip_max_age)
+    associations = db.load_balancer_instance_association_get_stale(
+        context, before, limit=FLAGS.instance_ip_refresh_batch)
+    if not associations:
+        return
+
+    instance_uuids = list(set(map(lambda x: x['instance_uuid'],
+                                  associations)))
+    ip_resolver = resolver.get_resolver()
+    ip_resolver.invalidate(instance_uuids)
+    fixed_ips = ip_resolver.resolve(instance_uuids, strict=False)
+    resolved_at = utils.utcnow()
+
+    changed_load_balancer_ids = set()
+    for association_ref in associations:
+        values = {'instance_ip_resolved_at': resolved_at}
+        fixed_ip = fixed_ips.get(association_ref.instance_uuid)
+        if fixed_ip and fixed_ip != association_ref.instance_ip:
+            LOG.info('instance %s changed ip from %s to %s',
+                     association_ref.instance_uuid,
+                     association_ref.instance_ip, fixed_ip)
+            values['instance_ip'] = fixed_ip
+            changed_load_balancer_ids.add(association_ref.load_balancer_id)
+        db.load_balancer_instance_association_update(
+            context, association_ref.load_balancer_id,
+            association_ref.instance_uuid, values)
+
+    for load_balancer_id in changed_load_balancer_ids:
+        try:
+            load_balancer_ref = db.load_balancer_get(context,
+                                                     load_balancer_id)
+        except exception.LoadBalancerNotFound:
+            continue
+        if load_balancer_ref.state == state.ACTIVE:
+            db.load_balancer_update_state(context, load_balancer_ref.uuid,
+                                          state.UPDATING)
+        elif load_balancer_ref.state in [state.CREATING, state.UPDATING]:
+            # NOTE: workers skip a revision they applied already, the
+            # change must come with a new one.
+            db.load_balancer_update_state(context, load_balancer_ref.uuid,
+                                          load_balancer_ref.state)
+            retry.get_scheduler().forget(load_balancer_ref.uuid)
+
+
+def give_up_load_balancer(context, load_balancer_ref):
+    """Move a load balancer that ran out of retries to ERROR."""
+    events = {
+        state.CREATING: 'loadbalancer.create.error',
+        state.UPDATING: 'loadbalancer.update.error',
+        state.DELETING: 'loadbalancer.delete.error',
+    }
+    LOG.warn('load balancer %s is still %s after %d dispatches, give up',
+             load_balancer_ref.uuid, load_balancer_ref.state,
+             retry.get_scheduler().attempts(load_balancer_ref.uuid))
+    db.load_balancer_update_state(context, load_balancer_ref.uuid,
+                                  state.ERROR)
+    retry.get_scheduler().forget(load_balancer_ref.uuid)
+    notify(context, load_balancer_ref, events[load_balancer_ref.state])
+
+
+def get_server_stats(context, **kwargs):
+    return {'data': {'retry_queue_size': len(retry.get_scheduler()),
+                     'workers': dict(_worker_stats)}}
 
-        db.load_balancer_config_destroy(context, load_balancer_ref.config.id)
-        db.load_balancer_destroy(context, load_balancer_ref.id)
-    except Exception, exp:
-        raise exception.DeleteLoadBalancerFailed(msg=str(exp))
+
+def update_worker_stats(context, worker, stats):
+    """Keep the queue depth and latency of the drivers of `worker`."""
+    _worker_stats[worker] = {
+        'drivers': stats,
+        'updated_at': utils.utcnow().isoformat(),
+    }
 
 
 def update_load_balancer_state(context, **kwargs):
-    code = kwargs['code']
-    uuid = kwargs['uuid']
+    update_load_balancer_states(context, [kwargs])
+
+
+def update_load_balancer_states(context, feedbacks):
+    """Apply a batch of worker feedbacks in one transaction.
+
+    Every worker reports on every change, only the first feedback of
+    each load balancer in the batch is taken into account. Feedbacks on
+    an older revision than the stored one are stale and ignored, and a
+    load balancer is only changed while it still is in the state and
+    revision the feedback applies to.
+    """
+    all_feedbacks = dict()
+    for feedback in feedbacks:
+        all_feedbacks.setdefault(feedback['uuid'], []).append(feedback)
+
+    transitions = {
+        (200, state.CREATING): (state.ACTIVE, 'loadbalancer.create.end'),
+        (200, state.UPDATING): (state.ACTIVE, 'loadbalancer.update.end'),
+        (200, state.DELETING): (None, 'loadbalancer.delete.end'),
+        (500, state.CREATING): (state.ERROR, 'loadbalancer.create.error'),
+        (500, state.UPDATING): (state.ERROR, 'loadbalancer.update.error'),
+    }
+    states = dict()
+    destroys = []
+    notifications = []
     try:
-        load_balancer_ref = db.load_balancer_get_by_uuid(context, uuid)
+        all_load_balancers = db.load_balancer_get_all_by_uuids(
+            context, all_feedbacks.keys())
+        for load_balancer_ref in all_load_balancers:
+            codes = [feedback['code']
+                     for feedback in all_feedbacks[load_balancer_ref.uuid]
+                     if feedback.get('revision') in
+                     (None, load_balancer_ref.revision)]
+            if not codes:
+                continue
+            key = (codes[0], load_balancer_ref.state)
+            if key not in transitions:
+                continue
+            new_state, event = transitions[key]
+            if new_state is None:
+                destroys.append((load_balancer_ref.id,
+                                 load_balancer_ref.state,
+                                 load_balancer_ref.revision))
+            else:
+                states.setdefault(new_state, []).append(
+                    (load_balancer_ref.uuid,
+                     load_balancer_ref.state,
+                     load_balancer_ref.revision))
+            notifications.append((load_balancer_ref, event))
+        changed = db.load_balancer_update_states(context, states,
+                                                 destroys=destroys)
     except Exception, exp:
         raise exception.UpdateLoadBalancerFailed(msg=str(exp))
-
-    if code == 200:
-        if load_balancer_ref.state == state.DELETING:
-            delete_load_balancer_hard(context, load_balancer_ref)
-            notify(context, load_balancer_ref, 'loadbalancer.delete.end')
-        elif load_balancer_ref.state == state.CREATING:
-            db.load_balancer_update_state(context, uuid, state.ACTIVE)
-            notify(context, load_balancer_ref, 'loadbalancer.create.end')
-        elif load_balancer_ref.state == state.UPDATING:
-            db.load_balancer_update_state(context, uuid, state.ACTIVE)
-            notify(context, load_balancer_ref, 'loadbalancer.update.end')
-    elif code == 500:
-        if load_balancer_ref.state == state.CREATING:
-            db.load_balancer_update_state(context, uuid, state.ERROR)
-            notify(context, load_balancer_ref, 'loadbalancer.create.error')
-        elif load_balancer_ref.state == state.UPDATING:
-            db.load_balancer_update_state(context, uuid, state.ERROR)
-            notify(context, load_balancer_ref, 'loadbalancer.update.error')
+    notifications = [(load_balancer_ref, event)
+                     for load_balancer_ref, event in notifications
+                     if load_balancer_ref.uuid in changed]
+
+    # load balancers which left transient states start a new budget
+    # when they enter one again, the others keep theirs.
+    scheduler = retry.get_scheduler()
+    for load_balancer_ref, event in notifications:
+        scheduler.forget(load_balancer_ref.uuid)
+    for load_balancer_ref, event in notifications:
+        notify(context, load_balancer_ref, event)
@@ -0,0 +1,80 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Ustack Corporation
+# All Rights Reserved.
+# Author: Jiajun Liu <iamljj@gmail.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Sequenced broadcast of requests to workers."""
+import collections
+
+from nozzle.openstack.common import cfg
+from nozzle.openstack.common import jsonutils
+from nozzle.openstack.common import log as logging
+
+from nozzle.common import flags
+from nozzle.common import utils
+
+broadcaster_opts = [
+    cfg.IntOpt('broadcast_hwm',
+               default=10000,
+               help='Messages queued per worker on the broadcast socket '
+                    'before new ones are dropped.'),
+    cfg.IntOpt('broadcast_history_size',
+               default=10000,
+               help='Number of broadcast messages kept for workers to '
+                    'resync missed ones.'),
+]
+
+FLAGS = flags.FLAGS
+FLAGS.register_opts(broadcaster_opts)
+
+LOG = logging.getLogger(__name__)
+
+
+class Broadcaster(object):
+    """Number broadcast messages and keep the latest ones.
+
+    Every message carries the epoch of this server and a sequence
+    number, so workers can detect lost messages and ask for them with
+    get_range().
+    """
+
+    def __init__(self, socket):
+        self.socket = socket
+        self.epoch = utils.str_uuid()
+        self.seq = 0
+        self._history = collections.deque(
+            maxlen=FLAGS.broadcast_history_size)
+
+    def send(self, msg_type, msg_uuid, message):
+        self.seq += 1
+        message['epoch'] = self.epoch
+        message['seq'] = self.seq
+        request_msg = jsonutils.dumps(message)
+        LOG.debug(">>>>>>> worker: %s" % request_msg)
+        self._history.append((self.seq, msg_type, msg_uuid, request_msg))
+        self.socket.send_multipart([msg_type, msg_uuid, request_msg])
+
+    def get_range(self, epoch, first, last):
+        """Return the frames of messages `first` to `last`, inclusive.
+
+        :returns: None if some of them are not kept any more
+        """
+        if epoch != self.epoch or first > last:
+            return None
+        if not self._history or self._history[0][0] > first:
+            return None
+        return [frames[1:] for frames in self._history
+                if first <= frames[0] <= last]
@@ -16,8 +16,10 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import time
+
 import eventlet
-import zmq
+from eventlet.green import zmq
 
 from nozzle.openstack.common import jsonutils
 from nozzle.openstack.common import log as logging
@@ -28,97 +30,140 @@ from nozzle.common import context
 from nozzle.common import flags
 from nozzle.common import utils
 from nozzle.server import api
+from nozzle.server import broadcaster
+from nozzle.server import retry
 from nozzle.server import state
 
 FLAGS = flags.FLAGS
 LOG = logging.getLogger(__name__)
 
 
+def _handle_client_request(handler, broadcast, envelope,
+                           msg_type, msg_uuid, msg_json):
+    response = dict()
+    cli_msg = {'code': 200, 'message': 'OK'}
+    try:
+        msg_body = jsonutils.loads(msg_json)
+        LOG.debug("<<<<<<< client: %s" % msg_body)
+        method = msg_body['method']
+        args = msg_body['args']
+        ctxt = context.get_context(**args)
+        method_func = getattr(api, method)
+        result = method_func(ctxt, **args)
+        if result is not None:
+            response.update(result)
+        # send request to worker
+        try:
+            msg = api.get_msg_to_worker(ctxt, method, **args)
+            if msg is not None:
+                broadcast.send(msg_type, msg_uuid, msg)
+                retry.get_scheduler().start(msg['args']['uuid'])
+        except Exception:
+            pass
+    except Exception as e:
+        cli_msg['code'] = 500
+        cli_msg['message'] = str(e)
+        LOG.exception(cli_msg['message'])
+    response.update(cli_msg)
+    response_msg = jsonutils.dumps(response)
+    LOG.debug(">>>>>>> client: %s" % response_msg)
+    handler.send_multipart(envelope + [msg_type, msg_uuid, response_msg])
+
+
 def client_routine(*args, **kwargs):
     LOG.info('nozzle client starting...')
 
     handler = kwargs['handler']
     broadcast = kwargs['broadcast']
-    poller = zmq.Poller()
-    poller.register(handler, zmq.POLLIN)
+    pool = eventlet.GreenPool(FLAGS.server_pool_size)
 
     while True:
-        eventlet.sleep(0)
-        socks = dict(poller.poll(100))
-        if socks.get(handler) == zmq.POLLIN:
-            msg_type, msg_uuid, msg_json = handler.recv_multipart()
-            response = dict()
-            cli_msg = {'code': 200, 'message': 'OK'}
-            try:
-                msg_body = jsonutils.loads(msg_json)
-                LOG.debug("<<<<<<< client: %s" % msg_body)
-                method = msg_body['method']
-                args = msg_body['args']
-                ctxt = context.get_context(**args)
-                method_func = getattr(api, method)
-                result = method_func(ctxt, **args)
-                if result is not None:
-                    response.update(result)
-                # send request to worker
-                try:
-                    msg = api.get_msg_to_worker(ctxt, method, **args)
-                    if msg is not None:
-                        request_msg = jsonutils.dumps(msg)
-                        LOG.debug(">>>>>>> worker: %s" % request_msg)
-                        broadcast.send_multipart([msg_type, msg_uuid,
-                                                  request_msg])
-                except Exception:
-                    pass
-            except Exception as e:
-                cli_msg['code'] = 500
-                cli_msg['message'] = str(e)
-                LOG.exception(cli_msg['message'])
-            response.update(cli_msg)
-            response_msg = jsonutils.dumps(response)
-            LOG.debug(">>>>>>> client: %s" % response_msg)
-            handler.send_multipart([msg_type, msg_uuid, response_msg])
+        # green socket, parks this routine on the hub until input arrives.
+        frames = handler.recv_multipart()
+        # NOTE: ROUTER prefixes each request with the routing envelope
+        # of the caller, reply must carry it back to reach the client.
+        envelope = frames[:-3]
+        msg_type, msg_uuid, msg_json = frames[-3:]
+        # spawn_n() blocks once the pool is full, which throttles us.
+        pool.spawn_n(_handle_client_request, handler, broadcast,
+                     envelope, msg_type, msg_uuid, msg_json)
 
 
 def worker_routine(*args, **kwargs):
     LOG.info('nozzle worker starting...')
 
     feedback = kwargs['feedback']
-    poller = zmq.Poller()
-    poller.register(feedback, zmq.POLLIN)
 
     while True:
-        eventlet.sleep(0)
-        socks = dict(poller.poll(100))
-        if socks.get(feedback) == zmq.POLLIN:
-            msg_type, msg_uuid, msg_json = feedback.recv_multipart()
-            msg_body = jsonutils.loads(msg_json)
-            LOG.debug("<<<<<<< worker: %s" % msg_body)
-            # update load balancer's state
+        # block for the first feedback, then drain what is queued.
+        frames = [feedback.recv_multipart()]
+        while len(frames) < FLAGS.feedback_batch_size:
+            try:
+                frames.append(feedback.recv_multipart(zmq.NOBLOCK))
+            except zmq.ZMQError:
+                break
+
+        start = time.time()
+        ctxt = context.get_admin_context()
+        feedbacks = []
+        for msg_type, msg_uuid, msg_json in frames:
             try:
-                args = msg_body
-                ctxt = context.get_admin_context()
-                api.update_load_balancer_state(ctxt, **args)
+                msg_body = jsonutils.loads(msg_json)
+                LOG.debug("<<<<<<< worker: %s" % msg_body)
+                if msg_type == 'stats':
+                    # periodic report, the uuid is the worker host name
+                    api.update_worker_stats(ctxt, msg_uuid, msg_body)
+                    continue
+                feedbacks.append(msg_body)
             except Exception as exp:
                 LOG.exception(str(exp))
-                continue
+        # update load balancers' state
+        try:
+            api.update_load_balancer_states(ctxt, feedbacks)
+        except Exception as exp:
+            LOG.exception(str(exp))
+            continue
+        LOG.info('applied %d worker feedbacks in %.3fs',
+                 len(feedbacks), time.time() - start)
+
+
+def _get_load_balancers_by_states(ctxt, states):
+    """Yield load balancers in any of `states`, a db call per page."""
+    marker = None
+    while True:
+        page = db.load_balancer_get_all_by_states(
+            ctxt, states, batch_size=FLAGS.checker_batch_size,
+            marker=marker)
+        for load_balancer_ref in page:
+            yield load_balancer_ref
+        if len(page) < FLAGS.checker_batch_size:
+            return
+        marker = page[-1].id
 
 
 def checker_routine(*args, **kwargs):
     LOG.info('nozzle checker starting...')
 
     broadcast = kwargs['broadcast']
+    scheduler = retry.get_scheduler()
     states = [state.CREATING, state.UPDATING, state.DELETING]
     while True:
-        eventlet.sleep(6)
+        eventlet.sleep(FLAGS.checker_interval)
         msg_type = 'lb'
         msg_uuid = utils.str_uuid()
         try:
             ctxt = context.get_admin_context()
-            all_load_balancers = db.load_balancer_get_all(ctxt)
-            transient_load_balancers = filter(lambda x: x.state in states,
-                                              all_load_balancers)
+            transient_load_balancers = _get_load_balancers_by_states(
+                ctxt, states)
+            seen = set()
             for load_balancer_ref in transient_load_balancers:
+                seen.add(load_balancer_ref.uuid)
+                if not scheduler.is_due(load_balancer_ref.uuid):
+                    continue
                 try:
+                    if scheduler.is_exhausted(load_balancer_ref.uuid):
+                        api.give_up_load_balancer(ctxt, load_balancer_ref)
+                        continue
                     result = dict()
                     message = dict()
                     if load_balancer_ref.state == state.CREATING:
@@ -129,22 +174,97 @@ def checker_routine(*args, **kwargs):
                         result = api.format_msg_to_worker(load_balancer_ref)
                     elif load_balancer_ref.state == state.DELETING:
                         message['cmd'] = 'delete_lb'
-                        result['user_id'] = load_balancer_ref['user_id']
-                        result['tenant_id'] = load_balancer_ref['project_id']
-                        result['uuid'] = load_balancer_ref['uuid']
-                        result['protocol'] = load_balancer_ref['protocol']
+                        result = api.format_delete_msg_to_worker(
+                            load_balancer_ref)
                     message['args'] = result
-                    request_msg = jsonutils.dumps(message)
-                    LOG.debug(">>>>>>> worker: %s" % request_msg)
-                    broadcast.send_multipart([msg_type, msg_uuid, request_msg])
+                    broadcast.send(msg_type, msg_uuid, message)
+                    scheduler.dispatched(load_balancer_ref.uuid)
                 except Exception as exp:
                     LOG.exception(str(exp))
                     continue
+            # load balancers which left transient states are done.
+            scheduler.retain(seen)
+            LOG.debug('retry queue size: %d' % len(scheduler))
         except Exception as exp:
             LOG.exception(str(exp))
             continue
 
 
+def refresher_routine(*args, **kwargs):
+    LOG.info('nozzle refresher starting...')
+
+    while True:
+        eventlet.sleep(FLAGS.instance_ip_refresh_interval)
+        try:
+            ctxt = context.get_admin_context()
+            api.refresh_instance_ips(ctxt)
+        except Exception as exp:
+            LOG.exception(str(exp))
+            continue
+
+
+def _send_snapshot(snapshot, broadcast, envelope, msg_uuid):
+    # NOTE: changes broadcast up to this sequence number are committed,
+    # so the snapshot read afterwards contains them.
+    result = {'code': 200, 'count': 0,
+              'epoch': broadcast.epoch, 'seq': broadcast.seq}
+    try:
+        ctxt = context.get_admin_context()
+        for chunk in api.get_snapshot(ctxt, FLAGS.snapshot_chunk_size):
+            snapshot.send_multipart(envelope + ['chunk', msg_uuid,
+                                                jsonutils.dumps(chunk)])
+            result['count'] += len(chunk)
+    except Exception as exp:
+        LOG.exception(str(exp))
+        result['code'] = 500
+    snapshot.send_multipart(envelope + ['end', msg_uuid,
+                                        jsonutils.dumps(result)])
+    return result['count']
+
+
+def _send_resync(snapshot, broadcast, envelope, msg_uuid, msg_body):
+    frames = broadcast.get_range(msg_body['epoch'], msg_body['first'],
+                                 msg_body['last'])
+    if frames is None:
+        result = {'code': 404}
+    else:
+        result = {'code': 200}
+        # frames as they were broadcast, in chunks.
+        for i in xrange(0, len(frames), FLAGS.snapshot_chunk_size):
+            chunk = frames[i:i + FLAGS.snapshot_chunk_size]
+            snapshot.send_multipart(envelope + ['chunk', msg_uuid,
+                                                jsonutils.dumps(chunk)])
+    snapshot.send_multipart(envelope + ['end', msg_uuid,
+                                        jsonutils.dumps(result)])
+    return len(frames or [])
+
+
+def snapshot_routine(*args, **kwargs):
+    LOG.info('nozzle snapshot starting...')
+
+    snapshot = kwargs['snapshot']
+    broadcast = kwargs['broadcast']
+
+    while True:
+        frames = snapshot.recv_multipart()
+        envelope = frames[:-3]
+        msg_type, msg_uuid, msg_json = frames[-3:]
+        start = time.time()
+        try:
+            msg_body = jsonutils.loads(msg_json)
+            if msg_type == 'resync':
+                count = _send_resync(snapshot, broadcast, envelope,
+                                     msg_uuid, msg_body)
+            else:
+                count = _send_snapshot(snapshot, broadcast, envelope,
+                                       msg_uuid)
+        except Exception as exp:
+            LOG.exception(str(exp))
+            continue
+        LOG.info('sent %s %s of %d items in %.3fs', msg_type, msg_uuid,
+                 count, time.time() - start)
+
+
 class ServerManager(manager.Manager):
 
     def __init__(self):
@@ -156,18 +276,21 @@ class ServerManager(manager.Manager):
         Child class should override this method
 
         """
-        self.pool = eventlet.GreenPool(3)
+        self.pool = eventlet.GreenPool(5)
 
     def start(self):
         zmq_context = zmq.Context()
 
-        # Socket to receive messages on
-        handler = zmq_context.socket(zmq.REP)
+        # Socket to receive messages on, replies are routed back by
+        # envelope so requests can be served out of order.
+        handler = zmq_context.socket(zmq.ROUTER)
         handler.bind("tcp://%s:%s" % (FLAGS.server_listen,
                                       FLAGS.server_listen_port))
 
         # Socket to send messages on
         broadcast = zmq_context.socket(zmq.PUB)
+        broadcast.setsockopt(getattr(zmq, 'SNDHWM', zmq.HWM),
+                             FLAGS.broadcast_hwm)
         broadcast.bind("tcp://%s:%s" % (FLAGS.broadcast_listen,
                                         FLAGS.broadcast_listen_port))
 
@@ -176,15 +299,23 @@ class ServerManager(manager.Manager):
         feedback.bind("tcp://%s:%s" % (FLAGS.feedback_listen,
                                        FLAGS.feedback_listen_port))
 
+        # Socket for workers to fetch the state of all load balancers
+        snapshot = zmq_context.socket(zmq.ROUTER)
+        snapshot.bind("tcp://%s:%s" % (FLAGS.snapshot_listen,
+                                       FLAGS.snapshot_listen_port))
+
         args = {
             'handler': handler,
-            'broadcast': broadcast,
+            'broadcast': broadcaster.Broadcaster(broadcast),
             'feedback': feedback,
+            'snapshot': snapshot,
         }
 
         self.pool.spawn(client_routine, **args)
         self.pool.spawn(worker_routine, **args)
         self.pool.spawn(checker_routine, **args)
+        self.pool.spawn(refresher_routine, **args)
+        self.pool.spawn(snapshot_routine, **args)
 
     def wait(self):
         self.pool.waitall()
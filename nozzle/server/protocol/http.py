@@ -20,8 +20,51 @@
 from nozzle import db
 from nozzle.common import exception
 from nozzle.common import utils
+from nozzle.server import resolver
 from nozzle.server import state
 
+# optional in config, with their range
+_OPTIONAL_CONFIGS = [
+    ('keepalive_connections', 0, 1024),
+    ('keepalive_timeout_ms', 1000, 3600000),
+    ('keepalive_requests', 1, 100000),
+    ('connect_timeout_ms', 100, 75000),
+    ('client_timeout_ms', 1000, 3600000),
+    ('server_timeout_ms', 1000, 3600000),
+    ('retries', 0, 10),
+    ('max_fails', 0, 100),
+    ('fail_timeout_ms', 1000, 3600000),
+]
+
+# cases passed to the next backend, as nginx proxy_next_upstream
+_NEXT_UPSTREAM_CONDITIONS = [
+    'error', 'timeout', 'invalid_header', 'http_500', 'http_502',
+    'http_503', 'http_504', 'http_403', 'http_404', 'non_idempotent',
+    'off',
+]
+
+
+def _check_optional_config(config):
+    """Check the keepalive and retry settings present in `config`.
+
+    :returns: dict of the settings to store
+    """
+    values = utils.check_optional_configs(_OPTIONAL_CONFIGS, config)
+    if 'next_upstream' in config:
+        conditions = config['next_upstream']
+        if isinstance(conditions, basestring):
+            conditions = conditions.split()
+        else:
+            conditions = None
+        if (not conditions or
+                not set(conditions) <= set(_NEXT_UPSTREAM_CONDITIONS) or
+                ('off' in conditions and len(conditions) > 1)):
+            raise exception.InvalidParameter(
+                msg='invalid next_upstream, should be some of %s' %
+                ' '.join(_NEXT_UPSTREAM_CONDITIONS))
+        values['next_upstream'] = ' '.join(conditions)
+    return values
+
 
 def create_load_balancer(context, **kwargs):
     expect_keys = [
@@ -54,6 +97,7 @@ def create_load_balancer(context, **kwargs):
     if not config['health_check_target_path']:
         raise exception.InvalidParameter(
             msg='health check path could not be null')
+    optional_values = _check_optional_config(config)
 
     try:
         free = kwargs['free']
@@ -79,6 +123,13 @@ def create_load_balancer(context, **kwargs):
             exp = exception.LoadBalancerDomainExists(domain_name=name)
             raise exception.CreateLoadBalancerFailed(msg=str(exp))
 
+    # resolve backend ips before writing anything
+    try:
+        fixed_ips = resolver.get_resolver().resolve(kwargs['instance_uuids'])
+        resolved_at = utils.utcnow()
+    except Exception, exp:
+        raise exception.CreateLoadBalancerFailed(msg=str(exp))
+
     # create load balancer
     config_ref = None
     load_balancer_ref = None
@@ -110,6 +161,7 @@ def create_load_balancer(context, **kwargs):
             'health_check_healthy_threshold': 0,
             'health_check_unhealthy_threshold': 0,
         }
+        config_values.update(optional_values)
         config_ref = db.load_balancer_config_create(context, config_values)
         # binding domains
         for domain in kwargs['http_server_names']:
@@ -124,6 +176,8 @@ def create_load_balancer(context, **kwargs):
             association = {
                 'load_balancer_id': load_balancer_ref.id,
                 'instance_uuid': uuid,
+                'instance_ip': fixed_ips[uuid],
+                'instance_ip_resolved_at': resolved_at,
             }
             db.load_balancer_instance_association_create(context, association)
             associated_instances.append(uuid)
@@ -172,6 +226,7 @@ def update_load_balancer_config(context, **kwargs):
     if not config['health_check_target_path']:
         raise exception.InvalidParameter(
             msg='health check path could not be null')
+    optional_values = _check_optional_config(config)
 
     uuid = kwargs['uuid']
     try:
@@ -188,6 +243,7 @@ def update_load_balancer_config(context, **kwargs):
         'health_check_healthy_threshold': 0,
         'health_check_unhealthy_threshold': 0,
     }
+    config_values.update(optional_values)
     try:
         db.load_balancer_config_destroy(context, load_balancer_ref.config.id)
         db.load_balancer_config_create(context, config_values)
@@ -222,6 +278,12 @@ def update_load_balancer_instances(context, **kwargs):
                                     old_instance_uuids)
     need_created_instances = filter(lambda x: x not in old_instance_uuids,
                                     new_instance_uuids)
+    try:
+        fixed_ips = resolver.get_resolver().resolve(need_created_instances)
+        resolved_at = utils.utcnow()
+    except Exception, exp:
+        raise exception.UpdateLoadBalancerFailed(msg=str(exp))
+
     try:
         for instance_uuid in need_deleted_instances:
             db.load_balancer_instance_association_destroy(
@@ -230,6 +292,8 @@ def update_load_balancer_instances(context, **kwargs):
             association = {
                 'load_balancer_id': load_balancer_ref.id,
                 'instance_uuid': instance_uuid,
+                'instance_ip': fixed_ips[instance_uuid],
+                'instance_ip_resolved_at': resolved_at,
             }
             db.load_balancer_instance_association_create(context, association)
         db.load_balancer_update_state(context, uuid, state.UPDATING)
@@ -20,8 +20,19 @@
 from nozzle import db
 from nozzle.common import exception
 from nozzle.common import utils
+from nozzle.server import resolver
 from nozzle.server import state
 
+# optional in config, with their range
+_OPTIONAL_CONFIGS = [
+    ('connect_timeout_ms', 100, 75000),
+    ('client_timeout_ms', 1000, 3600000),
+    ('server_timeout_ms', 1000, 3600000),
+    ('retries', 0, 10),
+    ('redispatch', 0, 1),
+    ('max_fails', 0, 100),
+]
+
 
 def create_load_balancer(context, **kwargs):
     expect_keys = [
@@ -58,6 +69,8 @@ def create_load_balancer(context, **kwargs):
     if not 1 <= config['health_check_unhealthy_threshold'] <= 10:
         raise exception.InvalidParameter(
             msg='Healthy check unhealthy threshold out of rage, 1~10')
+    optional_values = utils.check_optional_configs(_OPTIONAL_CONFIGS,
+                                                   config)
 
     try:
         free = kwargs['free']
@@ -76,6 +89,13 @@ def create_load_balancer(context, **kwargs):
     else:
         raise exception.CreateLoadBalancerFailed(msg='already exists!')
 
+    # resolve backend ips before writing anything
+    try:
+        fixed_ips = resolver.get_resolver().resolve(kwargs['instance_uuids'])
+        resolved_at = utils.utcnow()
+    except Exception, exp:
+        raise exception.CreateLoadBalancerFailed(msg=str(exp))
+
     # create load balancer
     config_ref = None
     load_balancer_ref = None
@@ -108,12 +128,15 @@ def create_load_balancer(context, **kwargs):
             'health_check_unhealthy_threshold':
             config['health_check_unhealthy_threshold'],
         }
+        config_values.update(optional_values)
         config_ref = db.load_balancer_config_create(context, config_values)
         # binding instances
         for uuid in kwargs['instance_uuids']:
             association = {
                 'load_balancer_id': load_balancer_ref.id,
                 'instance_uuid': uuid,
+                'instance_ip': fixed_ips[uuid],
+                'instance_ip_resolved_at': resolved_at,
             }
             db.load_balancer_instance_association_create(context, association)
             associated_instances.append(uuid)
@@ -163,6 +186,8 @@ def update_load_balancer_config(context, **kwargs):
     if not 1 <= config['health_check_unhealthy_threshold'] <= 10:
         raise exception.InvalidParameter(
             msg='Healthy check unhealthy threshold out of rage, 1~10')
+    optional_values = utils.check_optional_configs(_OPTIONAL_CONFIGS,
+                                                   config)
 
     uuid = kwargs['uuid']
     try:
@@ -181,6 +206,7 @@ def update_load_balancer_config(context, **kwargs):
         'health_check_unhealthy_threshold':
         config['health_check_unhealthy_threshold'],
     }
+    config_values.update(optional_values)
     try:
         db.load_balancer_config_destroy(context, load_balancer_ref.config.id)
         db.load_balancer_config_create(context, config_values)
@@ -215,6 +241,12 @@ def update_load_balancer_instances(context, **kwargs):
                                     old_instance_uuids)
     need_created_instances = filter(lambda x: x not in old_instance_uuids,
                                     new_instance_uuids)
+    try:
+        fixed_ips = resolver.get_resolver().resolve(need_created_instances)
+        resolved_at = utils.utcnow()
+    except Exception, exp:
+        raise exception.UpdateLoadBalancerFailed(msg=str(exp))
+
     try:
         for instance_uuid in need_deleted_instances:
             db.load_balancer_instance_association_destroy(
@@ -223,6 +255,8 @@ def update_load_balancer_instances(context, **kwargs):
             association = {
                 'load_balancer_id': load_balancer_ref.id,
                 'instance_uuid': instance_uuid,
+                'instance_ip': fixed_ips[instance_uuid],
+                'instance_ip_resolved_at': resolved_at,
             }
             db.load_balancer_instance_association_create(context, association)
         db.load_balancer_update_state(context, uuid, state.UPDATING)
@@ -0,0 +1,195 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Ustack Corporation
+# All Rights Reserved.
+# Author: Jiajun Liu <iamljj@gmail.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Resolve fixed ips of backend instances through nova."""
+import time
+
+import eventlet
+from eventlet import pools
+from novaclient import exceptions as nova_exceptions
+
+from nozzle.openstack.common import cfg
+from nozzle.openstack.common import log as logging
+
+from nozzle.common import exception
+from nozzle.common import flags
+from nozzle.common import utils
+
+resolver_opts = [
+    cfg.IntOpt('instance_ip_cache_ttl',
+               default=300,
+               help='Seconds a resolved instance ip is kept in cache.'),
+    cfg.IntOpt('nova_list_threshold',
+               default=5,
+               help='Resolve with paged nova list calls once this many '
+                    'instances miss the cache, and the listing of all '
+                    'instances takes fewer calls than getting them.'),
+    cfg.IntOpt('nova_list_page_size',
+               default=1000,
+               help='Instances per nova list call.'),
+    cfg.IntOpt('nova_max_concurrency',
+               default=8,
+               help='Max number of nova calls in flight.'),
+    cfg.IntOpt('instance_ip_refresh_interval',
+               default=60,
+               help='Seconds between two runs of the backend ip refresher.'),
+    cfg.IntOpt('instance_ip_max_age',
+               default=600,
+               help='Re-resolve stored backend ips older than this.'),
+    cfg.IntOpt('instance_ip_refresh_batch',
+               default=500,
+               help='Max number of backend ips re-resolved per run.'),
+]
+
+FLAGS = flags.FLAGS
+FLAGS.register_opts(resolver_opts)
+
+LOG = logging.getLogger(__name__)
+
+_RESOLVER = None
+
+
+class InstanceIpResolver(object):
+    """Map instance uuids to fixed ips.
+
+    Results are cached for instance_ip_cache_ttl seconds. Cache misses
+    are fetched with paged nova list calls when that takes fewer calls
+    than getting them one by one, otherwise with concurrent nova get
+    calls. Each nova client is used by one green thread at a time, the
+    client pool bounds concurrency.
+    """
+
+    def __init__(self, client_factory=None):
+        self._cache = {}
+        # instances in the cloud, as counted by the last listing
+        self._cloud_size = None
+        self._clients = pools.Pool(max_size=FLAGS.nova_max_concurrency,
+                                   create=client_factory or
+                                   utils.new_nova_client)
+
+    def invalidate(self, instance_uuids=None):
+        if instance_uuids is None:
+            self._cache.clear()
+            return
+        for uuid in instance_uuids:
+            self._cache.pop(uuid, None)
+
+    def resolve(self, instance_uuids, strict=True):
+        """Return a dict of instance uuid to fixed ip.
+
+        :param strict: if False, instances without fixed ip are left out
+                       of the result instead of raising
+        :raises: InstanceFixedIpNotFound if any instance has no fixed ip
+        """
+        result = dict()
+        missing = []
+        now = time.time()
+        for uuid in instance_uuids:
+            cached = self._cache.get(uuid)
+            if cached and cached[1] > now:
+                result[uuid] = cached[0]
+            elif uuid not in missing:
+                self._cache.pop(uuid, None)
+                missing.append(uuid)
+
+        if (len(missing) >= FLAGS.nova_list_threshold and
+                self._count_list_pages() < len(missing)):
+            self._fetch_all(missing)
+            missing = self._pick_cached(missing, result)
+        if missing:
+            self._fetch(missing)
+            missing = self._pick_cached(missing, result)
+
+        if missing and strict:
+            raise exception.InstanceFixedIpNotFound(instance_uuid=missing[0])
+        return result
+
+    def resolve_one(self, instance_uuid):
+        return self.resolve([instance_uuid])[instance_uuid]
+
+    def _pick_cached(self, instance_uuids, result):
+        missing = []
+        for uuid in instance_uuids:
+            if uuid in self._cache:
+                result[uuid] = self._cache[uuid][0]
+            else:
+                missing.append(uuid)
+        return missing
+
+    def _remember(self, instance):
+        fixed_ip = utils.get_instance_fixed_ip(instance)
+        if fixed_ip is not None:
+            expire_at = time.time() + FLAGS.instance_ip_cache_ttl
+            self._cache[instance.id] = (fixed_ip, expire_at)
+
+    def _count_list_pages(self):
+        """Estimate the nova list calls needed to list all instances."""
+        if self._cloud_size is None:
+            return 1
+        return self._cloud_size / FLAGS.nova_list_page_size + 1
+
+    def _fetch_all(self, instance_uuids):
+        """List the instances of all tenants page by page.
+
+        Stops once `instance_uuids` are all found, or after fewer calls
+        than getting them would take, the rest is left to nova get.
+        """
+        wanted = set(instance_uuids)
+        page_size = FLAGS.nova_list_page_size
+        search_opts = {'all_tenants': 1, 'limit': page_size}
+        pages = 0
+        listed = 0
+        while wanted:
+            if pages >= len(instance_uuids) - 1:
+                # a bigger cloud than we knew of
+                self._cloud_size = max(self._cloud_size or 0, listed + 1)
+                break
+            with self._clients.item() as client:
+                instances = client.servers.list(search_opts=search_opts)
+            pages += 1
+            listed += len(instances)
+            for instance in instances:
+                self._remember(instance)
+                wanted.discard(instance.id)
+            if len(instances) < page_size:
+                self._cloud_size = listed
+                break
+            search_opts['marker'] = instances[-1].id
+        LOG.debug('listed %d instances with %d nova list calls',
+                  listed, pages)
+
+    def _fetch(self, instance_uuids):
+        pool = eventlet.GreenPool(FLAGS.nova_max_concurrency)
+        for instance in pool.imap(self._get_instance, instance_uuids):
+            if instance is not None:
+                self._remember(instance)
+
+    def _get_instance(self, instance_uuid):
+        with self._clients.item() as client:
+            try:
+                return client.servers.get(instance_uuid)
+            except nova_exceptions.NotFound:
+                LOG.warn('instance %s not found in nova', instance_uuid)
+                return None
+
+
+def get_resolver():
+    global _RESOLVER
+    if _RESOLVER is None:
+        _RESOLVER = InstanceIpResolver()
+    return _RESOLVER
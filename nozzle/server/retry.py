@@ -0,0 +1,97 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Ustack Corporation
+# All Rights Reserved.
+# Author: Jiajun Liu <iamljj@gmail.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Schedule re-broadcasts of load balancers stuck in transient states."""
+import time
+
+from nozzle.openstack.common import cfg
+
+from nozzle.common import flags
+
+retry_opts = [
+    cfg.IntOpt('retry_base_interval',
+               default=6,
+               help='Seconds to wait before the first re-broadcast of a '
+                    'load balancer, doubled on every further attempt.'),
+    cfg.IntOpt('retry_max_interval',
+               default=300,
+               help='Upper bound of the wait between two re-broadcasts.'),
+    cfg.IntOpt('retry_budget',
+               default=10,
+               help='Dispatches of a load balancer to workers before '
+                    'moving it to ERROR.'),
+]
+
+FLAGS = flags.FLAGS
+FLAGS.register_opts(retry_opts)
+
+_SCHEDULER = None
+
+
+class RetryScheduler(object):
+    """Track dispatches of load balancers to workers.
+
+    Each load balancer uuid maps to the number of dispatches so far and
+    the time it becomes due again. The wait grows exponentially from
+    retry_base_interval up to retry_max_interval.
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def start(self, uuid, now=None):
+        """Record the first dispatch of a new change."""
+        self.forget(uuid)
+        self.dispatched(uuid, now=now)
+
+    def dispatched(self, uuid, now=None):
+        now = now or time.time()
+        attempts = self._entries.get(uuid, (0, 0))[0] + 1
+        delay = min(FLAGS.retry_base_interval * 2 ** (attempts - 1),
+                    FLAGS.retry_max_interval)
+        self._entries[uuid] = (attempts, now + delay)
+
+    def is_due(self, uuid, now=None):
+        if uuid not in self._entries:
+            return True
+        return (now or time.time()) >= self._entries[uuid][1]
+
+    def attempts(self, uuid):
+        return self._entries.get(uuid, (0, 0))[0]
+
+    def is_exhausted(self, uuid):
+        return self.attempts(uuid) >= FLAGS.retry_budget
+
+    def forget(self, uuid):
+        self._entries.pop(uuid, None)
+
+    def retain(self, uuids):
+        """Drop entries of load balancers not in `uuids`."""
+        for uuid in self._entries.keys():
+            if uuid not in uuids:
+                del self._entries[uuid]
+
+
+def get_scheduler():
+    global _SCHEDULER
+    if _SCHEDULER is None:
+        _SCHEDULER = RetryScheduler()
+    return _SCHEDULER
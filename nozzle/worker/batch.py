@@ -0,0 +1,49 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Ustack Corporation
+# All Rights Reserved.
+# Author: Jiajun Liu <iamljj@gmail.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Helpers to apply a batch of changes with a single reload."""
+
+
+def bisect(changes, check):
+    """Split `changes` into the ones valid together and the bad ones.
+
+    The whole batch is checked first. When that fails it is halved and
+    each half checked on top of the changes accepted so far, down to
+    single changes, which keeps the order of `changes`.
+
+    :param check: callable taking a list of changes, returning None if
+                  they are valid together and an error string otherwise
+    :returns: (accepted changes, list of (rejected change, error))
+    """
+    accepted = []
+    rejected = []
+
+    def _bisect(pending):
+        error = check(accepted + pending)
+        if error is None:
+            accepted.extend(pending)
+        elif len(pending) == 1:
+            rejected.append((pending[0], error))
+        else:
+            middle = len(pending) // 2
+            _bisect(pending[:middle])
+            _bisect(pending[middle:])
+
+    if changes:
+        _bisect(list(changes))
+    return accepted, rejected
@@ -1,4 +1,8 @@
 import os
+import re
+import signal
+import socket
+import time
 import datetime
 
 from nozzle.openstack.common import cfg
@@ -8,6 +12,8 @@ from nozzle.common import flags
 from nozzle.common import exception
 from nozzle.common import validate
 from nozzle.common import utils
+from nozzle.worker import batch
+from nozzle.worker import fileutils
 
 haproxy_opts = [
     cfg.ListOpt('listen',
@@ -19,6 +25,54 @@ haproxy_opts = [
     cfg.StrOpt('configuration_backup_dir',
                default='/var/lib/nozzle/backup/haproxy',
                help="Directory for backup haproxy configuration"),
+    cfg.StrOpt('config_dir',
+               default='',
+               help="If set, haproxy.cfg only holds the global and defaults "
+                    "sections and each load balancer gets its own file in "
+                    "this directory"),
+    cfg.BoolOpt('runtime_api',
+                default=False,
+                help="Apply backend membership changes through the haproxy "
+                     "stats socket instead of reloading haproxy"),
+    cfg.StrOpt('stats_socket',
+               default='/var/run/haproxy.sock',
+               help="Path of the haproxy stats socket, it must be declared "
+                    "with level admin"),
+    cfg.FloatOpt('stats_socket_timeout',
+                 default=5.0,
+                 help="Seconds to wait for an answer of the stats socket"),
+    cfg.StrOpt('validation',
+               default='full',
+               help="'full' tests the whole configuration for every batch, "
+                    "'scoped' only tests the changed load balancers with "
+                    "the global sections, and the whole configuration "
+                    "every full_validation_interval seconds"),
+    cfg.IntOpt('full_validation_interval',
+               default=300,
+               help="Seconds between two tests of the whole configuration "
+                    "in scoped validation"),
+    cfg.IntOpt('validation_timeout',
+               default=60,
+               help="Seconds after which a configuration test is killed "
+                    "and the changes tested rejected"),
+    cfg.StrOpt('reload_mode',
+               default='sf',
+               help="'sf' starts a new haproxy which binds the listeners "
+                    "again while the old one finishes. 'seamless' passes "
+                    "the listening sockets of the old haproxy to the new "
+                    "one through stats_socket, which needs 'expose-fd "
+                    "listeners' on it. 'master' sends SIGUSR2 to a haproxy "
+                    "started in master-worker mode (-W) with the same "
+                    "configuration files, its pid in /var/run/haproxy.pid"),
+    cfg.IntOpt('server_slots',
+               default=8,
+               help="Server lines provisioned in each listen section when "
+                    "runtime_api is enabled, unused ones are disabled"),
+    cfg.IntOpt('drain_timeout',
+               default=30,
+               help="Seconds a removed server is drained at runtime before "
+                    "it is put in maintenance on a later change, 0 puts "
+                    "it in maintenance at once"),
 ]
 
 FLAGS = flags.FLAGS
@@ -26,6 +80,237 @@ FLAGS.register_opts(haproxy_opts, 'haproxy')
 
 LOG = logging.getLogger(__name__)
 
+_SERVER_RE = re.compile(r'^\tserver (?P<slot>\S+) '
+                        r'(?P<address>[^\s:]+):(?P<port>\d+) '
+                        r'(?P<options>.*?)(?P<disabled> disabled)?'
+                        r'(?: # (?P<uuid>\S+))?$')
+
+
+_BIND_RE = re.compile(r'^\tbind (\S+)$', re.M)
+
+
+def _get_bind_ports(section):
+    match = _BIND_RE.search(section or '')
+    if match is None:
+        return set()
+    return set(address.rsplit(':', 1)[1]
+               for address in match.group(1).split(','))
+
+
+def _split_listen_cfg(section):
+    """Split a listen section into its server lines and the others.
+
+    :returns: (list of other lines, list of server dicts)
+    """
+    lines = []
+    servers = []
+    for line in (section or '').strip('\n').split('\n'):
+        match = _SERVER_RE.match(line)
+        if match:
+            servers.append(match.groupdict())
+        else:
+            lines.append(line)
+    return lines, servers
+
+
+def _same_section(section, other):
+    """Compare listen sections, parsed from a file or freshly rendered."""
+    if section is None or other is None:
+        return section is other
+    return section.strip('\n') == other.strip('\n')
+
+
+class HaproxyConfig(object):
+    """haproxy.cfg parsed into its header and listen sections.
+
+    The header holds the global and defaults sections, listen sections
+    are kept by load balancer name. The file is parsed once and the
+    model kept in sync with what is committed, it is parsed again only
+    when the file changed behind our back.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header = ''
+        self.sections = {}
+        self._stat = None
+
+    def __contains__(self, name):
+        return name in self.sections
+
+    def _get_stat(self):
+        stat = os.stat(self.path)
+        return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+    def load(self):
+        header = []         # global, defaults
+        sections = {}       # listen
+        name = None
+        with open(self.path) as cfg_file:
+            for line in cfg_file:
+                if line.startswith('listen'):
+                    name = line.split()[1]
+                    sections[name] = [line]
+                elif name is None:
+                    header.append(line)
+                elif line.startswith('\t'):
+                    sections[name].append(line)
+        self.header = ''.join(header)
+        self.sections = dict((k, ''.join(v)) for k, v in sections.iteritems())
+        self._stat = self._get_stat()
+
+    def ensure_fresh(self):
+        """Parse the file on first use, or when it changed on disk."""
+        if self._stat is None:
+            self.load()
+        elif self._get_stat() != self._stat:
+            LOG.warn('%s changed on disk, parse it again', self.path)
+            self.load()
+
+    def is_noop(self, change):
+        """Whether `change` leaves the configuration as it is."""
+        current = self.sections.get(change['name'])
+        if change['cmd'] == 'delete_lb':
+            return current is None
+        return _same_section(current, change['section'])
+
+    def apply(self, changes):
+        """Return the listen sections with `changes` applied."""
+        sections = dict(self.sections)
+        for change in changes:
+            name = change['name']
+            if change['cmd'] == 'create_lb':
+                if name in sections:
+                    raise exception.HaproxyLBExists(name=name)
+                sections[name] = change['section']
+            elif change['cmd'] == 'update_lb':
+                if name not in sections:
+                    raise exception.HaproxyLBNotExists(name=name)
+                sections[name] = change['section']
+            elif change['cmd'] == 'delete_lb':
+                sections.pop(name, None)
+        return sections
+
+    def render(self, sections=None):
+        if sections is None:
+            sections = self.sections
+        # sorted, so that the same load balancers give the same file.
+        body = ['\n%s\n' % sections[name].strip('\n')
+                for name in sorted(sections)]
+        return '%s\n%s' % (self.header.rstrip('\n'), ''.join(body))
+
+    def write(self, cfg_path, sections=None):
+        fileutils.write_atomic(cfg_path, self.render(sections))
+
+    def commit(self, sections):
+        """Take `sections` as what the file holds now."""
+        self.sections = sections
+        self._stat = self._get_stat()
+
+
+class HaproxyConfigDir(HaproxyConfig):
+    """haproxy.cfg holding the header, plus one file per listen section.
+
+    Load balancer `name` lives in `config_dir`/`name`.cfg, haproxy is
+    given both with `-f haproxy.cfg -f config_dir`.
+    """
+
+    def __init__(self, path, config_dir):
+        super(HaproxyConfigDir, self).__init__(path)
+        self.config_dir = config_dir
+        # listen sections still found in haproxy.cfg, moved on commit
+        self.inline = set()
+        if not os.path.exists(config_dir):
+            os.makedirs(config_dir)
+
+    def section_path(self, name):
+        return os.path.join(self.config_dir, '%s.cfg' % name)
+
+    def _get_stat(self):
+        stat = os.stat(self.config_dir)
+        return (super(HaproxyConfigDir, self)._get_stat(),
+                stat.st_ino, stat.st_mtime)
+
+    def load(self):
+        super(HaproxyConfigDir, self).load()
+        self.inline = set(self.sections)
+        if self.inline:
+            LOG.warn('%d load balancers found in %s, they are moved to %s '
+                     'on the next change', len(self.inline), self.path,
+                     self.config_dir)
+        for filename in os.listdir(self.config_dir):
+            if not filename.endswith('.cfg'):
+                continue
+            with open(os.path.join(self.config_dir, filename)) as cfg_file:
+                self.sections[filename[:-len('.cfg')]] = cfg_file.read()
+        self._stat = self._get_stat()
+
+    def diff(self, sections):
+        """Return (names to write, names to remove) to get `sections`."""
+        updated = [name for name, section in sections.iteritems()
+                   if name in self.inline or
+                   not _same_section(self.sections.get(name), section)]
+        removed = [name for name in self.sections if name not in sections]
+        return updated, removed
+
+    def render_section(self, section):
+        return '\n%s\n' % section.strip('\n')
+
+    def write_section(self, cfg_path, section):
+        fileutils.write_atomic(cfg_path, self.render_section(section))
+
+    def write_header(self, cfg_path):
+        fileutils.write_atomic(cfg_path, self.header)
+
+    def commit(self, sections):
+        self.inline = set()
+        super(HaproxyConfigDir, self).commit(sections)
+
+
+class HaproxyRuntime(object):
+    """Client of the haproxy stats socket.
+
+    Every command is sent on its own connection, haproxy answers and
+    closes it.
+    """
+
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+
+    def execute(self, command):
+        LOG.debug('haproxy runtime: %s', command)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        chunks = []
+        try:
+            sock.connect(self.path)
+            sock.sendall(command + '\n')
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                chunks.append(data)
+        except socket.error as e:
+            raise exception.HaproxyRuntimeError(explanation=str(e))
+        finally:
+            sock.close()
+        return ''.join(chunks).strip()
+
+    def set_server_addr(self, backend, server, address):
+        response = self.execute('set server %s/%s addr %s' %
+                                (backend, server, address))
+        if not (response.startswith('IP changed') or
+                response.startswith('no need to change')):
+            raise exception.HaproxyRuntimeError(explanation=response)
+
+    def set_server_state(self, backend, server, state):
+        """Set `server` to 'ready', 'drain' or 'maint'."""
+        response = self.execute('set server %s/%s state %s' %
+                                (backend, server, state))
+        if response:
+            raise exception.HaproxyRuntimeError(explanation=response)
+
 
 class HaproxyConfigurer(object):
 
@@ -49,6 +334,21 @@ class HaproxyConfigurer(object):
         self.listen_port_max = int(listen_port_range[1])
 
         self.cfg_backup_dir = FLAGS.haproxy.configuration_backup_dir
+        self.config_dir = FLAGS.haproxy.config_dir
+        if self.config_dir:
+            self.config = HaproxyConfigDir('/etc/haproxy/haproxy.cfg',
+                                           self.config_dir)
+        else:
+            self.config = HaproxyConfig('/etc/haproxy/haproxy.cfg')
+        self.stats = {'changes': 0, 'skipped': 0}
+        self._last_full_validation = 0
+        self.runtime = None
+        # (name, slot) of the drained servers to their deadline
+        self._draining = dict()
+        if FLAGS.haproxy.runtime_api:
+            self.runtime = HaproxyRuntime(
+                FLAGS.haproxy.stats_socket,
+                timeout=FLAGS.haproxy.stats_socket_timeout)
 
         if not os.path.exists(self.cfg_backup_dir):
             strerror = ("configuration_backup_dir(dir=%s) does not exist" %
@@ -85,62 +385,457 @@ class HaproxyConfigurer(object):
             except exception.HaproxyUpdateError as e:
                 raise exception.HaproxyConfigureError(explanation=str(e))
 
-    def _create_lb(self, msg):
-        LOG.debug("Creating the haproxy load "
-                  "balancer for NAME:%s USER: %s PROJECT:%s" %
-                  (msg['uuid'], msg['user_id'], msg['tenant_id']))
+    @utils.synchronized('haproxy')
+    def do_config_batch(self, requests):
+        """Apply `requests` with a single configuration test and reload.
+
+        Changes which make the configuration invalid are isolated by
+        bisection and left out, the others are committed together.
+
+        :returns: list holding None or the error of each request
+        """
+        return self._config_batch(requests)
 
+    def _config_batch(self, requests):
+        try:
+            self.config.ensure_fresh()
+        except IOError as e:
+            LOG.error("Failed to read haproxy configuration: %s", e)
+            return [str(e)] * len(requests)
+        self._finish_draining()
+
+        results = [None] * len(requests)
+        changes = []
+        for index, request in enumerate(requests):
+            msg = request['args']
+            try:
+                self._validate_request(request)
+                name = self._get_lb_name(msg)
+                section = None
+                if request['cmd'] != 'delete_lb':
+                    section = self._format_haproxy_listen_cfg(
+                        msg, self.config.sections.get(name))
+            except (exception.BadRequest,
+                    exception.HaproxyCreateError) as e:
+                LOG.warn('Bad request: %s' % e)
+                results[index] = str(e)
+                continue
+            change = {'index': index,
+                      'cmd': request['cmd'],
+                      'name': name,
+                      'section': section}
+            self.stats['changes'] += 1
+            if self.config.is_noop(change):
+                # e.g. a re-broadcast, nothing to test nor reload
+                LOG.debug('Skip %s of %s, no change', change['cmd'], name)
+                self.stats['skipped'] += 1
+                continue
+            changes.append(change)
+        if not changes:
+            return results
+
+        def check(subset, scoped=False):
+            try:
+                sections = self.config.apply(subset)
+                error = self._lint_haproxy_cfg(sections, subset)
+                if error is not None:
+                    return error
+                if scoped:
+                    cfg_paths = self._stage_scoped_config(subset)
+                else:
+                    cfg_paths = self._stage_config(sections)
+                self._test_haproxy_config(*cfg_paths)
+            except (exception.HaproxyLBExists,
+                    exception.HaproxyLBNotExists,
+                    exception.ProcessExecutionError,
+                    IOError, OSError) as e:
+                return str(e)
+            if not scoped:
+                self._last_full_validation = time.time()
+            return None
+
+        if FLAGS.haproxy.validation == 'scoped':
+            accepted, rejected = batch.bisect(
+                changes, lambda subset: check(subset, scoped=True))
+            if accepted and self._is_full_validation_due():
+                # safety net for what the scoped tests can not see
+                accepted, more = batch.bisect(accepted, check)
+                rejected.extend(more)
+        else:
+            accepted, rejected = batch.bisect(changes, check)
+        for change, error in rejected:
+            LOG.warn('Reject %s of %s: %s', change['cmd'], change['name'],
+                     error)
+            results[change['index']] = error
+        if not accepted:
+            return results
+
+        sections = self.config.apply(accepted)
+        operations = self._get_runtime_operations(accepted)
+        if operations is not None:
+            error = self._apply_at_runtime(operations, sections)
+            if error is None:
+                LOG.info("Applied %d changes at runtime", len(accepted))
+                return results
+            LOG.warn("Failed to apply changes at runtime, reload haproxy "
+                     "instead: %s", error)
+
+        error = self._commit(sections)
+        if error is not None:
+            for change in accepted:
+                results[change['index']] = error
+        else:
+            # the new haproxy starts with the free slots disabled
+            self._draining.clear()
+            LOG.info("Applied %d changes with one reload", len(accepted))
+        return results
+
+    def _get_runtime_operations(self, changes):
+        """Return the stats socket operations equivalent to `changes`.
+
+        :returns: list of (method, args), or None if some change needs
+                  a reload
+        """
+        if self.runtime is None:
+            return None
+        sections = dict(self.config.sections)
+        operations = []
+        for change in changes:
+            name = change['name']
+            if change['cmd'] != 'update_lb' or name not in sections:
+                return None
+            ops = self._get_server_operations(name, sections[name],
+                                              change['section'])
+            if ops is None:
+                return None
+            operations.extend(ops)
+            sections[name] = change['section']
+        return operations
+
+    def _get_server_operations(self, name, old, new):
+        old_lines, old_servers = _split_listen_cfg(old)
+        new_lines, new_servers = _split_listen_cfg(new)
+        if old_lines != new_lines:
+            return None
+
+        def layout(servers):
+            return [(s['slot'], s['port'], s['options']) for s in servers]
+
+        if layout(old_servers) != layout(new_servers):
+            return None
+
+        # established connections of removed servers may finish
+        removed_state = 'drain' if FLAGS.haproxy.drain_timeout else 'maint'
+        operations = []
+        for old_server, new_server in zip(old_servers, new_servers):
+            slot = new_server['slot']
+            if new_server['uuid'] is None:
+                if old_server['uuid'] is not None:
+                    operations.append((self.runtime.set_server_state,
+                                       (name, slot, removed_state)))
+            elif (old_server['uuid'] != new_server['uuid'] or
+                  old_server['address'] != new_server['address'] or
+                  old_server['disabled']):
+                operations.append((self.runtime.set_server_addr,
+                                   (name, slot, new_server['address'])))
+                operations.append((self.runtime.set_server_state,
+                                   (name, slot, 'ready')))
+        return operations
+
+    def _apply_at_runtime(self, operations, sections):
+        """Run `operations` on the stats socket, then save `sections`.
+
+        :returns: None, or the error which prevented it
+        """
         try:
-            new_cfg_path = self._create_lb_haproxy_cfg(msg)
-        except exception.HaproxyCreateCfgError as e:
-            raise exception.HaproxyCreateError(explanation=str(e))
+            for method, args in operations:
+                method(*args)
+                if method == self.runtime.set_server_state:
+                    name, slot, state = args
+                    if state == 'drain':
+                        self._draining[(name, slot)] = (
+                            time.time() + FLAGS.haproxy.drain_timeout)
+                    else:
+                        self._draining.pop((name, slot), None)
+        except exception.HaproxyRuntimeError as e:
+            return str(e)
+        # keep haproxy.cfg in sync for the next reload
+        return self._commit(sections, reload_haproxy=False)
+
+    def _finish_draining(self):
+        """Put the servers drained long enough in maintenance."""
+        now = time.time()
+        for key, deadline in self._draining.items():
+            if deadline > now:
+                continue
+            del self._draining[key]
+            name, slot = key
+            try:
+                self.runtime.set_server_state(name, slot, 'maint')
+            except exception.HaproxyRuntimeError as e:
+                # the slot is disabled anyway on the next reload
+                LOG.warn("Failed to put %s/%s in maintenance: %s",
+                         name, slot, e)
+
+    def _is_full_validation_due(self):
+        return (time.time() - self._last_full_validation >=
+                FLAGS.haproxy.full_validation_interval)
+
+    def _lint_haproxy_cfg(self, sections, changes):
+        """Catch errors haproxy -c does not see, without running it.
+
+        :returns: None, or the error of the first faulty change
+        """
+        ports = dict()
+        for name, section in sections.iteritems():
+            for port in _get_bind_ports(section):
+                ports.setdefault(port, []).append(name)
+        for change in changes:
+            if change['section'] is None:
+                continue
+            for port in _get_bind_ports(change['section']):
+                users = [name for name in ports.get(port, [])
+                         if name != change['name']]
+                if users:
+                    return ('Listen port %s of %s is used by %s' %
+                            (port, change['name'], ', '.join(users)))
+        return None
+
+    def _stage_scoped_config(self, changes):
+        """Write the global sections and `changes` only, to be tested.
+
+        :returns: list of paths to give haproxy with -f
+        """
+        scoped_cfg_path = '/etc/haproxy/haproxy.cfg.scoped'
+        sections = dict()
+        for change in changes:
+            if change['section'] is None:
+                sections.pop(change['name'], None)
+            else:
+                sections[change['name']] = change['section']
+        self.config.write(scoped_cfg_path, sections)
+        return [scoped_cfg_path]
+
+    def _stage_config(self, sections):
+        """Write `sections` aside, to be tested before the commit.
+
+        With config_dir, the stage dir holds the files of changed load
+        balancers, and links to the files of the unchanged ones. Those
+        of deleted load balancers are left out.
+
+        :returns: list of paths to give haproxy with -f
+        """
+        if not self.config_dir:
+            new_cfg_path = '/etc/haproxy/haproxy.cfg.new'
+            self.config.write(new_cfg_path, sections)
+            return [new_cfg_path]
+
+        header_path = self.config.path
+        if self.config.inline:
+            header_path = '/etc/haproxy/haproxy.cfg.new'
+            self.config.write_header(header_path)
+        stage_dir = '%s.new' % self.config_dir.rstrip('/')
+        if not os.path.exists(stage_dir):
+            os.makedirs(stage_dir)
+        for filename in os.listdir(stage_dir):
+            os.remove(os.path.join(stage_dir, filename))
+        updated = set(self.config.diff(sections)[0])
+        for name in sections:
+            staged_path = os.path.join(stage_dir, '%s.cfg' % name)
+            if name in updated:
+                self.config.write_section(staged_path, sections[name])
+            else:
+                os.symlink(self.config.section_path(name), staged_path)
+        return [header_path, stage_dir]
+
+    def _commit(self, sections, reload_haproxy=True):
+        """Make `sections` the running configuration.
+
+        :param reload_haproxy: False if haproxy already runs `sections`
+        :returns: None, or the error which prevented it
+        """
+        if self.config_dir:
+            return self._commit_config_dir(sections, reload_haproxy)
 
+        new_cfg_path = '/etc/haproxy/haproxy.cfg.new'
         try:
-            self._test_haproxy_config(new_cfg_path)
-        except exception.ProcessExecutionError as e:
-            raise exception.HaproxyCreateError(explanation=str(e))
+            self.config.write(new_cfg_path, sections)
+        except IOError as e:
+            LOG.error("Failed to write %s: %s" % (new_cfg_path, e))
+            return str(e)
 
         rc, backup_path = self._backup_original_cfg()
         if rc != 0:
-            raise exception.HaproxyCreateError(explanation=backup_path)
+            utils.delete_if_exists(new_cfg_path)
+            return backup_path
 
         rc, strerror = self._replace_original_cfg_with_new(new_cfg_path)
         if rc != 0:
-            raise exception.HaproxyCreateError(explanation=strerror)
+            utils.delete_if_exists(new_cfg_path)
+            return strerror
+
+        if reload_haproxy and self._reload_haproxy_cfg(backup_path) != 0:
+            return 'Failed to reload haproxy'
+
+        self.config.commit(sections)
+        return None
+
+    def _commit_config_dir(self, sections, reload_haproxy):
+        updated, removed = self.config.diff(sections)
+        cfg_paths = [self.config.section_path(name)
+                     for name in updated + removed]
+        if self.config.inline:
+            cfg_paths.append(self.config.path)
+        backups = dict()
+        try:
+            backups = self._backup_cfg_files(cfg_paths)
+            if self.config.inline:
+                self.config.write_header(self.config.path)
+            for name in updated:
+                self.config.write_section(self.config.section_path(name),
+                                          sections[name])
+            for name in removed:
+                if os.path.exists(self.config.section_path(name)):
+                    os.remove(self.config.section_path(name))
+        except (IOError, OSError) as e:
+            LOG.error("Failed to change %s: %s" % (self.config_dir, e))
+            self._restore_cfg(backups)
+            return str(e)
+
+        if reload_haproxy and self._reload_haproxy_cfg(backups) != 0:
+            return 'Failed to reload haproxy'
+
+        self.config.commit(sections)
+        return None
+
+    def _backup_cfg_files(self, cfg_paths):
+        """Copy the files `cfg_paths` to the backup dir.
+
+        :returns: dict of path to backup path, None for new files
+        """
+        now = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S-%f")
+        backups = dict()
+        for cfg_path in cfg_paths:
+            backups[cfg_path] = None
+            if os.path.exists(cfg_path):
+                backups[cfg_path] = os.path.join(
+                    self.cfg_backup_dir,
+                    '%s_%s' % (os.path.basename(cfg_path), now))
+                fileutils.backup(cfg_path, backups[cfg_path])
+        return backups
+
+    def _restore_cfg(self, backup):
+        """Put back the configuration saved in `backup`.
+
+        :param backup: backup path of haproxy.cfg, or with config_dir
+                       the dict returned by _backup_cfg_files()
+        :returns: True on success
+        """
+        if not self.config_dir:
+            backup = {'/etc/haproxy/haproxy.cfg': backup}
 
-        if self._reload_haproxy_cfg(backup_path) != 0:
-            e = 'Failed to reload haproxy'
-            raise exception.HaproxyCreateError(explanation=e)
+        try:
+            for cfg_path, backup_path in backup.iteritems():
+                if backup_path is not None:
+                    fileutils.copy_atomic(backup_path, cfg_path)
+                elif os.path.exists(cfg_path):
+                    os.remove(cfg_path)
+        except (IOError, OSError) as e:
+            LOG.error("Failed to restore the configuration: %s" % e)
+            return False
+        return True
 
-        LOG.debug("Created the new load balancer successfully")
+    @utils.synchronized('haproxy')
+    def do_bootstrap(self, requests):
+        """Rewrite haproxy.cfg to hold exactly `requests`, reload once.
 
-    def _delete_lb(self, msg):
-        LOG.debug("Deleting the haproxy load "
+        The load balancers which make the configuration invalid are
+        isolated by bisection and left out.
+
+        :returns: dict of uuid to error of the requests left out
+        """
+        try:
+            self.config.ensure_fresh()
+        except IOError as e:
+            LOG.error("Failed to read haproxy configuration: %s", e)
+            raise exception.HaproxyConfigureError(explanation=str(e))
+
+        failed = dict()
+        changes = []
+        for request in requests:
+            msg = request['args']
+            try:
+                self._validate_request(request)
+                name = self._get_lb_name(msg)
+                section = self._format_haproxy_listen_cfg(
+                    msg, self.config.sections.get(name))
+            except (exception.BadRequest,
+                    exception.HaproxyCreateError) as e:
+                LOG.warn('Skip %s on bootstrap: %s', msg.get('uuid'), e)
+                failed[msg.get('uuid')] = str(e)
+                continue
+            changes.append({'uuid': msg['uuid'],
+                            'cmd': request['cmd'],
+                            'name': name,
+                            'section': section})
+
+        def check(subset):
+            sections = dict((change['name'], change['section'])
+                            for change in subset)
+            error = self._lint_haproxy_cfg(sections, subset)
+            if error is not None:
+                return error
+            try:
+                self._test_haproxy_config(*self._stage_config(sections))
+            except (exception.ProcessExecutionError,
+                    IOError, OSError) as e:
+                return str(e)
+            return None
+
+        if changes:
+            accepted, rejected = batch.bisect(changes, check)
+        else:
+            # nothing left to serve, still test the global sections
+            error = check([])
+            if error is not None:
+                raise exception.HaproxyConfigureError(explanation=error)
+            accepted, rejected = [], []
+        for change, error in rejected:
+            LOG.warn('Skip %s on bootstrap: %s', change['uuid'], error)
+            failed[change['uuid']] = error
+        if changes and not accepted:
+            # keep what runs rather than serving nothing
+            return failed
+
+        sections = dict((change['name'], change['section'])
+                        for change in accepted)
+        error = self._commit(sections)
+        if error is not None:
+            raise exception.HaproxyConfigureError(explanation=error)
+        self._draining.clear()
+
+        LOG.info("Bootstrapped %d load balancers", len(sections))
+        return failed
+
+    def _create_lb(self, msg):
+        LOG.debug("Creating the haproxy load "
                   "balancer for NAME:%s USER: %s PROJECT:%s" %
                   (msg['uuid'], msg['user_id'], msg['tenant_id']))
-        try:
-            new_cfg_path = self._create_lb_deleted_haproxy_cfg(msg)
-        except exception.HaproxyLBNotExists as e:
-            LOG.warn('%s', e)
-            return
-            ##raise exception.HaproxyDeleteError(explanation=str(e))
 
-        try:
-            self._test_haproxy_config(new_cfg_path)
-        except exception.ProcessExecutionError as e:
-            raise exception.HaproxyDeleteError(explanation=str(e))
+        error = self._config_batch([{'cmd': 'create_lb', 'args': msg}])[0]
+        if error is not None:
+            raise exception.HaproxyCreateError(explanation=error)
 
-        rc, backup_path = self._backup_original_cfg()
-        if rc != 0:
-            raise exception.HaproxyDeleteError(explanation=backup_path)
+        LOG.debug("Created the new load balancer successfully")
 
-        rc, strerror = self._replace_original_cfg_with_new(new_cfg_path)
-        if rc != 0:
-            raise exception.HaproxyDeleteError(explanation=strerror)
+    def _delete_lb(self, msg):
+        LOG.debug("Deleting the haproxy load "
+                  "balancer for NAME:%s USER: %s PROJECT:%s" %
+                  (msg['uuid'], msg['user_id'], msg['tenant_id']))
 
-        if self._reload_haproxy_cfg(backup_path) != 0:
-            e = 'Failed to reload haproxy'
-            raise exception.HaproxyDeleteError(explanation=str(e))
+        error = self._config_batch([{'cmd': 'delete_lb', 'args': msg}])[0]
+        if error is not None:
+            raise exception.HaproxyDeleteError(explanation=error)
 
         LOG.debug("Deleted the new load balancer successfully")
 
@@ -149,34 +844,9 @@ class HaproxyConfigurer(object):
                   "balancer for NAME:%s USER: %s PROJECT:%s" %
                   (msg['uuid'], msg['user_id'], msg['tenant_id']))
 
-        try:
-            lb_deleted_cfg_path = self._create_lb_deleted_haproxy_cfg(msg)
-        except exception.HaproxyLBNotExists as e:
-            LOG.warn('%s', e)
-            raise exception.HaproxyUpdateError(explanation=str(e))
-
-        try:
-            new_cfg_path = self._create_lb_haproxy_cfg(
-                msg, base_cfg_path=lb_deleted_cfg_path)
-        except exception.HaproxyCreateCfgError as e:
-            raise exception.HaproxyUpdateError(explanation=str(e))
-
-        try:
-            self._test_haproxy_config(new_cfg_path)
-        except exception.ProcessExecutionError as e:
-            raise exception.HaproxyUpdateError(explanation=str(e))
-
-        rc, backup_path = self._backup_original_cfg()
-        if rc != 0:
-            raise exception.HaproxyUpdateError(explanation=backup_path)
-
-        rc, strerror = self._replace_original_cfg_with_new(new_cfg_path)
-        if rc != 0:
-            raise exception.HaproxyUpdateError(explanation=strerror)
-
-        if self._reload_haproxy_cfg(backup_path) != 0:
-            e = 'Failed to reload haproxy'
-            raise exception.HaproxyUpdateError(explanation=str(e))
+        error = self._config_batch([{'cmd': 'update_lb', 'args': msg}])[0]
+        if error is not None:
+            raise exception.HaproxyUpdateError(explanation=error)
 
         LOG.debug("Updated the new load balancer successfully")
 
@@ -188,82 +858,114 @@ class HaproxyConfigurer(object):
         ##return "%s_%s" % (msg['tenant_id'],
         return "%s" % msg['uuid']
 
+    def _create_haproxy_lb_server_options(self, msg):
+        options = ('check inter %sms rise %s fall %s' %
+                   (msg['health_check_interval_ms'],
+                    msg['health_check_healthy_threshold'],
+                    msg['health_check_unhealthy_threshold']))
+        if msg.get('max_fails'):
+            # mark a server down after as many failed connections in a
+            # row, without waiting for the health check to fail
+            options += (' observe layer4 error-limit %d on-error mark-down'
+                        % msg['max_fails'])
+        return options
+
     def _create_haproxy_lb_server_directive(self, msg):
         servers = []
 
-        _HAPROXY_LB_SERVER_FMT = ('\tserver %s %s:%s '
-                                  'check inter %sms rise %s fall %s')
+        _HAPROXY_LB_SERVER_FMT = '\tserver %s %s:%s %s'
 
+        options = self._create_haproxy_lb_server_options(msg)
         n = len(msg['instance_uuids'])
         for i in range(n):
             servers.append(_HAPROXY_LB_SERVER_FMT %
                            (msg['instance_uuids'][i],
                             msg['instance_ips'][i],
                             msg['instance_port'],
-                            msg['health_check_interval_ms'],
-                            msg['health_check_healthy_threshold'],
-                            msg['health_check_unhealthy_threshold']))
+                            options))
 
         return '\n'.join(servers)
 
+    def _create_haproxy_lb_policy_directives(self, msg):
+        """Render the timeouts and the retries of `msg`.
+
+        The settings left unset are not rendered, the defaults section
+        of haproxy.cfg applies.
+        """
+        directives = []
+        for key, name in (('connect_timeout_ms', 'connect'),
+                          ('client_timeout_ms', 'client'),
+                          ('server_timeout_ms', 'server')):
+            if msg.get(key) is not None:
+                directives.append('\ttimeout %s %dms\n' % (name, msg[key]))
+        if msg.get('retries') is not None:
+            directives.append('\tretries %d\n' % msg['retries'])
+        if msg.get('redispatch'):
+            directives.append('\toption redispatch\n')
+        return ''.join(directives)
+
+    def _create_haproxy_lb_slot_directives(self, msg, current=None):
+        """Lay the instances of `msg` out on server_slots server lines.
+
+        Instances keep the slot they have in the `current` section, so
+        that membership changes only touch the slots which changed.
+        """
+        n = len(msg['instance_uuids'])
+        slots = ['slot%d' % i for i in xrange(max(n,
+                                                  FLAGS.haproxy.server_slots))]
+        current_slots = dict((server['uuid'], server['slot'])
+                             for server in _split_listen_cfg(current)[1]
+                             if server['uuid'] is not None)
+
+        assigned = dict()
+        for i, uuid in enumerate(msg['instance_uuids']):
+            if current_slots.get(uuid) in slots:
+                assigned[current_slots[uuid]] = i
+        free = [slot for slot in slots if slot not in assigned]
+        placed = set(assigned.values())
+        for i in xrange(n):
+            if i not in placed:
+                assigned[free.pop(0)] = i
+
+        options = self._create_haproxy_lb_server_options(msg)
+        servers = []
+        for slot in slots:
+            if slot in assigned:
+                i = assigned[slot]
+                servers.append('\tserver %s %s:%s %s # %s' %
+                               (slot, msg['instance_ips'][i],
+                                msg['instance_port'], options,
+                                msg['instance_uuids'][i]))
+            else:
+                servers.append('\tserver %s 0.0.0.0:%s %s disabled' %
+                               (slot, msg['instance_port'], options))
+        return '\n'.join(servers)
+
     def _backup_original_cfg(self):
         now = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S-%f")
         backup_filename = 'haproxy.cfg_' + now
 
         backup_path = os.path.join(self.cfg_backup_dir, backup_filename)
-        cmd = "cp /etc/haproxy/haproxy.cfg %s" % backup_path
-
         try:
-            utils.execute(cmd)
-        except exception.ProcessExecutionError as e:
+            fileutils.backup('/etc/haproxy/haproxy.cfg', backup_path)
+        except (IOError, OSError) as e:
             LOG.error("Failed to make a backup configuration")
             return -1, str(e)
 
         return 0, backup_path
 
     def _replace_original_cfg_with_new(self, new_cfg_path):
-        cmd = "cp %s /etc/haproxy/haproxy.cfg" % new_cfg_path
         try:
-            utils.execute(cmd)
-        except exception.ProcessExecutionError as e:
+            fileutils.rename(new_cfg_path, '/etc/haproxy/haproxy.cfg')
+        except OSError as e:
             LOG.error("Failed to replace the orignal configuration")
             return -1, str(e)
 
         return 0, None
 
-    def _create_lb_haproxy_cfg(self, msg,
-                               base_cfg_path='/etc/haproxy/haproxy.cfg'):
-        try:
-            haproxy_new_proxy_cfg = self._create_haproxy_listen_cfg(
-                msg, base_cfg_path)
-        except exception.HaproxyLBExists as e:
-            LOG.warn('%s', e)
-            raise exception.HaproxyCreateCfgError(explanation=str(e))
-
-        new_cfg_path = '/etc/haproxy/haproxy.cfg.new'
-        cmd = 'cp %s %s' % (base_cfg_path, new_cfg_path)
-        try:
-            utils.execute(cmd)
-        except exception.ProcessExecutionError as e:
-            LOG.error("Failed to copy original configuration: %s", e)
-            raise exception.HaproxyCreateCfgError(explanation=str(e))
-
-        try:
-            with open(new_cfg_path, 'a') as cfile:
-                cfile.write(haproxy_new_proxy_cfg)
-        except IOError as e:
-            LOG.error("Failed to open %s: %s" % (new_cfg_path, e))
-            raise exception.HaproxyCreateCfgError(explanation=str(e))
-
-        return new_cfg_path
-
-    def _create_haproxy_listen_cfg(self, msg,
-                                   base_cfg_path='/etc/haproxy/haproxy.cfg'):
+    def _format_haproxy_listen_cfg(self, msg, current=None):
         lb_name = self._get_lb_name(msg)
 
-        if self._is_lb_in_use(lb_name, base_cfg_path):
-            raise exception.HaproxyLBExists(name=lb_name)
-
         listen_port = int(msg['listen_port'])
         listen_port_min = self.listen_port_min
         listen_port_max = self.listen_port_max
@@ -280,19 +982,25 @@ class HaproxyConfigurer(object):
 
         LOG.info("selft._bind_ip = %s" % self._bind_ip)
 
-        server_directives = self._create_haproxy_lb_server_directive(msg)
+        if self.runtime is None:
+            server_directives = self._create_haproxy_lb_server_directive(msg)
+        else:
+            server_directives = self._create_haproxy_lb_slot_directives(
+                msg, current)
 
         bind_directive = ','.join(map(lambda ip: "%s:%s" % (ip, listen_port),
                                       self._bind_ip))
 
         _HAPROXY_LB_FMT = ('\nlisten\t%s\n\tmode tcp\n\tbind %s\n\t'
-                           'balance %s\n\ttimeout check %sms\n%s')
+                           'balance %s\n\ttimeout check %sms\n%s%s')
 
-        config = _HAPROXY_LB_FMT % (lb_name,
-                                    bind_directive,
-                                    balancing_method,
-                                    msg['health_check_timeout_ms'],
-                                    server_directives)
+        config = _HAPROXY_LB_FMT % (
+            lb_name,
+            bind_directive,
+            balancing_method,
+            msg['health_check_timeout_ms'],
+            self._create_haproxy_lb_policy_directives(msg),
+            server_directives)
 
         LOG.debug("""Created new haproxy listen configuration:
                   =====================================
@@ -302,50 +1010,6 @@ class HaproxyConfigurer(object):
 
         return config
 
-    def _create_lb_deleted_haproxy_cfg(self, msg):
-        lb_name = self._get_lb_name(msg)
-
-        # TODO(wenjianhn): handle exception
-        if not self._is_lb_in_use(lb_name):
-            raise exception.HaproxyLBNotExists(name=lb_name)
-
-        config = self._format_haproxy_config()
-
-        cfg_body = config['body']
-        self._del_one_lb_info(cfg_body, lb_name)
-
-        body_lines = []
-        for k, v in cfg_body.iteritems():
-            body_lines.append("%s%s" % (k, ''.join(v)))
-
-        new_config = "%s%s" % (''.join(config['header']),
-                               '\n'.join(body_lines))
-
-        new_cfg_path = '/etc/haproxy/haproxy.cfg.new.lb_deleted'
-        try:
-            with open(new_cfg_path, 'w') as cfile:
-                cfile.write(new_config)
-        except IOError as e:
-            LOG.error("Failed to open %s: %s" % (new_cfg_path, e))
-            raise exception.HaproxyCreateCfgError(explanation=str(e))
-
-        return new_cfg_path
-
-    def _is_lb_in_use(self, lb_name,
-                      base_cfg_path='/etc/haproxy/haproxy.cfg'):
-        with open(base_cfg_path) as cfg:
-            lines = cfg.readlines()
-
-        try:
-            in_use_lb_name = [line.split()[1] for line in lines
-                              if line.startswith('listen')]
-        except IndexError:
-            LOG.error("No item was found after listen directive,"
-                      "is the haproxy configuraion file valid?")
-            raise
-
-        return lb_name in in_use_lb_name
-
     def _get_haproxy_pid(self):
         try:
             with open('/var/run/haproxy.pid') as pidfile:
@@ -358,102 +1022,80 @@ class HaproxyConfigurer(object):
             raise
         return pid
 
-    def _test_haproxy_config(self, cfile_path):
+    def _test_haproxy_config(self, *cfile_paths):
         LOG.info('Testing the new haproxy configuration file')
-        cmd = "haproxy -c -f %s" % cfile_path
+        cmd = "haproxy -c %s" % ' '.join('-f %s' % path
+                                         for path in cfile_paths)
 
         try:
-            utils.execute(cmd)
+            utils.execute(cmd, timeout=FLAGS.haproxy.validation_timeout)
         except exception.ProcessExecutionError as e:
             LOG.warn('Did not pass the new haproxy configuration test: %s', e)
             raise
 
+    def _get_reload_cmd(self, pid):
+        cfg_args = "-f /etc/haproxy/haproxy.cfg"
+        if self.config_dir:
+            cfg_args += " -f %s" % self.config_dir
+        fd_args = ""
+        if FLAGS.haproxy.reload_mode == 'seamless':
+            # the new process takes over the listening sockets of `pid`
+            # so they are never closed, instead of binding them again.
+            fd_args = "-x %s " % FLAGS.haproxy.stats_socket
+        return ("haproxy %s -p /var/run/haproxy.pid %s-sf %s " %
+                (cfg_args, fd_args, pid))
+
+    def _load_haproxy_cfg(self, pid):
+        """Make haproxy `pid` load the configuration files.
+
+        :raises: ProcessExecutionError
+        """
+        if FLAGS.haproxy.reload_mode != 'master':
+            utils.execute(self._get_reload_cmd(pid))
+            return
+
+        # the master keeps the listeners and starts new workers, which
+        # read the files it was started with.
+        try:
+            os.kill(pid, signal.SIGUSR2)
+        except OSError as e:
+            raise exception.ProcessExecutionError(
+                exit_code=e.errno, output=e.strerror,
+                cmd='kill -USR2 %s' % pid)
+
     def _reload_haproxy_cfg(self, backup_path):
+        """Reload haproxy, restore `backup_path` if it fails.
+
+        :returns: 0 once haproxy runs the new configuration, -1 otherwise
+        """
         LOG.debug("Reloading haproxy")
         try:
             pid = self._get_haproxy_pid()
-        except IOError:
-            return -1
-        except ValueError:
+        except (IOError, ValueError) as e:
+            LOG.error("Failed to read the pid of haproxy: %s", e)
+            # the new configuration must not wait for the next start
+            if not self._restore_cfg(backup_path):
+                LOG.error('Failed to rollback the configuration')
             return -1
 
-        cmd = ("haproxy -f /etc/haproxy/haproxy.cfg -p "
-               "/var/run/haproxy.pid -sf %s " % pid)
-
         try:
-            utils.execute(cmd)
+            self._load_haproxy_cfg(pid)
         except exception.ProcessExecutionError as e:
             LOG.error("Failed to reload haproxy(pid=%s): %s", pid, e)
 
             LOG.debug('Try to rollback the configuration')
-            cmd = "cp %s /etc/haproxy/haproxy.cfg" % backup_path
-            try:
-                utils.execute(cmd)
-            except exception.ProcessExecutionError as e:
+            if not self._restore_cfg(backup_path):
                 LOG.error('Failed to rollback the configuration')
                 return -1
 
             LOG.debug('Try to load the original configration')
-            cmd = ("haproxy -f /etc/haproxy/haproxy.cfg -p "
-                   "/var/run/haproxy.pid -sf %s " % pid)
             try:
-                utils.execute(cmd)
+                self._load_haproxy_cfg(pid)
             except exception.ProcessExecutionError as e:
                 LOG.error('Failed to load original configuration')
-                return -1
+            # haproxy runs the original configuration at best, the
+            # changes were not applied.
+            return -1
 
         LOG.debug("Reloaded haproxy successfully")
         return 0
-
-    def _format_haproxy_config(self):
-        # TODO(wenjianhn): handle exception
-        with open("/etc/haproxy/haproxy.cfg") as cfg_file:
-            line_all = cfg_file.readlines()
-
-        cfg_file_buff = {}
-        cfg_header = []         # global, defaults
-        cfg_body = {}           # listen
-
-        line_total = len(line_all)
-
-        index = 0
-        for i in range(0, line_total):
-            if line_all[i].startswith('listen'):
-                index = i
-                break
-            cfg_header.append(line_all[i])
-
-        while True:
-            key = line_all[index]
-            index, cfg_body[key] = self._get_one_lb_info(line_all,
-                                                         index + 1,
-                                                         line_total)
-            if index == line_total - 1:
-                break
-
-        cfg_file_buff['header'] = cfg_header
-        cfg_file_buff['body'] = cfg_body
-
-        return cfg_file_buff
-
-    def _get_one_lb_info(self, line_all, line_index, line_total):
-        value = []
-
-        for i in range(line_index, line_total):
-            line = line_all[i]
-
-            if line.startswith('\t'):
-                value.append(line)
-            elif line.startswith('listen'):
-                return i, value
-
-        return line_total - 1, value
-
-    def _del_one_lb_info(self, cfg_body, lb_name):
-        del_key = None
-        for key in cfg_body:
-            if key.startswith('listen'):
-                if key.split()[1] == lb_name:
-                    del_key = key
-                    break
-        del cfg_body[key]
@@ -1,4 +1,7 @@
+import hashlib
 import os
+import re
+import time
 
 from nozzle.openstack.common import cfg
 from nozzle.openstack.common import log as logging
@@ -7,6 +10,8 @@ from nozzle.common import flags
 from nozzle.common import exception
 from nozzle.common import validate
 from nozzle.common import utils
+from nozzle.worker import batch
+from nozzle.worker import fileutils
 
 nginx_opts = [
     cfg.ListOpt('listen',
@@ -18,6 +23,44 @@ nginx_opts = [
     cfg.StrOpt('configuration_backup_dir',
                default='/var/lib/nozzle/backup/nginx',
                help="Where to backup nginx configuration."),
+    cfg.StrOpt('main_config',
+               default='/etc/nginx/nginx.conf',
+               help="Main nginx configuration, including sites-enabled."),
+    cfg.StrOpt('validation',
+               default='full',
+               help="'full' tests the whole configuration for every batch, "
+                    "'scoped' only tests the changed load balancers with "
+                    "the main configuration, and the whole configuration "
+                    "every full_validation_interval seconds"),
+    cfg.IntOpt('full_validation_interval',
+               default=300,
+               help="Seconds between two tests of the whole configuration "
+                    "in scoped validation"),
+    cfg.IntOpt('validation_timeout',
+               default=60,
+               help="Seconds after which a configuration test is killed "
+                    "and the changes tested rejected"),
+    cfg.StrOpt('hash_sizes_config',
+               default='',
+               help="File sizing the server_names and map hash tables "
+                    "for the names bound, e.g. "
+                    "/etc/nginx/conf.d/nozzle-hash.conf. It must be "
+                    "included by this path at the http level and the main "
+                    "configuration must not set them. Empty leaves them to "
+                    "nginx.conf"),
+    cfg.StrOpt('render_mode',
+               default='server',
+               help="'server' renders a server and an upstream block per "
+                    "load balancer. 'map' renders an upstream per load "
+                    "balancer, a single server block routes the hosts to "
+                    "them with a map, which nginx loads much faster with "
+                    "many load balancers"),
+    cfg.BoolOpt('upstream_keepalive_limits',
+                default=False,
+                help="Render keepalive_timeout and keepalive_requests in "
+                     "the upstreams keeping connections alive, which needs "
+                     "nginx 1.15.3 or later. Older versions keep the "
+                     "connections until the backends close them"),
 ]
 
 FLAGS = flags.FLAGS
@@ -25,16 +68,31 @@ FLAGS.register_opts(nginx_opts, 'nginx')
 
 LOG = logging.getLogger(__name__)
 
+_SERVER_NAME_RE = re.compile(r'^[a-zA-Z0-9.\-]+$')
+
 _NGX_UPSTREAM_FMT = '''
 upstream %(upstream_name)s {
 \t%(balancing_method)s ip_hash;
-\t%(servers)s
+\t%(servers)s%(keepalive)s
 }
 '''
 
+_NGX_UPSTREAM_KEEPALIVE_FMT = '''
+\tkeepalive %(connections)d;'''
+
+# upstream directives of nginx 1.15.3 and later
+_NGX_UPSTREAM_KEEPALIVE_LIMITS_FMT = '''
+\tkeepalive_timeout %(timeout_ms)dms;
+\tkeepalive_requests %(requests)d;'''
+
+# HTTP/1.0 closes the connections to the backends after each request
+_NGX_KEEPALIVE_HEADERS = '''
+              proxy_http_version 1.1;
+              proxy_set_header Connection "";'''
+
 _NGX_UPSTREAM_SERVER_FMT = ("\tserver %(ip)s:%(port)s "
                             "max_fails=%(max_fails)s "
-                            "fail_timeout=%(fail_timeout)ss;")
+                            "fail_timeout=%(fail_timeout)s;")
 
 _NGX_SERVER_FMT = '''
 server {
@@ -43,20 +101,133 @@ server {
        server_name_in_redirect  off;
        server_name %(server_name)s;
 
+       proxy_connect_timeout %(connect_timeout)s;
+       proxy_read_timeout    %(server_timeout)s;
+       proxy_send_timeout    %(server_timeout)s;\
+%(policy)s
+
+       location / {
+              proxy_set_header Host $host;
+              proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;\
+%(keepalive_headers)s
+              proxy_pass http://%(proxy_pass)s;
+       }
+
+       access_log %(log_path)s sws_proxy_log_fmt;
+}
+'''
+
+
+_NGX_CLIENT_TIMEOUT_FMT = '''
+       client_body_timeout   %(timeout)s;
+       send_timeout          %(timeout)s;'''
+
+_NGX_NEXT_UPSTREAM_FMT = '''
+       proxy_next_upstream   %s;'''
+
+_NGX_NEXT_UPSTREAM_TRIES_FMT = '''
+       proxy_next_upstream_tries %d;'''
+
+# settings of a load balancer rendered in its server block
+_NGX_PROXY_POLICY_KEYS = ['connect_timeout_ms', 'client_timeout_ms',
+                          'server_timeout_ms', 'retries', 'next_upstream']
+
+# used for the settings a load balancer leaves unset
+_NGX_DEFAULT_CONNECT_TIMEOUT = '4'
+_NGX_DEFAULT_SERVER_TIMEOUT = '300'
+_NGX_DEFAULT_MAX_FAILS = 3
+_NGX_DEFAULT_FAIL_TIMEOUT = '10s'
+
+
+# routes the host names of all load balancers in map render mode
+_NGX_MAP_PATH = '/etc/nginx/sites-enabled/nozzle-map.conf'
+
+_NGX_MAP_FMT = '''
+map $host $nozzle_upstream {
+\tdefault "";
+%(hosts)s
+}
+%(connection_map)s
+server {
+%(listen)s
+
+       server_name_in_redirect  off;
+       server_name _;
+
        proxy_connect_timeout 4;
        proxy_read_timeout    300;
        proxy_send_timeout    300;
 
        location / {
+              if ($nozzle_upstream = "") {
+                     return 404;
+              }
               proxy_set_header Host $host;
-              proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
-              proxy_pass http://%(proxy_pass)s;
+              proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;\
+%(keepalive_headers)s
+              proxy_pass http://$nozzle_upstream;
        }
 
-       access_log %(log_path)s sws_proxy_log_fmt;
+       access_log %(log_dir)s/$nozzle_upstream sws_proxy_log_fmt;
 }
 '''
 
+# keeps alive the connections to the upstreams which allow it only
+_NGX_MAP_CONNECTION_FMT = '''
+map $nozzle_upstream $nozzle_connection {
+\tdefault close;
+%(upstreams)s
+}
+'''
+
+_NGX_MAP_KEEPALIVE_HEADERS = '''
+              proxy_http_version 1.1;
+              proxy_set_header Connection $nozzle_connection;'''
+
+# first line of the configuration files in map render mode, followed
+# by _NGX_MAP_KEEPALIVE when the upstream keeps connections alive
+_NGX_MAP_HEADER = '# server_name'
+_NGX_MAP_KEEPALIVE = '# keepalive'
+
+_NGX_HASH_FMT = '''server_names_hash_max_size %(max_size)d;
+server_names_hash_bucket_size %(bucket_size)d;
+map_hash_max_size %(max_size)d;
+map_hash_bucket_size %(bucket_size)d;
+'''
+
+
+def _next_power_of_two(value):
+    result = 1
+    while result < value:
+        result *= 2
+    return result
+
+
+def _hash_sizes(count, longest):
+    """Return (max_size, bucket_size) for `count` names of `longest` chars.
+
+    A bucket holds at least a name with its pointer and length, plus the
+    pointer ending the bucket. Twice as many buckets as names keeps nginx
+    from searching long for a size without collisions.
+    """
+    entry = (8 + 2 + longest + 7) // 8 * 8
+    bucket_size = max(64, _next_power_of_two(entry + 8))
+    max_size = max(512, 2 * _next_power_of_two(count))
+    return max_size, bucket_size
+
+
+def _ngx_time(value_ms, default):
+    """Render a time in ms of a load balancer, `default` when unset."""
+    if value_ms is None:
+        return default
+    return '%dms' % value_ms
+
+
+def _digest(ngx_cfg):
+    if isinstance(ngx_cfg, unicode):
+        ngx_cfg = ngx_cfg.encode('utf-8')
+    return hashlib.md5(ngx_cfg).hexdigest()
+
 
 class NginxProxyConfigurer(object):
     """
@@ -77,8 +248,18 @@ class NginxProxyConfigurer(object):
         _listen_field = map(lambda x: ("\tlisten %s;" % str(x)),
                             ip_port_list)
         self.listen_field = '\n'.join(_listen_field)
+        # the shared server block takes the requests of all hosts
+        self.map_listen_field = '\n'.join(
+            "\tlisten %s default_server;" % str(x) for x in ip_port_list)
 
         self.backup_dir = FLAGS.nginx.configuration_backup_dir
+        # digests of the enabled configuration files, by file name
+        self._digests = dict()
+        self.stats = {'changes': 0, 'skipped': 0}
+        self._last_full_validation = 0
+        # server names of the enabled files, by file name, with the
+        # stat of the file they were read from
+        self._server_names = dict()
         self.access_log_dir = FLAGS.nginx.access_log_dir
         if not os.path.exists(self.access_log_dir):
             raise exception.DirNotFound(dir=self.access_log_dir)
@@ -112,6 +293,376 @@ class NginxProxyConfigurer(object):
             except exception.NginxUpdateProxyError as e:
                 raise exception.NginxConfigureError(explanation=str(e))
 
+    @utils.synchronized('nginx')
+    def do_config_batch(self, requests):
+        """Apply `requests` with a single configuration test and reload.
+
+        Changes which make the configuration invalid are isolated by
+        bisection and left out, the others are committed together.
+
+        :returns: list holding None or the error of each request
+        """
+        results = [None] * len(requests)
+        changes = []
+        for index, request in enumerate(requests):
+            try:
+                self._validate_request(request)
+            except exception.BadRequest as e:
+                LOG.warn('Bad request: %s' % e)
+                results[index] = str(e)
+                continue
+            self.stats['changes'] += 1
+            if self._is_noop(request['cmd'], request['args']):
+                # e.g. a re-broadcast, nothing to test nor reload
+                LOG.debug('Skip %s of %s, no change', request['cmd'],
+                          request['args']['uuid'])
+                self.stats['skipped'] += 1
+                continue
+            changes.append({'index': index,
+                            'cmd': request['cmd'],
+                            'msg': request['args']})
+        if not changes:
+            return results
+
+        def check(subset):
+            error = self._lint_changes(subset)
+            if error is not None:
+                return error
+            try:
+                self._test_changes(subset)
+            except (exception.NginxConfFileExists,
+                    exception.ProcessExecutionError,
+                    IOError, OSError) as e:
+                return str(e)
+            self._last_full_validation = time.time()
+            return None
+
+        def check_scoped(subset):
+            error = self._lint_changes(subset)
+            if error is not None:
+                return error
+            try:
+                self._test_scoped_http_ngx_cfg(subset)
+            except (exception.ProcessExecutionError,
+                    IOError, OSError) as e:
+                return str(e)
+            return None
+
+        if FLAGS.nginx.validation == 'scoped':
+            accepted, rejected = batch.bisect(changes, check_scoped)
+            if accepted and self._is_full_validation_due():
+                # safety net for what the scoped tests can not see
+                accepted, more = batch.bisect(accepted, check)
+                rejected.extend(more)
+        else:
+            accepted, rejected = batch.bisect(changes, check)
+        for change, error in rejected:
+            LOG.warn('Reject %s of %s: %s', change['cmd'],
+                     change['msg']['uuid'], error)
+            results[change['index']] = error
+        if not accepted:
+            return results
+
+        try:
+            self._commit_changes(accepted)
+        except (exception.NginxConfFileExists,
+                exception.ProcessExecutionError,
+                IOError, OSError) as e:
+            for change in accepted:
+                results[change['index']] = str(e)
+        else:
+            LOG.info("Applied %d changes with one reload", len(accepted))
+        return results
+
+    def _test_changes(self, changes):
+        """Test the configuration with `changes`, leaving it as is.
+
+        The changed sites are tested staged beside the enabled ones.
+        When the main configuration can not be tested with other sites,
+        `changes` are applied, tested and restored.
+        """
+        if self._test_staged_http_ngx_cfg(changes):
+            return
+        saved = []
+        try:
+            for change in changes:
+                saved.append(self._save_http_ngx_cfg(change['msg']))
+                self._apply_change(change)
+            self._test_http_ngx_cfg()
+        finally:
+            for item in reversed(saved):
+                self._restore_http_ngx_cfg(item)
+            if saved:
+                # written for the changed sites by the test
+                self._write_managed_ngx_cfg()
+
+    def _commit_changes(self, changes):
+        """Apply tested `changes` and reload.
+
+        Each file is written beside the enabled one and renamed over it.
+        The files are restored if any of it fails.
+        """
+        saved = []
+        try:
+            for change in changes:
+                saved.append(self._save_http_ngx_cfg(change['msg']))
+                self._apply_change(change, commit=True)
+            self._reload_http_ngx_cfg()
+        except:
+            for item in reversed(saved):
+                self._restore_http_ngx_cfg(item)
+            raise
+
+    def _apply_change(self, change, commit=False):
+        msg = change['msg']
+        if change['cmd'] == 'create_lb':
+            cfile_path = os.path.join('/etc/nginx/sites-available/',
+                                      self._conf_file_name(msg))
+            if os.path.exists(cfile_path):
+                raise exception.NginxConfFileExists(path=cfile_path)
+            self._write_http_ngx_cfg(msg)
+        elif change['cmd'] == 'update_lb':
+            self._write_http_ngx_cfg(msg)
+        elif change['cmd'] == 'delete_lb':
+            if commit:
+                self._delete_http_ngx_cfg(msg)
+            else:
+                confname = self._conf_file_name(msg)
+                utils.delete_if_exists(
+                    os.path.join('/etc/nginx/sites-enabled/', confname))
+                utils.delete_if_exists(
+                    os.path.join('/etc/nginx/sites-available/', confname))
+
+    def _is_full_validation_due(self):
+        return (time.time() - self._last_full_validation >=
+                FLAGS.nginx.full_validation_interval)
+
+    def _lint_changes(self, changes):
+        """Catch common errors without running nginx.
+
+        :returns: None, or the error of the first faulty change
+        """
+        created = set()
+        for change in changes:
+            msg = change['msg']
+            if change['cmd'] == 'delete_lb':
+                created.discard(msg['uuid'])
+                continue
+            if change['cmd'] == 'create_lb':
+                cfile_path = os.path.join('/etc/nginx/sites-available/',
+                                          self._conf_file_name(msg))
+                if msg['uuid'] in created or os.path.exists(cfile_path):
+                    return str(exception.NginxConfFileExists(
+                        path=cfile_path))
+                created.add(msg['uuid'])
+            # dns_names are not checked with the request
+            for server_name in msg['dns_names'] + msg['http_server_names']:
+                if not _SERVER_NAME_RE.match(server_name):
+                    return 'Invalid server_name: %s' % server_name
+        return None
+
+    def _test_scoped_http_ngx_cfg(self, changes):
+        """Test the main configuration with `changes` as only sites."""
+        scoped_dir = '/etc/nginx/sites-scoped/'
+        self._clear_sites_dir(scoped_dir)
+        for change in changes:
+            confname = self._conf_file_name(change['msg'])
+            cfile_path = os.path.join(scoped_dir, confname)
+            if change['cmd'] == 'delete_lb':
+                utils.delete_if_exists(cfile_path)
+            else:
+                fileutils.write_atomic(
+                    cfile_path,
+                    self._create_http_ngx_cfg_buffer(change['msg']))
+
+        if not self._test_main_ngx_cfg(scoped_dir, 'scoped'):
+            self._test_http_ngx_cfg()
+
+    def _stage_sites(self, changes):
+        """Lay out the enabled sites with `changes` applied.
+
+        The sites of `changes` are written to the staged dir, the
+        deleted ones left out, and the other enabled sites linked.
+
+        :returns: the staged dir
+        """
+        enabled_dir = '/etc/nginx/sites-enabled/'
+        staged_dir = '/etc/nginx/sites-staged/'
+        self._clear_sites_dir(staged_dir)
+        staged = dict()
+        for change in changes:
+            staged[self._conf_file_name(change['msg'])] = change
+        skipped = set(staged)
+        if FLAGS.nginx.render_mode == 'map':
+            # rendered for the staged sites
+            skipped.add(os.path.basename(_NGX_MAP_PATH))
+        for name in os.listdir(enabled_dir):
+            # skip the temporary files of fileutils
+            if name in skipped or name.startswith('.'):
+                continue
+            os.symlink(os.path.realpath(os.path.join(enabled_dir, name)),
+                       os.path.join(staged_dir, name))
+        for confname, change in staged.iteritems():
+            if change['cmd'] != 'delete_lb':
+                fileutils.write_atomic(
+                    os.path.join(staged_dir, confname),
+                    self._create_http_ngx_cfg_buffer(change['msg']))
+        self._write_managed_ngx_cfg(staged_dir, self._staged_hash_path())
+        return staged_dir
+
+    def _staged_hash_path(self):
+        if not FLAGS.nginx.hash_sizes_config:
+            return None
+        return '%s.staged' % FLAGS.nginx.hash_sizes_config
+
+    def _test_staged_http_ngx_cfg(self, changes):
+        """Test the enabled sites with `changes` applied, in a staged dir.
+
+        :returns: False if the main configuration can not be tested with
+                  other sites, nothing was tested then
+        """
+        return self._test_main_ngx_cfg(self._stage_sites(changes), 'staged',
+                                       self._staged_hash_path())
+
+    def _clear_sites_dir(self, sites_dir):
+        if not os.path.exists(sites_dir):
+            os.makedirs(sites_dir)
+        for confname in os.listdir(sites_dir):
+            os.remove(os.path.join(sites_dir, confname))
+
+    def _test_main_ngx_cfg(self, sites_dir, suffix, hash_path=None):
+        """Test the main configuration including `sites_dir`.
+
+        :param hash_path: hash sizes file included instead of
+                          hash_sizes_config
+        :returns: False if the main configuration does not include
+                  /etc/nginx/sites-enabled/, or hash_sizes_config when
+                  `hash_path` is given, nothing was tested then
+        """
+        with open(FLAGS.nginx.main_config) as main_file:
+            main_cfg = main_file.read()
+        includes = {'/etc/nginx/sites-enabled/': sites_dir}
+        if hash_path:
+            includes[FLAGS.nginx.hash_sizes_config] = hash_path
+        for path in includes:
+            if path not in main_cfg:
+                LOG.warn('%s does not include %s, test the whole '
+                         'configuration', FLAGS.nginx.main_config, path)
+                return False
+            main_cfg = main_cfg.replace(path, includes[path])
+        # next to the main configuration for relative includes
+        test_cfg_path = '%s.%s' % (FLAGS.nginx.main_config, suffix)
+        fileutils.write_atomic(test_cfg_path, main_cfg)
+
+        LOG.debug('Testing the changed nginx configuration')
+        try:
+            utils.execute('nginx -t -c %s' % test_cfg_path,
+                          timeout=FLAGS.nginx.validation_timeout)
+        except exception.ProcessExecutionError as e:
+            LOG.warn('Did not pass the new nginx configuration test: %s', e)
+            raise
+        return True
+
+    def _is_noop(self, cmd, msg):
+        """Whether applying `cmd` would leave the files of `msg` as is."""
+        confname = self._conf_file_name(msg)
+        cfile_path = os.path.join('/etc/nginx/sites-available/', confname)
+        symbol_path = os.path.join('/etc/nginx/sites-enabled/', confname)
+        if cmd == 'delete_lb':
+            return not (os.path.lexists(symbol_path) or
+                        os.path.exists(cfile_path))
+        if not os.path.lexists(symbol_path):
+            return False
+        if confname not in self._digests:
+            try:
+                with open(cfile_path) as cfile:
+                    self._digests[confname] = _digest(cfile.read())
+            except IOError:
+                return False
+        ngx_cfg = self._create_http_ngx_cfg_buffer(msg)
+        return self._digests[confname] == _digest(ngx_cfg)
+
+    def _save_http_ngx_cfg(self, msg):
+        """Return what is needed to restore the files of `msg`."""
+        confname = self._conf_file_name(msg)
+        cfile_path = os.path.join('/etc/nginx/sites-available/', confname)
+        content = None
+        if os.path.exists(cfile_path):
+            with open(cfile_path) as cfile:
+                content = cfile.read()
+        symbol_path = os.path.join('/etc/nginx/sites-enabled/', confname)
+        return (cfile_path, content, symbol_path,
+                os.path.lexists(symbol_path))
+
+    def _restore_http_ngx_cfg(self, saved):
+        cfile_path, content, symbol_path, linked = saved
+        self._digests.pop(os.path.basename(cfile_path), None)
+        if content is None:
+            utils.delete_if_exists(cfile_path)
+        else:
+            fileutils.write_atomic(cfile_path, content)
+        if not linked:
+            utils.delete_if_exists(symbol_path)
+        elif not os.path.lexists(symbol_path):
+            fileutils.symlink_atomic(cfile_path, symbol_path)
+
+    @utils.synchronized('nginx')
+    def do_bootstrap(self, requests):
+        """Write the configuration of all `requests` and reload once.
+
+        Load balancers enabled here but missing from `requests` were
+        deleted meanwhile, and are removed. The result is tested staged
+        before any enabled file is touched, the load balancers which make
+        it invalid are isolated by bisection and left out.
+
+        :returns: dict of uuid to error of the requests left out
+        """
+        failed = dict()
+        wanted = set()
+        changes = []
+        for request in requests:
+            msg = request['args']
+            try:
+                self._validate_request(request)
+            except exception.BadRequest as e:
+                LOG.warn('Skip %s on bootstrap: %s', msg.get('uuid'), e)
+                failed[msg.get('uuid')] = str(e)
+                continue
+            changes.append({'cmd': 'update_lb', 'msg': msg})
+            wanted.add(self._conf_file_name(msg))
+
+        for confname in os.listdir('/etc/nginx/sites-enabled/'):
+            if confname in wanted or not validate._is_uuid_like(confname):
+                continue
+            changes.append({'cmd': 'delete_lb', 'msg': {'uuid': confname}})
+
+        def check(subset):
+            error = self._lint_changes(subset)
+            if error is not None:
+                return error
+            try:
+                self._test_changes(subset)
+            except (exception.ProcessExecutionError,
+                    IOError, OSError) as e:
+                return str(e)
+            return None
+
+        accepted, rejected = batch.bisect(changes, check)
+        for change, error in rejected:
+            LOG.warn('Skip %s of %s on bootstrap: %s', change['cmd'],
+                     change['msg']['uuid'], error)
+            if change['cmd'] == 'update_lb':
+                failed[change['msg']['uuid']] = error
+        if accepted:
+            try:
+                self._commit_changes(accepted)
+            except (exception.ProcessExecutionError, IOError, OSError) as e:
+                LOG.critical('%s', e)
+                raise exception.NginxConfigureError(explanation=str(e))
+
+        LOG.info("Bootstrapped %d load balancers", len(wanted) - len(failed))
+        return failed
+
     def _create_lb(self, msg):
         LOG.debug("Creating the nginx load "
                   "balancer for NAME:%s USER: %s PROJECT:%s" %
@@ -163,18 +714,21 @@ class NginxProxyConfigurer(object):
         LOG.info("Delete nginx load balancer successfully")
 
     def _update_lb(self, msg):
+        """Replace the configuration of `msg` in place.
+
+        The new file is tested staged beside the enabled ones before it
+        is renamed over the enabled one, so a failed update leaves the
+        load balancer as it was.
+        """
         LOG.debug("Updating the nginx load "
                   "balancer for NAME:%s USER: %s PROJECT:%s" %
                   (msg['uuid'], msg['user_id'], msg['tenant_id']))
 
+        changes = [{'cmd': 'update_lb', 'msg': msg}]
         try:
-            self._delete_http_ngx_cfg(msg)
-        except OSError as e:
-            raise exception.NginxUpdateProxyError(explanation=str(e))
-
-        try:
-            self._create_lb(msg)
-        except exception.NginxCreateProxyError as e:
+            self._test_changes(changes)
+            self._commit_changes(changes)
+        except (exception.ProcessExecutionError, IOError, OSError) as e:
             raise exception.NginxUpdateProxyError(explanation=str(e))
 
         LOG.info("Update nginx load balancer successfully")
@@ -182,6 +736,7 @@ class NginxProxyConfigurer(object):
     def _reload_http_ngx_cfg(self):
         LOG.debug('Reloading nginx')
 
+        self._write_managed_ngx_cfg()
         try:
             utils.execute('nginx -s reload')
         except exception.ProcessExecutionError as e:
@@ -191,8 +746,10 @@ class NginxProxyConfigurer(object):
 
     def _test_http_ngx_cfg(self):
         LOG.debug('Testing the new nginx configuration')
+        self._write_managed_ngx_cfg()
         try:
-            utils.execute('nginx -t')
+            utils.execute('nginx -t',
+                          timeout=FLAGS.nginx.validation_timeout)
         except exception.ProcessExecutionError as e:
             LOG.warn('Did not pass the new nginx configuration test: %s', e)
             raise
@@ -200,6 +757,7 @@ class NginxProxyConfigurer(object):
     def _delete_http_ngx_cfg(self, msg):
         confname = self._conf_file_name(msg)
         LOG.debug("Deleting %s and its symbolic link", confname)
+        self._digests.pop(confname, None)
 
         dirname = os.path.dirname('/etc/nginx/sites-enabled/')
         symbol_path = os.path.join(dirname, confname)
@@ -249,8 +807,11 @@ class NginxProxyConfigurer(object):
 
         # TODO(wenjinahn): ngx healthy check
 
-        max_fails = 3
-        fail_timeout = 10
+        max_fails = msg.get('max_fails')
+        if max_fails is None:
+            max_fails = _NGX_DEFAULT_MAX_FAILS
+        fail_timeout = _ngx_time(msg.get('fail_timeout_ms'),
+                                 _NGX_DEFAULT_FAIL_TIMEOUT)
         server_list = []
         for ip in msg['instance_ips']:
             server_list.append(_NGX_UPSTREAM_SERVER_FMT %
@@ -259,21 +820,71 @@ class NginxProxyConfigurer(object):
                                 'max_fails': max_fails,
                                 'fail_timeout': fail_timeout})
 
+        keepalive = ''
+        if msg.get('keepalive_connections'):
+            keepalive = _NGX_UPSTREAM_KEEPALIVE_FMT % {
+                'connections': msg['keepalive_connections']}
+            if FLAGS.nginx.upstream_keepalive_limits:
+                keepalive += _NGX_UPSTREAM_KEEPALIVE_LIMITS_FMT % {
+                    'timeout_ms': msg.get('keepalive_timeout_ms') or 60000,
+                    'requests': msg.get('keepalive_requests') or 100}
+        if (not FLAGS.nginx.upstream_keepalive_limits and
+                (msg.get('keepalive_timeout_ms') or
+                 msg.get('keepalive_requests'))):
+            LOG.warn('keepalive_timeout_ms and keepalive_requests of %s '
+                     'are ignored, upstream_keepalive_limits is off',
+                     msg['uuid'])
+
         return _NGX_UPSTREAM_FMT % {'upstream_name': upstream_name,
                                     'balancing_method': balancing_method,
-                                    'servers': '\n'.join(server_list)}
+                                    'servers': '\n'.join(server_list),
+                                    'keepalive': keepalive}
+
+    def _create_ngx_proxy_policy(self, msg):
+        """Render the timeouts and the retries of `msg`.
+
+        :returns: dict of connect_timeout, server_timeout and policy,
+                  the lines of the optional settings
+        """
+        policy = ''
+        if msg.get('client_timeout_ms') is not None:
+            policy += _NGX_CLIENT_TIMEOUT_FMT % {
+                'timeout': '%dms' % msg['client_timeout_ms']}
+        retries = msg.get('retries')
+        if retries == 0:
+            policy += _NGX_NEXT_UPSTREAM_FMT % 'off'
+        else:
+            if msg.get('next_upstream'):
+                policy += _NGX_NEXT_UPSTREAM_FMT % msg['next_upstream']
+            if retries is not None:
+                # the first try is counted
+                policy += _NGX_NEXT_UPSTREAM_TRIES_FMT % (retries + 1)
+
+        return {
+            'connect_timeout': _ngx_time(msg.get('connect_timeout_ms'),
+                                         _NGX_DEFAULT_CONNECT_TIMEOUT),
+            'server_timeout': _ngx_time(msg.get('server_timeout_ms'),
+                                        _NGX_DEFAULT_SERVER_TIMEOUT),
+            'policy': policy,
+        }
 
     def _create_ngx_server_directive(self, upstream_name, msg):
-        server_name_list = msg['dns_names']
-        server_name_list.extend(msg['http_server_names'])
+        server_name_list = msg['dns_names'] + msg['http_server_names']
         server_name = ' '.join(server_name_list)
         dirname = os.path.dirname(self.access_log_dir)
         log_path = os.path.join(dirname, upstream_name)
 
-        return _NGX_SERVER_FMT % {'listen': self.listen_field,
-                                  'server_name': server_name,
-                                  'proxy_pass': upstream_name,
-                                  'log_path': log_path}
+        keepalive_headers = ''
+        if msg.get('keepalive_connections'):
+            keepalive_headers = _NGX_KEEPALIVE_HEADERS
+
+        values = self._create_ngx_proxy_policy(msg)
+        values.update({'listen': self.listen_field,
+                       'server_name': server_name,
+                       'proxy_pass': upstream_name,
+                       'log_path': log_path,
+                       'keepalive_headers': keepalive_headers})
+        return _NGX_SERVER_FMT % values
 
     def _create_http_ngx_cfg(self, msg):
         cfile_path = "/etc/nginx/sites-available/%s" % \
@@ -283,11 +894,23 @@ class NginxProxyConfigurer(object):
 
         ngx_cfg = self._create_http_ngx_cfg_buffer(msg)
         LOG.info('Write it into configuration file: %s', cfile_path)
-        with open(cfile_path, 'w') as cfile:
-            cfile.write(ngx_cfg)
+        fileutils.write_atomic(cfile_path, ngx_cfg)
+        self._digests[self._conf_file_name(msg)] = _digest(ngx_cfg)
+
+        symbol_path = os.path.join('/etc/nginx/sites-enabled/',
+                                   self._conf_file_name(msg))
+        fileutils.symlink_atomic(cfile_path, symbol_path)
 
-        cmd = "ln -sf %s /etc/nginx/sites-enabled/" % cfile_path
-        utils.execute(cmd)
+    def _write_http_ngx_cfg(self, msg):
+        confname = self._conf_file_name(msg)
+        cfile_path = os.path.join('/etc/nginx/sites-available/', confname)
+        ngx_cfg = self._create_http_ngx_cfg_buffer(msg)
+        fileutils.write_atomic(cfile_path, ngx_cfg)
+        self._digests[confname] = _digest(ngx_cfg)
+
+        symbol_path = os.path.join('/etc/nginx/sites-enabled/', confname)
+        if not os.path.lexists(symbol_path):
+            fileutils.symlink_atomic(cfile_path, symbol_path)
 
     def _create_http_ngx_cfg_buffer(self, msg):
         ngx_upstream_name = self._upstream_name(msg)
@@ -295,6 +918,18 @@ class NginxProxyConfigurer(object):
         ngx_upstream_directive = self._create_ngx_upstream_directive(
             ngx_upstream_name, msg)
 
+        has_policy = any(msg.get(key) is not None
+                         for key in _NGX_PROXY_POLICY_KEYS)
+        if FLAGS.nginx.render_mode == 'map' and not has_policy:
+            # the shared server block routes to the upstream, by the
+            # names listed on the first line. The others get their own
+            # server block, which takes precedence for their names.
+            server_names = msg['dns_names'] + msg['http_server_names']
+            header = "%s %s" % (_NGX_MAP_HEADER, ' '.join(server_names))
+            if msg.get('keepalive_connections'):
+                header = "%s\n%s" % (header, _NGX_MAP_KEEPALIVE)
+            return "%s\n%s" % (header, ngx_upstream_directive)
+
         ngx_server_directive = self._create_ngx_server_directive(
             ngx_upstream_name, msg)
 
@@ -307,3 +942,128 @@ class NginxProxyConfigurer(object):
                   """, ngx_cfg)
 
         return ngx_cfg
+
+    def _read_server_names(self, confname, cfile_path):
+        """Return the server names of the enabled file `cfile_path`."""
+        try:
+            stat = os.stat(cfile_path)
+        except OSError:
+            # dangling link
+            return []
+        key = (stat.st_ino, stat.st_size, stat.st_mtime)
+        cached = self._server_names.get(confname)
+        if cached is None or cached[0] != key:
+            server_names = []
+            keepalive = False
+            with open(cfile_path) as cfile:
+                for line in cfile:
+                    fields = line.split()
+                    if line.startswith(_NGX_MAP_HEADER):
+                        server_names = fields[2:]
+                        keepalive = next(cfile, '').startswith(
+                            _NGX_MAP_KEEPALIVE)
+                        break
+                    if fields and fields[0] == 'server_name':
+                        server_names = [x.rstrip(';') for x in fields[1:]]
+                        break
+            cached = (key, [x for x in server_names if x], keepalive)
+        self._server_names[confname] = cached
+        return cached[1]
+
+    def _scan_server_names(self, sites_dir='/etc/nginx/sites-enabled/'):
+        """Return (file name, server names) of the files of `sites_dir`.
+
+        Files are only read again when they changed.
+        """
+        map_name = os.path.basename(_NGX_MAP_PATH)
+        confnames = [x for x in sorted(os.listdir(sites_dir))
+                     if not x.startswith('.') and x != map_name]
+        result = [(x, self._read_server_names(
+                   x, os.path.join(sites_dir, x))) for x in confnames]
+        if sites_dir == '/etc/nginx/sites-enabled/':
+            for confname in set(self._server_names) - set(confnames):
+                del self._server_names[confname]
+        return result
+
+    def _write_managed_ngx_cfg(self, sites_dir='/etc/nginx/sites-enabled/',
+                               hash_path=None):
+        """Write the files derived from all the files of `sites_dir`.
+
+        :param hash_path: where to write the hash sizes instead of
+                          hash_sizes_config
+        """
+        if (not FLAGS.nginx.hash_sizes_config and
+                FLAGS.nginx.render_mode != 'map'):
+            return
+        server_names = self._scan_server_names(sites_dir)
+        if FLAGS.nginx.hash_sizes_config:
+            self._write_hash_ngx_cfg(
+                server_names, hash_path or FLAGS.nginx.hash_sizes_config)
+        if FLAGS.nginx.render_mode == 'map':
+            self._write_map_ngx_cfg(
+                server_names,
+                os.path.join(sites_dir, os.path.basename(_NGX_MAP_PATH)))
+
+    def _write_if_changed(self, path, ngx_cfg):
+        if self._digests.get(path) == _digest(ngx_cfg):
+            return
+        LOG.info('Write it into configuration file: %s', path)
+        fileutils.write_atomic(path, ngx_cfg)
+        self._digests[path] = _digest(ngx_cfg)
+
+    def _write_hash_ngx_cfg(self, server_names, path=None):
+        """Size the hash tables of nginx for `server_names`.
+
+        Sizes are rounded up to powers of two, so the file only changes
+        when the number or the length of the names crosses one.
+        """
+        names = [name for confname, names in server_names for name in names]
+        longest = max([len(name) for name in names] or [0])
+        max_size, bucket_size = _hash_sizes(len(names), longest)
+        self._write_if_changed(path or FLAGS.nginx.hash_sizes_config,
+                               _NGX_HASH_FMT % {'max_size': max_size,
+                                                'bucket_size': bucket_size})
+
+    def _write_map_ngx_cfg(self, server_names, path=_NGX_MAP_PATH):
+        """Route the server names to the upstreams in map render mode."""
+        upstreams = dict()
+        for confname, names in server_names:
+            for host in names:
+                host = host.lower()
+                if host in upstreams:
+                    LOG.warn('%s is routed to %s already, ignored for %s',
+                             host, upstreams[host], confname)
+                    continue
+                upstreams[host] = confname
+        keepalive = [confname for confname, names in server_names
+                     if self._server_names.get(confname, (0, 0, False))[2]]
+        ngx_cfg = self._create_map_ngx_cfg_buffer(upstreams, keepalive)
+        if path == _NGX_MAP_PATH:
+            self._write_if_changed(path, ngx_cfg)
+        else:
+            fileutils.write_atomic(path, ngx_cfg)
+
+    def _create_map_ngx_cfg_buffer(self, upstreams, keepalive=()):
+        """Render the map and shared server block.
+
+        :param upstreams: dict of host name to upstream name
+        :param keepalive: names of the upstreams keeping connections
+                          alive
+        """
+        hosts = ['\t%s %s;' % (host, upstreams[host])
+                 for host in sorted(upstreams)]
+        # NOTE: the proxy timeouts take no variables, the load balancers
+        # setting them or retries have their own server block.
+        connection_map = ''
+        keepalive_headers = ''
+        if keepalive:
+            connection_map = _NGX_MAP_CONNECTION_FMT % {
+                'upstreams': '\n'.join(['\t%s "";' % name
+                                        for name in sorted(keepalive)])}
+            keepalive_headers = _NGX_MAP_KEEPALIVE_HEADERS
+        return _NGX_MAP_FMT % {
+            'listen': self.map_listen_field,
+            'hosts': '\n'.join(hosts),
+            'connection_map': connection_map,
+            'log_dir': os.path.dirname(self.access_log_dir),
+            'keepalive_headers': keepalive_headers}
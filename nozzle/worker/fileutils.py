@@ -0,0 +1,110 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Ustack Corporation
+# All Rights Reserved.
+# Author: Jiajun Liu <iamljj@gmail.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Atomic file operations for the configuration of the drivers.
+
+Files are never changed in place: new content goes to a temporary file
+in the same directory which is then renamed over the target, so readers
+see either the old or the new file. That also makes hard links usable
+as backups.
+"""
+import errno
+import os
+import shutil
+import tempfile
+
+from nozzle.openstack.common import cfg
+
+from nozzle.common import flags
+from nozzle.common import utils
+
+fileutils_opts = [
+    cfg.StrOpt('fsync_policy',
+               default='file',
+               help="How written files reach the disk: 'always' syncs the "
+                    "files and their directory, 'file' syncs the files "
+                    "only, 'never' leaves it to the kernel."),
+]
+
+FLAGS = flags.FLAGS
+FLAGS.register_opts(fileutils_opts, 'worker')
+
+
+def _fsync_dir(dirname):
+    if FLAGS.worker.fsync_policy != 'always':
+        return
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_atomic(path, content, mode=0644):
+    """Replace the content of `path` with `content`."""
+    dirname = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path),
+                                    dir=dirname)
+    try:
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(content)
+            if FLAGS.worker.fsync_policy != 'never':
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+        os.rename(tmp_path, path)
+    except:
+        utils.delete_if_exists(tmp_path)
+        raise
+    _fsync_dir(dirname)
+
+
+def copy_atomic(src, dst):
+    with open(src) as src_file:
+        write_atomic(dst, src_file.read())
+
+
+def rename(src, dst):
+    os.rename(src, dst)
+    _fsync_dir(os.path.dirname(dst) or '.')
+
+
+def symlink_atomic(target, link_path):
+    """Point `link_path` to `target`, replacing what is there."""
+    dirname = os.path.dirname(link_path) or '.'
+    # hidden, so that the include globs of nginx skip it
+    tmp_path = os.path.join(dirname,
+                            '.%s.tmp' % os.path.basename(link_path))
+    utils.delete_if_exists(tmp_path)
+    os.symlink(target, tmp_path)
+    os.rename(tmp_path, link_path)
+    _fsync_dir(dirname)
+
+
+def backup(path, backup_path):
+    """Keep the current content of `path` as `backup_path`.
+
+    A hard link is enough since `path` is only ever replaced by rename,
+    the file is copied when both are on different file systems.
+    """
+    try:
+        os.link(path, backup_path)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(path, backup_path)
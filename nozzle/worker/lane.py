@@ -0,0 +1,106 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Ustack Corporation
+# All Rights Reserved.
+# Author: Jiajun Liu <iamljj@gmail.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Execution lanes, one per driver, so drivers do not wait on each other."""
+import collections
+import Queue
+import threading
+import time
+
+from nozzle.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class Lane(object):
+    """Apply the changes of one driver on a thread of its own.
+
+    Changes are handled in the order they are put, the ones queued
+    while a batch is applied make the next batch.
+    """
+
+    def __init__(self, name, handler, max_batch_size, latency_samples=100):
+        """
+        :param handler: callable taking a list of changes, run on the
+                        thread of the lane
+        """
+        self.name = name
+        self._handler = handler
+        self._max_batch_size = max_batch_size
+        self._queue = Queue.Queue()
+        self._latencies = collections.deque(maxlen=latency_samples)
+        self.batches = 0
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='lane-%s' % self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, changes):
+        now = time.time()
+        for change in changes:
+            self._queue.put((now, change))
+
+    def join(self):
+        """Wait until all the changes put are handled."""
+        self._queue.join()
+
+    def _get_batch(self):
+        entries = [self._queue.get()]
+        while len(entries) < self._max_batch_size:
+            try:
+                entries.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        return entries
+
+    def _handle(self, entries):
+        try:
+            self._handler([change for queued_at, change in entries])
+        except Exception:
+            LOG.exception('Failed to handle %d %s changes',
+                          len(entries), self.name)
+        finally:
+            now = time.time()
+            self.batches += 1
+            for queued_at, change in entries:
+                self._latencies.append(now - queued_at)
+                self._queue.task_done()
+
+    def _run(self):
+        while True:
+            self._handle(self._get_batch())
+
+    def get_stats(self):
+        """Return the queue depth and the latency of the last changes.
+
+        Latency is the time from put to handled, in seconds.
+        """
+        latencies = list(self._latencies)
+        stats = {
+            'queue_depth': self._queue.qsize(),
+            'batches': self.batches,
+            'latency_avg': 0.0,
+            'latency_max': 0.0,
+        }
+        if latencies:
+            stats['latency_avg'] = sum(latencies) / len(latencies)
+            stats['latency_max'] = max(latencies)
+        return stats
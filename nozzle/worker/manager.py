@@ -16,6 +16,10 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import functools
+import socket
+import time
+
 import zmq
 
 from nozzle.openstack.common import cfg
@@ -27,6 +31,8 @@ from nozzle.common import exception
 from nozzle.common import flags
 from nozzle.common import utils
 from nozzle.worker.driver import haproxy
+from nozzle.worker import lane
+from nozzle.worker import revision
 from nozzle.worker.driver import nginx
 
 
@@ -34,6 +40,33 @@ worker_opts = [
     cfg.StrOpt('service_interface',
                default='lo',
                help="listen on which interface to provide service."),
+    cfg.StrOpt('revision_store_path',
+               default='/var/lib/nozzle/worker/revisions.json',
+               help="File keeping the load balancer revisions applied."),
+    cfg.IntOpt('broadcast_hwm',
+               default=10000,
+               help="Broadcast messages queued before new ones are "
+                    "dropped."),
+    cfg.IntOpt('batch_window_ms',
+               default=200,
+               help="Milliseconds to collect changes before applying them "
+                    "with a single reload."),
+    cfg.IntOpt('batch_max_size',
+               default=500,
+               help="Max number of changes applied with a single reload."),
+    cfg.IntOpt('snapshot_timeout',
+               default=30,
+               help="Seconds to wait for the snapshot or a resync from "
+                    "the server, 0 disables both."),
+    cfg.BoolOpt('concurrent_drivers',
+                default=True,
+                help="Apply the changes of each driver on a thread of its "
+                     "own, so a slow driver does not delay the others."),
+    cfg.IntOpt('stats_interval',
+               default=60,
+               help="Seconds between two reports of the queue depth and "
+                    "latency of the drivers to the server, 0 disables "
+                    "them."),
 ]
 
 FLAGS = flags.FLAGS
@@ -46,6 +79,7 @@ class WorkerManager(manager.Manager):
 
     def __init__(self):
         self.ips = []
+        self.lanes = dict()
         super(WorkerManager, self).__init__()
 
     def init_host(self):
@@ -74,9 +108,11 @@ class WorkerManager(manager.Manager):
             utils.execute(cmd)
 
     def start(self):
-        context = zmq.Context()
+        self.zmq_context = context = zmq.Context()
         # Socket for control input
         self.broadcast = context.socket(zmq.SUB)
+        self.broadcast.setsockopt(getattr(zmq, 'RCVHWM', zmq.HWM),
+                                  FLAGS.worker.broadcast_hwm)
         self.broadcast.connect("tcp://%s:%s" % (FLAGS.broadcast_listen,
                                                 FLAGS.broadcast_listen_port))
         self.broadcast.setsockopt(zmq.SUBSCRIBE, "lb")
@@ -90,54 +126,305 @@ class WorkerManager(manager.Manager):
         self.poller = zmq.Poller()
         self.poller.register(self.broadcast, zmq.POLLIN)
 
+        # epoch of the server and last sequence number handled
+        self.epoch = None
+        self.last_seq = 0
+
+        self.revisions = revision.RevisionStore(
+            FLAGS.worker.revision_store_path)
+
         self.ha_configurer = haproxy.HaproxyConfigurer()
         self.ngx_configurer = nginx.NginxProxyConfigurer()
 
         self.binding_ip(self.ha_configurer._bind_ip)
         self.binding_ip(self.ngx_configurer._bind_ip)
 
+        # NOTE: subscribed already, changes published while the snapshot
+        # is applied are queued and handled afterwards.
+        if FLAGS.worker.snapshot_timeout > 0:
+            self.bootstrap()
+
+        if FLAGS.worker.concurrent_drivers:
+            self._start_lanes()
+
+    def _get_configurers(self):
+        return {
+            'tcp': self.ha_configurer,
+            'http': self.ngx_configurer,
+        }
+
+    def _start_lanes(self):
+        for protocol in self._get_configurers():
+            # NOTE: zmq sockets are not thread safe, each lane sends its
+            # feedbacks on a socket of its own.
+            feedback = self.zmq_context.socket(zmq.PUSH)
+            feedback.connect("tcp://%s:%s" % (FLAGS.feedback_listen,
+                                              FLAGS.feedback_listen_port))
+            handler = functools.partial(self._apply_changes, protocol,
+                                        feedback=feedback)
+            self.lanes[protocol] = lane.Lane(protocol, handler,
+                                             FLAGS.worker.batch_max_size)
+            self.lanes[protocol].start()
+
+    def bootstrap(self):
+        """Apply the state of all load balancers in one go."""
+        # the drivers must not change the configuration meanwhile
+        for driver_lane in self.lanes.itervalues():
+            driver_lane.join()
+
+        requests = self._fetch_snapshot()
+        if requests is None:
+            return
+
+        configurers = [
+            ('tcp', self.ha_configurer, exception.HaproxyConfigureError),
+            ('http', self.ngx_configurer, exception.NginxConfigureError),
+        ]
+        for protocol, configurer, error in configurers:
+            proto_requests = filter(
+                lambda x: x['args'].get('protocol') == protocol, requests)
+            try:
+                failed = configurer.do_bootstrap(proto_requests)
+            except error, e:
+                LOG.error('Failed to bootstrap %s load balancers: %s',
+                          protocol, e)
+                continue
+            self.revisions.record_many(
+                [(x['args']['uuid'], x['args'].get('revision'))
+                 for x in proto_requests if x['args']['uuid'] not in failed])
+
+    def _request_server(self, msg_type, body):
+        """Send a request on the snapshot channel, collect the reply.
+
+        :returns: (items of all chunks, body of the end frame), or
+                  (None, None) on timeout
+        """
+        snapshot = self.zmq_context.socket(zmq.DEALER)
+        snapshot.setsockopt(zmq.LINGER, 0)
+        snapshot.connect("tcp://%s:%s" % (FLAGS.snapshot_listen,
+                                          FLAGS.snapshot_listen_port))
+        poller = zmq.Poller()
+        poller.register(snapshot, zmq.POLLIN)
+
+        request_id = utils.str_uuid()
+        items = []
+        try:
+            snapshot.send_multipart([msg_type, request_id,
+                                     jsonutils.dumps(body)])
+            while True:
+                timeout = FLAGS.worker.snapshot_timeout * 1000
+                if not poller.poll(timeout):
+                    LOG.warn('Timed out waiting for %s', msg_type)
+                    return None, None
+                reply_type, reply_id, reply_body = snapshot.recv_multipart()
+                if reply_id != request_id:
+                    continue
+                reply = jsonutils.loads(reply_body)
+                if reply_type == 'end':
+                    return items, reply
+                items.extend(reply)
+        finally:
+            snapshot.close()
+
+    def _fetch_snapshot(self):
+        requests, result = self._request_server('snapshot', {})
+        if requests is None or result['code'] != 200:
+            LOG.warn('Failed to fetch snapshot, skip bootstrap')
+            return None
+        LOG.info('Fetched snapshot of %d load balancers', len(requests))
+        self.epoch = result['epoch']
+        self.last_seq = result['seq']
+        return requests
+
+    def _resync(self, first, last):
+        """Fetch broadcast messages `first` to `last` again.
+
+        :returns: list of broadcast frames, None if the server does not
+                  have them any more
+        """
+        LOG.warn('Missed broadcast messages %d to %d, resync', first, last)
+        body = {'epoch': self.epoch, 'first': first, 'last': last}
+        frames, result = self._request_server('resync', body)
+        if frames is None or result['code'] != 200:
+            return None
+        return frames
+
+    def _check_sequence(self, msg_type, msg_id, message):
+        """Find broadcast messages missed before `message`.
+
+        :returns: list of (msg_type, msg_id, message) to handle, the
+                  missed ones first
+        """
+        seq = message.get('seq')
+        if seq is None:
+            return [(msg_type, msg_id, message)]
+
+        epoch = message.get('epoch')
+        if epoch != self.epoch:
+            LOG.info('Server epoch changed from %s to %s', self.epoch, epoch)
+            # start over from the first message of a restarted server.
+            self.last_seq = 0 if self.epoch else seq - 1
+            self.epoch = epoch
+
+        if seq <= self.last_seq:
+            return []
+
+        result = []
+        if seq > self.last_seq + 1 and FLAGS.worker.snapshot_timeout > 0:
+            missed = self._resync(self.last_seq + 1, seq - 1)
+            if missed is None:
+                LOG.warn('Can not resync, bootstrap from snapshot')
+                self.bootstrap()
+                if seq <= self.last_seq:
+                    return []
+            else:
+                for frames in missed:
+                    result.append((frames[0], frames[1],
+                                   jsonutils.loads(frames[2])))
+
+        self.last_seq = seq
+        result.append((msg_type, msg_id, message))
+        return result
+
+    def _collect_batch(self):
+        """Receive changes until the batch window closes or it is full."""
+        requests = []
+        deadline = time.time() + FLAGS.worker.batch_window_ms / 1000.0
+        while len(requests) < FLAGS.worker.batch_max_size:
+            msg_type, msg_id, msg_body = self.broadcast.recv_multipart()
+            message = jsonutils.loads(msg_body)
+            LOG.info('Received request: %s', message)
+            requests.extend(self._check_sequence(msg_type, msg_id, message))
+
+            timeout = (deadline - time.time()) * 1000
+            if timeout <= 0 or not self.poller.poll(timeout):
+                break
+        return requests
+
+    def _send_feedback(self, msg_type, msg_id, message, response_msg,
+                       feedback=None):
+        response_msg['cmd'] = message.get('cmd')
+        response_msg['uuid'] = message.get('args', {}).get('uuid')
+        # lets the server tell stale feedbacks apart
+        response_msg['revision'] = message.get('args', {}).get('revision')
+        if feedback is None:
+            feedback = self.feedback
+        feedback.send_multipart([msg_type, msg_id,
+                                 jsonutils.dumps(response_msg)])
+
+    def _handle_batch(self, requests):
+        configurers = self._get_configurers()
+        pending = dict((protocol, []) for protocol in configurers)
+        for msg_type, msg_id, message in requests:
+            response_msg = {'code': 200, 'message': 'OK'}
+            # check input message
+            if 'cmd' not in message or 'args' not in message:
+                LOG.warn("Error. 'cmd' or 'args' not in message")
+                response_msg['code'] = 500
+                response_msg['message'] = "missing 'cmd' or 'args' field"
+            elif message['args'].get('protocol') in configurers:
+                protocol = message['args']['protocol']
+                pending[protocol].append((msg_type, msg_id, message))
+                continue
+            else:
+                LOG.error('Error. Unsupported protocol')
+                response_msg['code'] = 500
+                response_msg['message'] = "Error: unsupported protocol"
+            self._send_feedback(msg_type, msg_id, message, response_msg)
+
+        for protocol, items in pending.iteritems():
+            if not items:
+                continue
+            if protocol in self.lanes:
+                self.lanes[protocol].put(items)
+            else:
+                self._apply_changes(protocol, items)
+
+    def _apply_changes(self, protocol, items, feedback=None):
+        """Apply broadcast messages of one driver with a single reload.
+
+        Runs on the lane of the driver when they are enabled, `feedback`
+        is then the socket of the lane.
+        """
+        configurer = self._get_configurers()[protocol]
+        pending = []
+        queued = dict()
+        for msg_type, msg_id, message in items:
+            uuid = message['args'].get('uuid')
+            lb_revision = message['args'].get('revision')
+            if lb_revision is not None and queued.get(uuid, 0) >= lb_revision:
+                # re-broadcast of a change in this batch, reported there.
+                continue
+            if self.revisions.is_applied(uuid, lb_revision):
+                # re-broadcast of a change done already, just ack it.
+                LOG.info('Revision %s of %s already applied',
+                         lb_revision, uuid)
+                self._send_feedback(msg_type, msg_id, message,
+                                    {'code': 200, 'message': 'OK'},
+                                    feedback=feedback)
+                continue
+            pending.append((msg_type, msg_id, message))
+            if lb_revision is not None:
+                queued[uuid] = lb_revision
+        if not pending:
+            return
+
+        start = time.time()
+        errors = configurer.do_config_batch(
+            [message for msg_type, msg_id, message in pending])
+        stats = configurer.stats
+        LOG.info('Applied %d %s changes in %.3fs, %s of %s changes '
+                 'skipped as no-op so far', len(pending), protocol,
+                 time.time() - start, stats['skipped'], stats['changes'])
+
+        applied = []
+        for (msg_type, msg_id, message), error in zip(pending, errors):
+            response_msg = {'code': 200, 'message': 'OK'}
+            if error is not None:
+                response_msg['code'] = 500
+                response_msg['message'] = error
+            else:
+                applied.append((message['args']['uuid'],
+                                message['args'].get('revision')))
+            self._send_feedback(msg_type, msg_id, message, response_msg,
+                                feedback=feedback)
+        self.revisions.record_many(applied)
+
+    def get_stats(self):
+        """Return the counters of each driver, by protocol.
+
+        With concurrent drivers, the queue depth and latency of their
+        lanes are included.
+        """
+        result = dict()
+        for protocol, configurer in self._get_configurers().iteritems():
+            stats = dict(configurer.stats)
+            stats['skip_rate'] = 0.0
+            if stats['changes']:
+                stats['skip_rate'] = (float(stats['skipped']) /
+                                      stats['changes'])
+            if protocol in self.lanes:
+                stats.update(self.lanes[protocol].get_stats())
+            result[protocol] = stats
+        return result
+
+    def _report_stats(self):
+        self.feedback.send_multipart(['stats', socket.gethostname(),
+                                      jsonutils.dumps(self.get_stats())])
+
     def wait(self):
 
         LOG.info('nozzle worker starting...')
 
+        interval = FLAGS.worker.stats_interval
+        next_report = time.time() + interval
         while True:
-            socks = dict(self.poller.poll())
+            timeout = None
+            if interval > 0:
+                timeout = max(next_report - time.time(), 0) * 1000
+            socks = dict(self.poller.poll(timeout))
             if socks.get(self.broadcast) == zmq.POLLIN:
-                msg_type, msg_id, msg_body = self.broadcast.recv_multipart()
-                message = jsonutils.loads(msg_body)
-                LOG.info('Received request: %s', message)
-
-                response_msg = {'code': 200, 'message': 'OK'}
-                # check input message
-                if 'cmd' not in message or 'args' not in message:
-                    LOG.warn("Error. 'cmd' or 'args' not in message")
-                    response_msg['code'] = 500
-                    response_msg['message'] = "missing 'cmd' or 'args' field"
-
-                    self.feedback.send_multipart([msg_type, msg_id,
-                                                  jsonutils.dumps(
-                                                      response_msg)])
-                    break
-
-                if message['args']['protocol'] == 'http':
-                    try:
-                        self.ngx_configurer.do_config(message)
-                    except exception.NginxConfigureError, e:
-                        response_msg['code'] = 500
-                        response_msg['message'] = str(e)
-                elif message['args']['protocol'] == 'tcp':
-                    try:
-                        self.ha_configurer.do_config(message)
-                    except exception.HaproxyConfigureError, e:
-                        response_msg['code'] = 500
-                        response_msg['message'] = str(e)
-                else:
-                    LOG.exception('Error. Unsupported protocol')
-                    response_msg['code'] = 500
-                    response_msg['message'] = "Error: unsupported protocol"
-
-                # Send results to feedback
-                response_msg['cmd'] = message['cmd']
-                response_msg['uuid'] = message['args']['uuid']
-                self.feedback.send_multipart([msg_type, msg_id,
-                                              jsonutils.dumps(response_msg)])
+                self._handle_batch(self._collect_batch())
+            if interval > 0 and time.time() >= next_report:
+                self._report_stats()
+                next_report = time.time() + interval
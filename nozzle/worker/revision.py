@@ -0,0 +1,81 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Ustack Corporation
+# All Rights Reserved.
+# Author: Jiajun Liu <iamljj@gmail.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Revisions of load balancers applied by this worker."""
+import os
+import threading
+
+from nozzle.openstack.common import jsonutils
+from nozzle.openstack.common import log as logging
+
+from nozzle.worker import fileutils
+
+LOG = logging.getLogger(__name__)
+
+
+class RevisionStore(object):
+    """Map load balancer uuids to the last revision applied.
+
+    The table is kept in a json file, rewritten atomically on every
+    change so it survives restarts of the worker. Drivers record from
+    their own lane, updates are serialized.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._revisions = {}
+        self._lock = threading.Lock()
+        store_dir = os.path.dirname(path)
+        if store_dir and not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        if os.path.exists(path):
+            try:
+                with open(path) as store:
+                    self._revisions = jsonutils.loads(store.read())
+            except ValueError:
+                LOG.warn('ignore corrupted revision store %s', path)
+
+    def get(self, uuid):
+        return self._revisions.get(uuid, 0)
+
+    def is_applied(self, uuid, revision):
+        """Whether `revision` or a newer one was applied already.
+
+        Messages without revision are never considered applied.
+        """
+        if revision is None:
+            return False
+        return self.get(uuid) >= revision
+
+    def record(self, uuid, revision):
+        self.record_many([(uuid, revision)])
+
+    def record_many(self, revisions):
+        """Record (uuid, revision) pairs, the file is written once."""
+        with self._lock:
+            changed = False
+            for uuid, revision in revisions:
+                if revision is None or revision <= self.get(uuid):
+                    continue
+                self._revisions[uuid] = revision
+                changed = True
+            if changed:
+                self._save()
+
+    def _save(self):
+        fileutils.write_atomic(self.path, jsonutils.dumps(self._revisions))
@@ -1,4 +1,5 @@
 import copy
+import datetime
 import mox
 import unittest
 import uuid
@@ -10,6 +11,8 @@ from nozzle.common import exception
 from nozzle.common import utils
 from nozzle.server import api
 from nozzle.server import protocol
+from nozzle.server import resolver
+from nozzle.server import retry
 from nozzle.server import state
 
 
@@ -34,6 +37,20 @@ class FakeModule(object):
         return None
 
 
+class FakeResolver(object):
+
+    def __init__(self, fixed_ips):
+        self.fixed_ips = fixed_ips
+        self.invalidated = []
+
+    def invalidate(self, instance_uuids=None):
+        self.invalidated.extend(instance_uuids)
+
+    def resolve(self, instance_uuids, strict=True):
+        return dict([(uuid, self.fixed_ips[uuid]) for uuid in instance_uuids
+                     if uuid in self.fixed_ips])
+
+
 class ApiTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -70,6 +87,17 @@ class ApiTestCase(unittest.TestCase):
             'health_check_target_path': '/',
             'health_check_healthy_threshold': 0,
             'health_check_unhealthy_threshold': 0,
+            'keepalive_connections': 16,
+            'keepalive_timeout_ms': 60000,
+            'keepalive_requests': 100,
+            'connect_timeout_ms': 2000,
+            'client_timeout_ms': None,
+            'server_timeout_ms': 30000,
+            'retries': 2,
+            'redispatch': None,
+            'next_upstream': 'error timeout',
+            'max_fails': 3,
+            'fail_timeout_ms': None,
         }
         self.tmp = copy.deepcopy(self.config)
         self.tmp['id'] = self.config_id
@@ -263,3 +291,171 @@ class ApiTestCase(unittest.TestCase):
         r = api.get_all_http_servers(self.context, **kwargs)
         self.mox.VerifyAll()
         self.assertEqual(r, {'data': self.http_server_names})
+
+    def _refresh_instance_ips(self, lb_state, new_state):
+        now = datetime.datetime(2013, 1, 1)
+        self.mox.stubs.Set(utils, 'utcnow', lambda: now)
+        fake_resolver = FakeResolver({'a-uuid': '10.0.0.1',
+                                      'b-uuid': '10.0.0.9'})
+        self.mox.stubs.Set(resolver, 'get_resolver', lambda: fake_resolver)
+        self.mox.StubOutWithMock(
+            db, 'load_balancer_instance_association_get_stale')
+        self.mox.StubOutWithMock(
+            db, 'load_balancer_instance_association_update')
+        self.mox.StubOutWithMock(db, 'load_balancer_get')
+        self.mox.StubOutWithMock(db, 'load_balancer_update_state')
+
+        associations = []
+        for uuid in ['a-uuid', 'b-uuid', 'c-uuid']:
+            association_ref = models.LoadBalancerInstanceAssociation()
+            association_ref.update({'load_balancer_id': self.load_balancer_id,
+                                    'instance_uuid': uuid,
+                                    'instance_ip': '10.0.0.1'})
+            associations.append(association_ref)
+        self.lb_ref.state = lb_state
+
+        db.load_balancer_instance_association_get_stale(
+            self.context, mox.IgnoreArg(),
+            limit=mox.IgnoreArg()).AndReturn(associations)
+        db.load_balancer_instance_association_update(
+            self.context, self.load_balancer_id, 'a-uuid',
+            {'instance_ip_resolved_at': now})
+        db.load_balancer_instance_association_update(
+            self.context, self.load_balancer_id, 'b-uuid',
+            {'instance_ip_resolved_at': now, 'instance_ip': '10.0.0.9'})
+        db.load_balancer_instance_association_update(
+            self.context, self.load_balancer_id, 'c-uuid',
+            {'instance_ip_resolved_at': now})
+        db.load_balancer_get(
+            self.context, self.load_balancer_id).AndReturn(self.lb_ref)
+        db.load_balancer_update_state(
+            self.context, self.lb_uuid, new_state)
+        self.mox.ReplayAll()
+        api.refresh_instance_ips(self.context)
+        self.mox.VerifyAll()
+        self.assertEqual(sorted(fake_resolver.invalidated),
+                         ['a-uuid', 'b-uuid', 'c-uuid'])
+
+    def test_refresh_instance_ips(self):
+        self._refresh_instance_ips(state.ACTIVE, state.UPDATING)
+
+    def test_refresh_instance_ips_while_creating(self):
+        scheduler = retry.RetryScheduler()
+        self.mox.stubs.Set(retry, '_SCHEDULER', scheduler)
+        scheduler.start(self.lb_uuid)
+
+        self._refresh_instance_ips(state.CREATING, state.CREATING)
+
+        self.assertEqual(scheduler.attempts(self.lb_uuid), 0)
+
+    def test_refresh_instance_ips_while_updating(self):
+        self._refresh_instance_ips(state.UPDATING, state.UPDATING)
+
+    def _load_balancer_ref(self, lb_id, lb_state, revision=1):
+        load_balancer_ref = models.LoadBalancer()
+        load_balancer_ref.update({'id': lb_id, 'uuid': 'lb-%s' % lb_id,
+                                  'state': lb_state, 'revision': revision})
+        return load_balancer_ref
+
+    def test_update_load_balancer_states(self):
+        self.mox.StubOutWithMock(db, 'load_balancer_get_all_by_uuids')
+        self.mox.StubOutWithMock(db, 'load_balancer_update_states')
+        scheduler = retry.RetryScheduler()
+        self.mox.stubs.Set(retry, '_SCHEDULER', scheduler)
+
+        creating_ref = self._load_balancer_ref('1', state.CREATING)
+        updating_ref = self._load_balancer_ref('2', state.UPDATING, 3)
+        deleting_ref = self._load_balancer_ref('3', state.DELETING)
+        feedbacks = [
+            {'code': 200, 'uuid': 'lb-1'},
+            {'code': 500, 'uuid': 'lb-2', 'revision': 3},
+            {'code': 200, 'uuid': 'lb-2', 'revision': 3},
+            {'code': 200, 'uuid': 'lb-3'},
+            {'code': 200, 'uuid': 'lb-3'},
+        ]
+        for uuid in ['lb-1', 'lb-2', 'lb-3']:
+            scheduler.start(uuid)
+
+        db.load_balancer_get_all_by_uuids(
+            self.context, mox.SameElementsAs(['lb-1', 'lb-2', 'lb-3'])
+        ).AndReturn([creating_ref, updating_ref, deleting_ref])
+        db.load_balancer_update_states(
+            self.context,
+            {state.ACTIVE: [('lb-1', state.CREATING, 1)],
+             state.ERROR: [('lb-2', state.UPDATING, 3)]},
+            destroys=[('3', state.DELETING, 1)]).AndReturn(
+                set(['lb-1', 'lb-2', 'lb-3']))
+        self.mox.ReplayAll()
+        api.update_load_balancer_states(self.context, feedbacks)
+        self.mox.VerifyAll()
+        self.assertEqual(len(scheduler), 0)
+
+    def test_update_load_balancer_states_without_transition(self):
+        self.mox.StubOutWithMock(db, 'load_balancer_get_all_by_uuids')
+        self.mox.StubOutWithMock(db, 'load_balancer_update_states')
+        scheduler = retry.RetryScheduler()
+        self.mox.stubs.Set(retry, '_SCHEDULER', scheduler)
+
+        deleting_ref = self._load_balancer_ref('1', state.DELETING)
+        scheduler.start('lb-1')
+
+        db.load_balancer_get_all_by_uuids(
+            self.context, ['lb-1']).AndReturn([deleting_ref])
+        db.load_balancer_update_states(
+            self.context, {}, destroys=[]).AndReturn(set())
+        self.mox.ReplayAll()
+        api.update_load_balancer_states(self.context,
+                                        [{'code': 500, 'uuid': 'lb-1'}])
+        self.mox.VerifyAll()
+        # the retry budget keeps counting
+        self.assertEqual(scheduler.attempts('lb-1'), 1)
+
+    def test_update_load_balancer_states_with_stale_feedback(self):
+        self.mox.StubOutWithMock(db, 'load_balancer_get_all_by_uuids')
+        self.mox.StubOutWithMock(db, 'load_balancer_update_states')
+        self.mox.stubs.Set(retry, '_SCHEDULER', retry.RetryScheduler())
+
+        updating_ref = self._load_balancer_ref('1', state.UPDATING, 5)
+        feedbacks = [
+            {'code': 200, 'uuid': 'lb-1', 'revision': 4},
+            {'code': 500, 'uuid': 'lb-1', 'revision': 5},
+        ]
+
+        db.load_balancer_get_all_by_uuids(
+            self.context, ['lb-1']).AndReturn([updating_ref])
+        db.load_balancer_update_states(
+            self.context, {state.ERROR: [('lb-1', state.UPDATING, 5)]},
+            destroys=[]).AndReturn(set(['lb-1']))
+        self.mox.ReplayAll()
+        api.update_load_balancer_states(self.context, feedbacks)
+        self.mox.VerifyAll()
+
+    def test_update_load_balancer_states_changed_meanwhile(self):
+        self.mox.StubOutWithMock(db, 'load_balancer_get_all_by_uuids')
+        self.mox.StubOutWithMock(db, 'load_balancer_update_states')
+        self.mox.StubOutWithMock(api, 'notify')
+        scheduler = retry.RetryScheduler()
+        self.mox.stubs.Set(retry, '_SCHEDULER', scheduler)
+
+        creating_ref = self._load_balancer_ref('1', state.CREATING)
+        updating_ref = self._load_balancer_ref('2', state.UPDATING)
+        for uuid in ['lb-1', 'lb-2']:
+            scheduler.start(uuid)
+
+        db.load_balancer_get_all_by_uuids(
+            self.context, mox.SameElementsAs(['lb-1', 'lb-2'])
+        ).AndReturn([creating_ref, updating_ref])
+        db.load_balancer_update_states(
+            self.context,
+            {state.ACTIVE: [('lb-1', state.CREATING, 1),
+                            ('lb-2', state.UPDATING, 1)]},
+            destroys=[]).AndReturn(set(['lb-1']))
+        api.notify(self.context, creating_ref, 'loadbalancer.create.end')
+        self.mox.ReplayAll()
+        api.update_load_balancer_states(self.context, [
+            {'code': 200, 'uuid': 'lb-1'},
+            {'code': 200, 'uuid': 'lb-2'}])
+        self.mox.VerifyAll()
+        # lb-2 was changed by someone else, its retry budget is kept
+        self.assertEqual(scheduler.attempts('lb-1'), 0)
+        self.assertEqual(scheduler.attempts('lb-2'), 1)
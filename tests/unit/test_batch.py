@@ -0,0 +1,36 @@
+import unittest
+
+from nozzle.worker import batch
+
+
+class BisectTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(BisectTestCase, self).setUp()
+        self.checks = []
+
+    def _check(self, changes):
+        self.checks.append(list(changes))
+        bad = [x for x in changes if x.startswith('bad')]
+        if bad:
+            return 'invalid %s' % bad[0]
+        return None
+
+    def test_all_good(self):
+        accepted, rejected = batch.bisect(['a', 'b', 'c'], self._check)
+        self.assertEqual(accepted, ['a', 'b', 'c'])
+        self.assertEqual(rejected, [])
+        self.assertEqual(len(self.checks), 1)
+
+    def test_isolate_bad(self):
+        changes = ['a', 'b', 'bad-1', 'c', 'd', 'bad-2', 'e']
+        accepted, rejected = batch.bisect(changes, self._check)
+        self.assertEqual(accepted, ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(rejected, [('bad-1', 'invalid bad-1'),
+                                    ('bad-2', 'invalid bad-2')])
+        # the last check is the accepted set
+        self.assertEqual(self.checks[-1], accepted)
+
+    def test_empty(self):
+        self.assertEqual(batch.bisect([], self._check), ([], []))
+        self.assertEqual(self.checks, [])
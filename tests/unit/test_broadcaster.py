@@ -0,0 +1,39 @@
+import mock
+import unittest
+
+from nozzle.openstack.common import jsonutils
+
+from nozzle.server import broadcaster
+
+
+class BroadcasterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(BroadcasterTestCase, self).setUp()
+        broadcaster.FLAGS.set_override('broadcast_history_size', 3)
+        self.socket = mock.MagicMock()
+        self.broadcaster = broadcaster.Broadcaster(self.socket)
+
+    def tearDown(self):
+        broadcaster.FLAGS.clear_override('broadcast_history_size')
+        super(BroadcasterTestCase, self).tearDown()
+
+    def test_send(self):
+        self.broadcaster.send('lb', 'msg-1', {'cmd': 'create_lb'})
+        self.broadcaster.send('lb', 'msg-2', {'cmd': 'delete_lb'})
+        frames = self.socket.send_multipart.call_args[0][0]
+        self.assertEqual(frames[:2], ['lb', 'msg-2'])
+        message = jsonutils.loads(frames[2])
+        self.assertEqual(message['seq'], 2)
+        self.assertEqual(message['epoch'], self.broadcaster.epoch)
+
+    def test_get_range(self):
+        for i in range(5):
+            self.broadcaster.send('lb', 'msg-%d' % i, {})
+        epoch = self.broadcaster.epoch
+        frames = self.broadcaster.get_range(epoch, 3, 4)
+        self.assertEqual([x[1] for x in frames], ['msg-2', 'msg-3'])
+        # fell out of history
+        self.assertEqual(self.broadcaster.get_range(epoch, 2, 4), None)
+        # other server
+        self.assertEqual(self.broadcaster.get_range('other', 3, 4), None)
@@ -0,0 +1,204 @@
+import mock
+import sqlalchemy
+from sqlalchemy import orm
+import unittest
+
+from nozzle import db
+from nozzle.common import context
+from nozzle.db.sqlalchemy import api as db_api
+from nozzle.db.sqlalchemy import models
+from nozzle.db.sqlalchemy import session
+
+
+class ExecutionModeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(ExecutionModeTestCase, self).setUp()
+        self.func = mock.MagicMock(return_value='result')
+        self.func.__name__ = 'load_balancer_fake'
+        self.wrapped = db._execute(self.func)
+
+    def tearDown(self):
+        db.FLAGS.clear_override('db_execution_mode')
+        super(ExecutionModeTestCase, self).tearDown()
+
+    def test_direct(self):
+        db.FLAGS.set_override('db_execution_mode', 'direct')
+        with mock.patch.object(db.tpool, 'execute') as execute:
+            self.assertEqual(self.wrapped('ctxt', 1), 'result')
+            self.assertFalse(execute.called)
+        self.func.assert_called_once_with('ctxt', 1)
+
+    def test_tpool(self):
+        db.FLAGS.set_override('db_execution_mode', 'tpool')
+        with mock.patch.object(db.tpool, 'execute',
+                               return_value='result') as execute:
+            self.assertEqual(self.wrapped('ctxt', 1), 'result')
+            execute.assert_called_once_with(self.func, 'ctxt', 1)
+
+    def test_bounded_by_pool_size(self):
+        db.FLAGS.set_override('db_execution_mode', 'green')
+        fake_semaphore = mock.MagicMock()
+        with mock.patch.object(db, '_SEMAPHORE', fake_semaphore):
+            self.assertEqual(self.wrapped('ctxt'), 'result')
+        self.assertTrue(fake_semaphore.__enter__.called)
+        self.assertTrue(fake_semaphore.__exit__.called)
+
+    def test_api_is_wrapped(self):
+        self.assertTrue(hasattr(db, 'load_balancer_get_by_uuid'))
+        self.assertFalse(db.load_balancer_get_by_uuid is
+                         db.IMPL.load_balancer_get_by_uuid)
+
+
+class LoadBalancerQueryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(LoadBalancerQueryTestCase, self).setUp()
+        engine = sqlalchemy.create_engine('sqlite://')
+        models.BASE.metadata.create_all(engine)
+        self.ctxt = context.get_admin_context()
+        self.ctxt._session = orm.sessionmaker(bind=engine,
+                                              autocommit=True)()
+        for i, lb_state in enumerate(['creating', 'active', 'updating',
+                                      'deleting', 'creating']):
+            self._create_load_balancer('lb-%d' % i, lb_state)
+
+    def _create_load_balancer(self, uuid, lb_state):
+        load_balancer_ref = db_api.load_balancer_create(self.ctxt, {
+            'name': uuid, 'user_id': 'user', 'project_id': 'project',
+            'uuid': uuid, 'state': lb_state, 'protocol': 'http',
+            'dns_prefix': uuid, 'listen_port': 80, 'instance_port': 80})
+        db_api.load_balancer_config_create(self.ctxt, {
+            'load_balancer_id': load_balancer_ref.id,
+            'balancing_method': 'round_robin'})
+        return load_balancer_ref
+
+    def test_get_all_by_states(self):
+        result = db_api.load_balancer_get_all_by_states(
+            self.ctxt, ['creating', 'updating'])
+        self.assertEqual(sorted(lb.uuid for lb in result),
+                         ['lb-0', 'lb-2', 'lb-4'])
+
+    def test_get_all_by_states_in_batches(self):
+        states = ['creating', 'updating', 'deleting']
+        first = db_api.load_balancer_get_all_by_states(
+            self.ctxt, states, batch_size=2)
+        second = db_api.load_balancer_get_all_by_states(
+            self.ctxt, states, batch_size=2, marker=first[-1].id)
+        third = db_api.load_balancer_get_all_by_states(
+            self.ctxt, states, batch_size=2, marker=second[-1].id)
+
+        self.assertEqual([lb.uuid for lb in first], ['lb-0', 'lb-2'])
+        self.assertEqual([lb.uuid for lb in second], ['lb-3', 'lb-4'])
+        self.assertEqual(third, [])
+        # relations are loaded with the page
+        self.ctxt.session.expunge_all()
+        self.assertEqual(first[0].config.balancing_method, 'round_robin')
+        self.assertEqual(first[0].instances, [])
+
+    def _get_state(self, uuid):
+        self.ctxt.session.expunge_all()
+        load_balancer_ref = db_api.model_query(
+            self.ctxt, models.LoadBalancer, read_deleted='yes').filter_by(
+                uuid=uuid).one()
+        return load_balancer_ref.state, load_balancer_ref.revision
+
+    def test_update_states(self):
+        changed = db_api.load_balancer_update_states(
+            self.ctxt, {'active': [('lb-0', 'creating', 1)]})
+        self.assertEqual(changed, set(['lb-0']))
+        self.assertEqual(self._get_state('lb-0'), ('active', 2))
+
+    def test_update_states_changed_meanwhile(self):
+        db_api.load_balancer_update_state(self.ctxt, 'lb-2', 'updating')
+
+        changed = db_api.load_balancer_update_states(
+            self.ctxt, {'active': [('lb-2', 'updating', 1),
+                                   ('lb-4', 'creating', 1)]})
+        self.assertEqual(changed, set(['lb-4']))
+
+        self.assertEqual(self._get_state('lb-2'), ('updating', 2))
+        self.assertEqual(self._get_state('lb-4'), ('active', 2))
+
+    def test_destroy_changed_meanwhile(self):
+        db_api.load_balancer_update_state(self.ctxt, 'lb-3', 'updating')
+
+        changed = db_api.load_balancer_update_states(
+            self.ctxt, {}, destroys=[(4, 'deleting', 1)])
+        self.assertEqual(changed, set())
+
+        self.assertEqual(self._get_state('lb-3'), ('updating', 2))
+        self.assertEqual(db_api.load_balancer_config_get_by_load_balancer_id(
+            self.ctxt, 4).balancing_method, 'round_robin')
+
+    def test_destroy(self):
+        changed = db_api.load_balancer_update_states(
+            self.ctxt, {}, destroys=[(4, 'deleting', 1)])
+        self.assertEqual(changed, set(['lb-3']))
+
+        self.assertEqual(self._get_state('lb-3'), ('deleted', 1))
+
+
+class SessionExpiryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(SessionExpiryTestCase, self).setUp()
+        db.FLAGS.set_override('db_execution_mode', 'green')
+        engine = sqlalchemy.create_engine('sqlite://')
+        models.BASE.metadata.create_all(engine)
+        self.depth = 0
+        self.outside = []
+        sqlalchemy.event.listen(engine, 'before_cursor_execute',
+                                self._before_cursor_execute)
+        patchers = [mock.patch.object(db, '_SEMAPHORE', self),
+                    mock.patch.object(session, '_MAKER', None),
+                    mock.patch.object(session, 'get_engine',
+                                      return_value=engine)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.ctxt = context.get_admin_context()
+
+    def tearDown(self):
+        db.FLAGS.clear_override('db_execution_mode')
+        super(SessionExpiryTestCase, self).tearDown()
+
+    def __enter__(self):
+        self.depth += 1
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+
+    def _before_cursor_execute(self, conn, cursor, statement, *args):
+        if not self.depth:
+            self.outside.append(statement)
+
+    def test_refs_read_after_commit(self):
+        load_balancer_ref = db.load_balancer_create(self.ctxt, {
+            'name': 'lb', 'user_id': 'user', 'project_id': 'project',
+            'uuid': 'lb-uuid', 'state': 'creating', 'protocol': 'http',
+            'dns_prefix': 'lb', 'listen_port': 80, 'instance_port': 80})
+        config_ref = db.load_balancer_config_create(self.ctxt, {
+            'load_balancer_id': load_balancer_ref.id,
+            'balancing_method': 'round_robin'})
+        domain_ref = db.load_balancer_domain_create(self.ctxt, {
+            'load_balancer_id': load_balancer_ref.id,
+            'name': 'www.example.com'})
+        db.load_balancer_instance_association_create(self.ctxt, {
+            'load_balancer_id': load_balancer_ref.id,
+            'instance_uuid': 'instance-uuid',
+            'instance_ip': '10.0.0.1'})
+        self.assertEqual((config_ref.id, domain_ref.id,
+                          load_balancer_ref.uuid), (1, 1, 'lb-uuid'))
+
+        db.load_balancer_domain_destroy(self.ctxt, domain_ref.id)
+        db.load_balancer_update_state(self.ctxt, 'lb-uuid', 'updating')
+        load_balancer_ref = db.load_balancer_get_by_uuid(self.ctxt,
+                                                         'lb-uuid')
+        self.assertEqual(load_balancer_ref.state, 'updating')
+        self.assertEqual(load_balancer_ref.revision, 2)
+        self.assertEqual(load_balancer_ref.config.id, config_ref.id)
+        self.assertEqual(load_balancer_ref.domains, [])
+        self.assertEqual([i.instance_ip for i in load_balancer_ref.instances],
+                         ['10.0.0.1'])
+        self.assertEqual(self.outside, [])
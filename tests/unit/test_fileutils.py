@@ -0,0 +1,80 @@
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from nozzle.worker import fileutils
+
+
+class FileUtilsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(FileUtilsTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'haproxy.cfg')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        super(FileUtilsTestCase, self).tearDown()
+
+    def _read(self, path):
+        with open(path) as cfg_file:
+            return cfg_file.read()
+
+    def test_write_atomic(self):
+        fileutils.write_atomic(self.path, 'old')
+        fileutils.write_atomic(self.path, 'new')
+
+        self.assertEqual(self._read(self.path), 'new')
+        self.assertEqual(os.listdir(self.tmp_dir), ['haproxy.cfg'])
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0644)
+
+    def test_write_atomic_with_write_failed(self):
+        fileutils.write_atomic(self.path, 'old')
+
+        with mock.patch('os.rename', mock.MagicMock(side_effect=OSError)):
+            self.assertRaises(OSError, fileutils.write_atomic,
+                              self.path, 'new')
+
+        self.assertEqual(self._read(self.path), 'old')
+        self.assertEqual(os.listdir(self.tmp_dir), ['haproxy.cfg'])
+
+    def test_symlink_atomic(self):
+        link_path = os.path.join(self.tmp_dir, 'enabled')
+        fileutils.symlink_atomic('/path/to/old', link_path)
+        fileutils.symlink_atomic('/path/to/new', link_path)
+
+        self.assertEqual(os.readlink(link_path), '/path/to/new')
+        self.assertEqual(os.listdir(self.tmp_dir), ['enabled'])
+
+    def test_backup(self):
+        backup_path = os.path.join(self.tmp_dir, 'backup')
+        fileutils.write_atomic(self.path, 'old')
+
+        fileutils.backup(self.path, backup_path)
+        fileutils.write_atomic(self.path, 'new')
+
+        # replacing the file leaves the backup alone
+        self.assertEqual(self._read(backup_path), 'old')
+
+    def test_backup_across_file_systems(self):
+        backup_path = os.path.join(self.tmp_dir, 'backup')
+        fileutils.write_atomic(self.path, 'old')
+
+        with mock.patch('os.link', mock.MagicMock(
+                side_effect=OSError(errno.EXDEV, 'cross-device link'))):
+            fileutils.backup(self.path, backup_path)
+
+        self.assertEqual(self._read(backup_path), 'old')
+
+    def test_copy_atomic(self):
+        backup_path = os.path.join(self.tmp_dir, 'backup')
+        fileutils.write_atomic(backup_path, 'old')
+        fileutils.write_atomic(self.path, 'new')
+
+        fileutils.copy_atomic(backup_path, self.path)
+
+        self.assertEqual(self._read(self.path), 'old')
@@ -2,6 +2,11 @@ import unittest
 import copy
 import mock
 import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
 
 from nozzle.common import exception
 from nozzle.common import validate
@@ -133,284 +138,386 @@ class TestHaproxyConfigurer(unittest.TestCase):
         self.assertRaises(exception.HaproxyConfigureError,
                           self.manager.do_config, request)
 
-    def test_create_lb(self):
-        args = self.requests['create_lb']['args']
-        self.manager.cfg_backup_dir = '/path/backup'
-        backup_path = os.path.join(self.manager.cfg_backup_dir,
-                                   'haproxy.cfg_W_M_1_12')
-        new_cfg_path = '/etc/haproxy/haproxy.cfg.new'
+    def _prepare_batch(self):
+        backup_path = '/path/backup/haproxy.cfg_W_M_1_12'
+        self.written = []
 
-        self.manager._create_lb_haproxy_cfg = mock.MagicMock(
-            return_value=new_cfg_path)
-        self.manager._test_haproxy_config = mock.MagicMock()
+        def write(cfg_path, sections=None):
+            self.written.append(sections)
+
+        def test(cfg_path):
+            if 'bad_lb' in self.written[-1]:
+                raise exception.ProcessExecutionError
+
+        config = self.manager.config
+        config.header = 'global\n'
+        config.sections = {'old_lb': 'listen\told_lb\n'}
+        config.ensure_fresh = mock.MagicMock()
+        config.write = mock.MagicMock(side_effect=write)
+        config.commit = mock.MagicMock()
+        self.manager._validate_request = mock.MagicMock()
+        self.manager._test_haproxy_config = mock.MagicMock(side_effect=test)
         self.manager._backup_original_cfg = mock.MagicMock(
             return_value=(0, backup_path))
         self.manager._replace_original_cfg_with_new = mock.MagicMock(
             return_value=(0, None))
         self.manager._reload_haproxy_cfg = mock.MagicMock(return_value=0)
 
-        self.manager._create_lb(args)
-
-        self.manager._create_lb_haproxy_cfg.assert_called_once_with(args)
-        self.manager._test_haproxy_config.assert_called_once_with(new_cfg_path)
-        self.manager._backup_original_cfg.assert_called_once_with()
-        self.manager._replace_original_cfg_with_new.assert_called_once_with(
-            new_cfg_path)
-        self.manager._reload_haproxy_cfg.assert_called_once_with(backup_path)
-
-    def test_create_lb_with_create_lb_haproxy_cfg_failed(self):
-        args = self.requests['create_lb']['args']
-        self.manager._create_lb_haproxy_cfg = mock.MagicMock(
-            side_effect=exception.HaproxyCreateCfgError)
+    @mock.patch('lockfile.FileLock', mock.MagicMock())
+    def test_do_config_batch(self):
+        self._prepare_batch()
+        bad = return_create_lb_request()
+        bad['args']['uuid'] = 'bad_lb'
+        delete = return_delete_lb_request()
+        delete['args']['uuid'] = 'old_lb'
+        update = return_update_lb_request()
+        update['args']['uuid'] = 'missing_lb'
+
+        results = self.manager.do_config_batch(
+            [return_create_lb_request(), bad, delete, update])
+
+        self.assertEqual(results[0], None)
+        self.assertTrue('bad_lb' not in self.written[-1])
+        self.assertNotEqual(results[1], None)
+        self.assertEqual(results[2], None)
+        self.assertNotEqual(results[3], None)
+        self.assertEqual(sorted(self.written[-1].keys()),
+                         ['load_balancer_id'])
+        self.assertEqual(self.manager._reload_haproxy_cfg.call_count, 1)
+        self.manager.config.commit.assert_called_once_with(self.written[-1])
 
-        self.assertRaises(exception.HaproxyCreateError,
-                          self.manager._create_lb, args)
+    @mock.patch('lockfile.FileLock', mock.MagicMock())
+    def test_do_config_batch_with_reload_failed(self):
+        self._prepare_batch()
+        self.manager._reload_haproxy_cfg = mock.MagicMock(return_value=-1)
+        results = self.manager.do_config_batch([return_create_lb_request(),
+                                                return_create_lb_request()])
+        # the second create collides with the first one
+        self.assertEqual(results[0], 'Failed to reload haproxy')
+        self.assertNotEqual(results[1], None)
+        self.assertFalse(self.manager.config.commit.called)
 
-    def test_create_lb_with_test_haproxy_config_failed(self):
-        args = self.requests['create_lb']['args']
-        new_cfg_path = '/etc/haproxy/haproxy.cfg.new'
+    @mock.patch('lockfile.FileLock', mock.MagicMock())
+    def test_do_config_batch_with_noop(self):
+        self._prepare_batch()
+        update = return_update_lb_request()
+        section = self.manager._format_haproxy_listen_cfg(update['args'])
+        # as parsed back from haproxy.cfg
+        self.manager.config.sections['load_balancer_id'] = \
+            section.strip('\n') + '\n'
+        delete = return_delete_lb_request()
+        delete['args']['uuid'] = 'missing_lb'
+
+        results = self.manager.do_config_batch([update, delete])
+
+        self.assertEqual(results, [None, None])
+        self.assertFalse(self.manager._test_haproxy_config.called)
+        self.assertFalse(self.manager._reload_haproxy_cfg.called)
+        self.assertEqual(self.manager.stats, {'changes': 2, 'skipped': 2})
 
-        self.manager._create_lb_haproxy_cfg = mock.MagicMock(
-            return_value=new_cfg_path)
-        self.manager._test_haproxy_config = mock.MagicMock(
-            side_effect=exception.ProcessExecutionError)
+    @mock.patch('lockfile.FileLock', mock.MagicMock())
+    def test_do_config_batch_with_scoped_validation(self):
+        haproxy.FLAGS.set_override('validation', 'scoped', 'haproxy')
+        self.addCleanup(haproxy.FLAGS.clear_override, 'validation',
+                        'haproxy')
+        self._prepare_batch()
+        self.manager._stage_scoped_config = mock.MagicMock(
+            return_value=['/etc/haproxy/haproxy.cfg.scoped'])
+        self.manager._stage_config = mock.MagicMock(
+            return_value=['/etc/haproxy/haproxy.cfg.new'])
+        self.manager._test_haproxy_config = mock.MagicMock()
+        config = self.manager.config
+        config.commit = mock.MagicMock(
+            side_effect=lambda sections: setattr(config, 'sections',
+                                                 sections))
+        update = return_update_lb_request()
+        update['args']['balancing_method'] = 'round_robin'
+
+        self.manager.do_config_batch([return_create_lb_request()])
+        self.manager.do_config_batch([update])
+
+        # the whole configuration is only tested for the first batch
+        self.assertEqual(self.manager._stage_scoped_config.call_count, 2)
+        self.assertEqual(self.manager._stage_config.call_count, 1)
+        self.manager._test_haproxy_config.assert_called_with(
+            '/etc/haproxy/haproxy.cfg.scoped')
+
+    def test_stage_scoped_config(self):
+        self.manager.config.write = mock.MagicMock()
+        changes = [{'cmd': 'create_lb', 'name': 'lb_a', 'section': 'a'},
+                   {'cmd': 'create_lb', 'name': 'lb_b', 'section': 'b'},
+                   {'cmd': 'delete_lb', 'name': 'lb_a', 'section': None}]
+
+        cfg_paths = self.manager._stage_scoped_config(changes)
+
+        self.assertEqual(cfg_paths, ['/etc/haproxy/haproxy.cfg.scoped'])
+        self.manager.config.write.assert_called_once_with(
+            '/etc/haproxy/haproxy.cfg.scoped', {'lb_b': 'b'})
+
+    def test_lint_haproxy_cfg(self):
+        sections = {'lb_a': 'listen\tlb_a\n\tbind 10.0.0.1:10001\n',
+                    'lb_b': 'listen\tlb_b\n\tbind 10.0.0.1:10002\n'}
+        change = {'cmd': 'update_lb', 'name': 'lb_b',
+                  'section': 'listen\tlb_b\n\tbind 10.0.0.1:10001\n'}
+        sections['lb_b'] = change['section']
+
+        error = self.manager._lint_haproxy_cfg(sections, [change])
+
+        self.assertEqual(error, 'Listen port 10001 of lb_b is used by lb_a')
+        self.assertEqual(self.manager._lint_haproxy_cfg(
+            {'lb_b': change['section']}, [change]), None)
 
-        self.assertRaises(exception.HaproxyCreateError,
-                          self.manager._create_lb, args)
+    @mock.patch('lockfile.FileLock', mock.MagicMock())
+    def test_do_config_batch_with_read_failed(self):
+        self._prepare_batch()
+        self.manager.config.ensure_fresh = mock.MagicMock(
+            side_effect=IOError)
+        results = self.manager.do_config_batch([return_create_lb_request()])
+        self.assertNotEqual(results[0], None)
+        self.assertFalse(self.manager._reload_haproxy_cfg.called)
+
+    def _prepare_runtime(self):
+        self._prepare_batch()
+        self.manager.runtime = mock.MagicMock()
+        msg = copy.deepcopy(_msg)
+        self.manager.config.sections = {
+            'load_balancer_id': self.manager._format_haproxy_listen_cfg(msg)}
+        return msg
 
-    def test_create_lb_with_backup_original_cfg_failed(self):
-        args = self.requests['create_lb']['args']
-        self.manager._create_lb_haproxy_cfg = mock.MagicMock()
-        self.manager._test_haproxy_config = mock.MagicMock()
-        self.manager._backup_original_cfg = mock.MagicMock(
-            return_value=(-1, 'backup failed'))
+    @mock.patch('lockfile.FileLock', mock.MagicMock())
+    def test_do_config_batch_at_runtime(self):
+        msg = self._prepare_runtime()
+        msg['instance_uuids'] = [msg['instance_uuids'][1], u'new_instance']
+        msg['instance_ips'] = [msg['instance_ips'][1], '10.3.4.5']
+        update = return_update_lb_request()
+        update['args'] = msg
+
+        results = self.manager.do_config_batch([update])
+
+        self.assertEqual(results, [None])
+        # the new instance takes the slot freed by the removed one
+        runtime = self.manager.runtime
+        runtime.set_server_addr.assert_called_once_with('load_balancer_id',
+                                                        'slot0', '10.3.4.5')
+        runtime.set_server_state.assert_called_once_with('load_balancer_id',
+                                                         'slot0', 'ready')
+        self.assertFalse(self.manager._reload_haproxy_cfg.called)
+        self.assertTrue(self.manager._replace_original_cfg_with_new.called)
+        self.manager.config.commit.assert_called_once_with(self.written[-1])
 
-        self.assertRaises(exception.HaproxyCreateError,
-                          self.manager._create_lb, args)
+    @mock.patch('lockfile.FileLock', mock.MagicMock())
+    def test_do_config_batch_at_runtime_with_structural_change(self):
+        msg = self._prepare_runtime()
+        msg['balancing_method'] = 'round_robin'
+        update = return_update_lb_request()
+        update['args'] = msg
 
-    def test_create_lb_with_replace_original_cfg_with_new_failed(self):
-        args = self.requests['create_lb']['args']
-        self.manager._create_lb_haproxy_cfg = mock.MagicMock()
-        self.manager._test_haproxy_config = mock.MagicMock()
-        self.manager._replace_original_cfg_with_new = mock.MagicMock(
-            return_value=(-1, 'replace failed'))
+        results = self.manager.do_config_batch([update])
 
-        self.assertRaises(exception.HaproxyCreateError,
-                          self.manager._create_lb, args)
+        self.assertEqual(results, [None])
+        self.assertFalse(self.manager.runtime.set_server_state.called)
+        self.assertEqual(self.manager._reload_haproxy_cfg.call_count, 1)
 
-    def test_create_lb_with_reload_haproxy_cfg_failed(self):
-        args = self.requests['create_lb']['args']
-        self.manager.cfg_backup_dir = '/path/backup'
-        backup_path = os.path.join(self.manager.cfg_backup_dir,
-                                   'haproxy.cfg_W_M_1_12')
-        new_cfg_path = '/etc/haproxy/haproxy.cfg.new'
+    @mock.patch('lockfile.FileLock', mock.MagicMock())
+    def test_do_config_batch_at_runtime_with_socket_failed(self):
+        msg = self._prepare_runtime()
+        msg['instance_uuids'] = msg['instance_uuids'][:1]
+        msg['instance_ips'] = msg['instance_ips'][:1]
+        update = return_update_lb_request()
+        update['args'] = msg
+        self.manager.runtime.set_server_state = mock.MagicMock(
+            side_effect=exception.HaproxyRuntimeError(explanation='error'))
+
+        results = self.manager.do_config_batch([update])
+
+        self.assertEqual(results, [None])
+        self.manager.runtime.set_server_state.assert_called_once_with(
+            'load_balancer_id', 'slot1', 'drain')
+        self.assertEqual(self.manager._reload_haproxy_cfg.call_count, 1)
+        # the reloaded haproxy starts with the slot disabled
+        self.assertEqual(self.manager._draining, {})
 
-        self.manager._create_lb_haproxy_cfg = mock.MagicMock(
-            return_value=new_cfg_path)
-        self.manager._test_haproxy_config = mock.MagicMock()
-        self.manager._backup_original_cfg = mock.MagicMock(
-            return_value=(0, backup_path))
-        self.manager._replace_original_cfg_with_new = mock.MagicMock(
-            return_value=(0, None))
-        self.manager._reload_haproxy_cfg = mock.MagicMock(return_value=-1)
+    @mock.patch('lockfile.FileLock', mock.MagicMock())
+    def test_do_config_batch_at_runtime_drains_removed(self):
+        msg = self._prepare_runtime()
+        msg['instance_uuids'] = msg['instance_uuids'][:1]
+        msg['instance_ips'] = msg['instance_ips'][:1]
+        update = return_update_lb_request()
+        update['args'] = msg
+        runtime = self.manager.runtime
+
+        with mock.patch.object(haproxy.time, 'time', return_value=100):
+            results = self.manager.do_config_batch([update])
+
+        self.assertEqual(results, [None])
+        runtime.set_server_state.assert_called_once_with(
+            'load_balancer_id', 'slot1', 'drain')
+        self.assertFalse(self.manager._reload_haproxy_cfg.called)
+
+        # a later change before the grace period leaves it draining
+        self.manager.config.sections = dict(self.written[-1])
+        msg = copy.deepcopy(msg)
+        msg['instance_ips'] = ['10.3.4.5']
+        update['args'] = msg
+        with mock.patch.object(haproxy.time, 'time', return_value=110):
+            self.manager.do_config_batch([update])
+        self.assertFalse(mock.call('load_balancer_id', 'slot1', 'maint') in
+                         runtime.set_server_state.call_args_list)
+
+        # and one after it puts it in maintenance
+        self.manager.config.sections = dict(self.written[-1])
+        msg = copy.deepcopy(msg)
+        msg['instance_ips'] = ['10.3.4.6']
+        update['args'] = msg
+        with mock.patch.object(haproxy.time, 'time', return_value=131):
+            self.manager.do_config_batch([update])
+        self.assertTrue(mock.call('load_balancer_id', 'slot1', 'maint') in
+                        runtime.set_server_state.call_args_list)
+        self.assertEqual(self.manager._draining, {})
+        self.assertFalse(self.manager._reload_haproxy_cfg.called)
 
-        self.assertRaises(exception.HaproxyCreateError,
-                          self.manager._create_lb, args)
+    @mock.patch('lockfile.FileLock', mock.MagicMock())
+    def test_do_config_batch_at_runtime_without_drain_timeout(self):
+        haproxy.FLAGS.set_override('drain_timeout', 0, 'haproxy')
+        self.addCleanup(haproxy.FLAGS.clear_override, 'drain_timeout',
+                        'haproxy')
+        msg = self._prepare_runtime()
+        msg['instance_uuids'] = msg['instance_uuids'][:1]
+        msg['instance_ips'] = msg['instance_ips'][:1]
+        update = return_update_lb_request()
+        update['args'] = msg
+
+        results = self.manager.do_config_batch([update])
+
+        self.assertEqual(results, [None])
+        self.manager.runtime.set_server_state.assert_called_once_with(
+            'load_balancer_id', 'slot1', 'maint')
+        self.assertEqual(self.manager._draining, {})
+
+    def test_create_haproxy_lb_slot_directives(self):
+        msg = copy.deepcopy(_msg)
+        current = self.manager._create_haproxy_lb_slot_directives(msg)
+        msg['instance_uuids'].reverse()
+        msg['instance_ips'].reverse()
+
+        ret = self.manager._create_haproxy_lb_slot_directives(msg, current)
+
+        self.assertEqual(ret, current)
+        lines = ret.split('\n')
+        self.assertEqual(len(lines), haproxy.FLAGS.haproxy.server_slots)
+        self.assertEqual(lines[0],
+                         '\tserver slot0 10.1.2.3:544 check inter 2222ms '
+                         'rise 2 fall 3 # '
+                         '212269a0-8f4f-11e1-acdf-001c234d5fd1')
+        self.assertEqual(lines[2],
+                         '\tserver slot2 0.0.0.0:544 check inter 2222ms '
+                         'rise 2 fall 3 disabled')
 
-    def test_delete_lb(self):
-        args = self.requests['delete_lb']['args']
-        self.manager.cfg_backup_dir = '/path/backup'
-        backup_path = os.path.join(self.manager.cfg_backup_dir,
-                                   'haproxy.cfg_W_M_1_12')
-        new_cfg_path = '/etc/haproxy/haproxy.cfg.new.lb_deleted'
-        self.manager._create_lb_deleted_haproxy_cfg = mock.MagicMock(
-            return_value=new_cfg_path)
-        self.manager._test_haproxy_config = mock.MagicMock()
-        self.manager._backup_original_cfg = mock.MagicMock(
-            return_value=(0, backup_path))
-        self.manager._replace_original_cfg_with_new = mock.MagicMock(
-            return_value=(0, None))
-        self.manager._reload_haproxy_cfg = mock.MagicMock(return_value=0)
+    @mock.patch('lockfile.FileLock', mock.MagicMock())
+    def test_do_bootstrap(self):
+        self._prepare_batch()
+        good = return_create_lb_request()
+        bad = return_create_lb_request()
+        bad['args']['uuid'] = 'bad_lb'
+        bad['args']['listen_port'] = 1
+        new_cfg_path = '/etc/haproxy/haproxy.cfg.new'
+        backup_path = '/path/backup/haproxy.cfg_W_M_1_12'
 
-        self.manager._delete_lb(args)
+        failed = self.manager.do_bootstrap([good, bad])
 
-        self.manager._create_lb_deleted_haproxy_cfg.assert_called_once_with(
-            args)
-        self.manager._test_haproxy_config.assert_called_once_with(new_cfg_path)
-        self.manager._backup_original_cfg.assert_called_once_with()
+        self.assertEqual(failed.keys(), ['bad_lb'])
+        self.assertEqual(self.written[-1].keys(), ['load_balancer_id'])
+        self.manager._test_haproxy_config.assert_called_once_with(
+            new_cfg_path)
         self.manager._replace_original_cfg_with_new.assert_called_once_with(
             new_cfg_path)
         self.manager._reload_haproxy_cfg.assert_called_once_with(backup_path)
 
-    def test_delete_lb_with_test_haproxy_config_failed(self):
-        args = self.requests['delete_lb']['args']
-        new_cfg_path = '/etc/haproxy/haproxy.cfg.new'
-
-        self.manager._create_lb_deleted_haproxy_cfg = mock.MagicMock(
-            return_value=new_cfg_path)
-        self.manager._test_haproxy_config = mock.MagicMock(
-            side_effect=exception.ProcessExecutionError)
-
-        self.assertRaises(exception.HaproxyDeleteError,
-                          self.manager._delete_lb, args)
-
-    def test_delete_lb_with_backup_original_cfg_failed(self):
-        args = self.requests['delete_lb']['args']
-        self.manager._create_lb_deleted_haproxy_cfg = mock.MagicMock()
-        self.manager._test_haproxy_config = mock.MagicMock()
-        self.manager._backup_original_cfg = mock.MagicMock(
-            return_value=(-1, 'backup failed'))
+    @mock.patch('lockfile.FileLock', mock.MagicMock())
+    def test_do_bootstrap_with_test_haproxy_config_failed(self):
+        self._prepare_batch()
+        good = return_create_lb_request()
+        bad = return_create_lb_request()
+        bad['args']['uuid'] = 'bad_lb'
+        other = return_create_lb_request()
+        other['args']['uuid'] = 'other_lb'
+        backup_path = '/path/backup/haproxy.cfg_W_M_1_12'
+
+        failed = self.manager.do_bootstrap([good, bad, other])
+
+        # the bad load balancer is left out, the others are applied
+        self.assertEqual(failed.keys(), ['bad_lb'])
+        self.assertEqual(sorted(self.written[-1].keys()),
+                         ['load_balancer_id', 'other_lb'])
+        self.manager._reload_haproxy_cfg.assert_called_once_with(backup_path)
 
-        self.assertRaises(exception.HaproxyDeleteError,
-                          self.manager._delete_lb, args)
+    @mock.patch('lockfile.FileLock', mock.MagicMock())
+    def test_do_bootstrap_with_all_failed(self):
+        self._prepare_batch()
+        bad = return_create_lb_request()
+        bad['args']['uuid'] = 'bad_lb'
 
-    def test_delete_lb_with_replace_original_cfg_with_new_failed(self):
-        args = self.requests['delete_lb']['args']
-        self.manager._create_lb_deleted_haproxy_cfg = mock.MagicMock()
-        self.manager._test_haproxy_config = mock.MagicMock()
-        self.manager._replace_original_cfg_with_new = mock.MagicMock(
-            return_value=(-1, 'replace failed'))
+        failed = self.manager.do_bootstrap([bad])
 
-        self.assertRaises(exception.HaproxyDeleteError,
-                          self.manager._delete_lb, args)
+        self.assertEqual(failed.keys(), ['bad_lb'])
+        self.assertFalse(self.manager._replace_original_cfg_with_new.called)
+        self.assertFalse(self.manager._reload_haproxy_cfg.called)
 
-    def test_delete_lb_with_reload_haproxy_cfg_failed(self):
+    def test_create_lb(self):
         args = self.requests['create_lb']['args']
-        self.manager.cfg_backup_dir = '/path/backup'
-        backup_path = os.path.join(self.manager.cfg_backup_dir,
-                                   'haproxy.cfg_W_M_1_12')
-        new_cfg_path = '/etc/haproxy/haproxy.cfg.new'
+        self.manager._config_batch = mock.MagicMock(return_value=[None])
 
-        self.manager._create_lb_deleted_haproxy_cfg = mock.MagicMock(
-            return_value=new_cfg_path)
-        self.manager._test_haproxy_config = mock.MagicMock()
-        self.manager._backup_original_cfg = mock.MagicMock(
-            return_value=(0, backup_path))
-        self.manager._replace_original_cfg_with_new = mock.MagicMock(
-            return_value=(0, None))
-        self.manager._reload_haproxy_cfg = mock.MagicMock(return_value=-1)
-
-        self.assertRaises(exception.HaproxyDeleteError,
-                          self.manager._delete_lb, args)
-
-    def test_update_lb(self):
-        args = self.requests['update_lb']['args']
-        self.manager.cfg_backup_dir = '/path/backup'
-        backup_path = os.path.join(self.manager.cfg_backup_dir,
-                                   'haproxy.cfg_W_M_1_12')
-        deleted_cfg_path = '/etc/haproxy/haproxy.cfg.deleted'
-        new_cfg_path = '/etc/haproxy/haproxy.cfg.new'
-        self.manager._create_lb_deleted_haproxy_cfg = mock.MagicMock(
-            return_value=deleted_cfg_path)
-        self.manager._create_lb_haproxy_cfg = mock.MagicMock(
-            return_value=new_cfg_path)
-        self.manager._test_haproxy_config = mock.MagicMock()
-        self.manager._backup_original_cfg = mock.MagicMock(
-            return_value=(0, backup_path))
-        self.manager._replace_original_cfg_with_new = mock.MagicMock(
-            return_value=(0, None))
-        self.manager._reload_haproxy_cfg = mock.MagicMock(return_value=0)
+        self.manager._create_lb(args)
 
-        self.manager._update_lb(args)
+        self.manager._config_batch.assert_called_once_with(
+            [{'cmd': 'create_lb', 'args': args}])
 
-        self.manager._create_lb_deleted_haproxy_cfg.assert_called_once_with(
-            args)
-        self.manager._create_lb_haproxy_cfg.assert_called_once_with(
-            args, base_cfg_path=deleted_cfg_path)
-        self.manager._test_haproxy_config.assert_called_once_with(new_cfg_path)
-        self.manager._backup_original_cfg.assert_called_once_with()
-        self.manager._replace_original_cfg_with_new.assert_called_once_with(
-            new_cfg_path)
-        self.manager._reload_haproxy_cfg.assert_called_once_with(backup_path)
+    def test_create_lb_with_config_batch_failed(self):
+        args = self.requests['create_lb']['args']
+        self.manager._config_batch = mock.MagicMock(return_value=['error'])
 
-    def test_update_lb_with_create_lb_deleted_haproxy_cfg_failed(self):
-        args = self.requests['update_lb']['args']
-        self.manager._create_lb_deleted_haproxy_cfg = mock.MagicMock(
-            side_effect=exception.HaproxyLBNotExists)
+        self.assertRaises(exception.HaproxyCreateError,
+                          self.manager._create_lb, args)
 
-        self.assertRaises(exception.HaproxyUpdateError,
-                          self.manager._update_lb, args)
+    def test_delete_lb(self):
+        args = self.requests['delete_lb']['args']
+        self.manager._config_batch = mock.MagicMock(return_value=[None])
 
-    def test_update_lb_with_create_lb_haproxy_cfg_failed(self):
-        args = self.requests['update_lb']['args']
-        deleted_cfg_path = '/etc/haproxy/haproxy.cfg.deleted'
-        self.manager._create_lb_deleted_haproxy_cfg = mock.MagicMock(
-            return_value=deleted_cfg_path)
-        self.manager._create_lb_haproxy_cfg = mock.MagicMock(
-            side_effect=exception.HaproxyCreateCfgError)
+        self.manager._delete_lb(args)
 
-        self.assertRaises(exception.HaproxyUpdateError,
-                          self.manager._update_lb, args)
+        self.manager._config_batch.assert_called_once_with(
+            [{'cmd': 'delete_lb', 'args': args}])
 
-    def test_update_lb_with_test_haproxy_config_failed(self):
-        args = self.requests['update_lb']['args']
-        deleted_cfg_path = '/etc/haproxy/haproxy.cfg.deleted'
-        new_cfg_path = '/etc/haproxy/haproxy.cfg.new'
-        self.manager._create_lb_deleted_haproxy_cfg = mock.MagicMock(
-            return_value=deleted_cfg_path)
-        self.manager._create_lb_haproxy_cfg = mock.MagicMock(
-            return_value=new_cfg_path)
-        self.manager._test_haproxy_config = mock.MagicMock(
-            side_effect=exception.ProcessExecutionError)
+    def test_delete_lb_with_config_batch_failed(self):
+        args = self.requests['delete_lb']['args']
+        self.manager._config_batch = mock.MagicMock(return_value=['error'])
 
-        self.assertRaises(exception.HaproxyUpdateError,
-                          self.manager._update_lb, args)
+        self.assertRaises(exception.HaproxyDeleteError,
+                          self.manager._delete_lb, args)
 
-    def test_update_lb_with_backup_original_cfg_failed(self):
+    def test_update_lb(self):
         args = self.requests['update_lb']['args']
-        self.manager._create_lb_deleted_haproxy_cfg = mock.MagicMock()
-        self.manager._create_lb_haproxy_cfg = mock.MagicMock()
-        self.manager._test_haproxy_config = mock.MagicMock()
-        self.manager._backup_original_cfg = mock.MagicMock(
-            return_value=(-1, 'backup failed'))
+        self.manager._config_batch = mock.MagicMock(return_value=[None])
 
-        self.assertRaises(exception.HaproxyUpdateError,
-                          self.manager._update_lb, args)
-
-    def test_update_lb_with_replace_original_cfg_with_new_failed(self):
-        args = self.requests['update_lb']['args']
-        self.manager.cfg_backup_dir = '/path/backup'
-        backup_path = os.path.join(self.manager.cfg_backup_dir,
-                                   'haproxy.cfg_W_M_1_12')
-        self.manager._create_lb_deleted_haproxy_cfg = mock.MagicMock()
-        self.manager._create_lb_haproxy_cfg = mock.MagicMock()
-        self.manager._test_haproxy_config = mock.MagicMock()
-        self.manager._backup_original_cfg = mock.MagicMock(
-            return_value=(0, backup_path))
-        self.manager._replace_original_cfg_with_new = mock.MagicMock(
-            return_value=(-1, 'replace failed'))
+        self.manager._update_lb(args)
 
-        self.assertRaises(exception.HaproxyUpdateError,
-                          self.manager._update_lb, args)
+        self.manager._config_batch.assert_called_once_with(
+            [{'cmd': 'update_lb', 'args': args}])
 
-    def test_update_lb_with_reload_haproxy_cfg_failed(self):
+    def test_update_lb_with_config_batch_failed(self):
         args = self.requests['update_lb']['args']
-        self.manager.cfg_backup_dir = '/path/backup'
-        backup_path = os.path.join(self.manager.cfg_backup_dir,
-                                   'haproxy.cfg_W_M_1_12')
-        deleted_cfg_path = '/etc/haproxy/haproxy.cfg.deleted'
-        new_cfg_path = '/etc/haproxy/haproxy.cfg.new'
-        self.manager._create_lb_deleted_haproxy_cfg = mock.MagicMock(
-            return_value=deleted_cfg_path)
-        self.manager._create_lb_haproxy_cfg = mock.MagicMock(
-            return_value=new_cfg_path)
-        self.manager._test_haproxy_config = mock.MagicMock()
-        self.manager._backup_original_cfg = mock.MagicMock(
-            return_value=(0, backup_path))
-        self.manager._replace_original_cfg_with_new = mock.MagicMock(
-            return_value=(0, None))
-        self.manager._reload_haproxy_cfg = mock.MagicMock(return_value=-1)
+        self.manager._config_batch = mock.MagicMock(return_value=['error'])
 
         self.assertRaises(exception.HaproxyUpdateError,
                           self.manager._update_lb, args)
 
-    def test_validate_request(self):
+    @mock.patch.object(validate, 'check_tcp_request')
+    def test_validate_request(self, check_tcp_request):
         args = self.requests['create_lb']['args']
-        validate.check_tcp_request = mock.MagicMock()
 
         self.manager._validate_request(args)
 
-        validate.check_tcp_request.assert_called_once_with(args)
+        check_tcp_request.assert_called_once_with(args)
 
     def test_get_lb_name(self):
         args = self.requests['create_lb']['args']
@@ -432,106 +539,49 @@ class TestHaproxyConfigurer(unittest.TestCase):
         method = self.manager._create_haproxy_lb_server_directive
         self.assertEqual(expected, method(args))
 
-    @mock.patch('time.asctime', mock.MagicMock(return_value='W_M_1_12'))
     @mock.patch('os.path.join', mock.MagicMock(return_value='/path/to/cfg'))
-    def test_backup_original_cfg(self):
-        backup_filename = 'haproxy.cfg_W_M_1_12'
+    @mock.patch.object(haproxy.fileutils, 'backup')
+    def test_backup_original_cfg(self, backup):
         self.manager.cfg_backup_dir = '/path/backup'
-        utils.execute = mock.MagicMock()
 
         rc, backup_path = self.manager._backup_original_cfg()
 
         self.assertEqual(rc, 0)
         self.assertEqual(backup_path, '/path/to/cfg')
-        cmd = "cp /etc/haproxy/haproxy.cfg /path/to/cfg"
-        utils.execute.assert_called_with(cmd)
+        backup.assert_called_once_with('/etc/haproxy/haproxy.cfg',
+                                       '/path/to/cfg')
 
-    @mock.patch('time.asctime', mock.MagicMock(return_value='W_M_1_12'))
-    @mock.patch('os.path.join', mock.MagicMock(return_value='/path/to/cfg'))
-    def test_backup_original_cfg_with_execute_failed(self):
-        backup_filename = 'haproxy.cfg_W_M_1_12'
+    @mock.patch.object(haproxy.fileutils, 'backup',
+                       mock.MagicMock(side_effect=OSError))
+    def test_backup_original_cfg_with_backup_failed(self):
         self.manager.cfg_backup_dir = '/path/backup'
-        utils.execute = mock.MagicMock(
-            side_effect=exception.ProcessExecutionError)
 
         rc, backup_path = self.manager._backup_original_cfg()
 
         self.assertEqual(rc, -1)
-        cmd = "cp /etc/haproxy/haproxy.cfg /path/to/cfg"
-        utils.execute.assert_called_with(cmd)
 
-    def test_replace_original_cfg_with_new(self):
-        utils.execute = mock.MagicMock()
+    @mock.patch.object(haproxy.fileutils, 'rename')
+    def test_replace_original_cfg_with_new(self, rename):
         new_cfg_path = '/path/to/new_cfg'
-        cmd = "cp /path/to/new_cfg /etc/haproxy/haproxy.cfg"
 
         rc, desc = self.manager._replace_original_cfg_with_new(new_cfg_path)
 
         self.assertEqual(rc, 0)
         self.assertEqual(desc, None)
-        utils.execute.assert_called_once_with(cmd)
+        rename.assert_called_once_with(new_cfg_path,
+                                       '/etc/haproxy/haproxy.cfg')
 
-    def test_replace_original_cfg_with_new_with_execute_failed(self):
+    @mock.patch.object(haproxy.fileutils, 'rename',
+                       mock.MagicMock(side_effect=OSError))
+    def test_replace_original_cfg_with_new_with_rename_failed(self):
         new_cfg_path = '/path/to/new_cfg'
-        cmd = "cp /path/to/new_cfg /etc/haproxy/haproxy.cfg"
-        utils.execute = mock.MagicMock(
-            side_effect=exception.ProcessExecutionError)
 
         rc, desc = self.manager._replace_original_cfg_with_new(new_cfg_path)
 
         self.assertEqual(rc, -1)
-        utils.execute.assert_called_once_with(cmd)
-
-    def test_create_lb_haproxy_cfg(self):
-        args = self.requests['create_lb']['args']
-        base_cfg_path = '/etc/haproxy/haproxy.cfg'
-        new_cfg_path = '/etc/haproxy/haproxy.cfg.new'
-        cmd = "cp %s %s" % (base_cfg_path, new_cfg_path)
-        new_cfg_content = '# haproxy proxy configuation'
-        self.manager._create_haproxy_listen_cfg = mock.MagicMock(
-            return_value=new_cfg_content)
-        utils.execute = mock.MagicMock()
-
-        with mock.patch('__builtin__.open',
-                        return_fake_file(new=True), create=True):
-            rc = self.manager._create_lb_haproxy_cfg(args)
-
-        self.assertEqual(rc, new_cfg_path)
-        self.manager._create_haproxy_listen_cfg.assert_called_once_with(
-            args, base_cfg_path)
-        utils.execute.assert_called_once_with(cmd)
-        fake_file.assert_called_once_with(new_cfg_path, 'a')
-        fake_file().write.assert_called_once_with(new_cfg_content)
-
-    def test_create_lb_haproxy_cfg_with_create_haproxy_listen_cfg_failed(self):
-        args = self.requests['create_lb']['args']
-        self.manager._create_haproxy_listen_cfg = mock.MagicMock(
-            side_effect=exception.HaproxyLBExists)
-
-        self.assertRaises(exception.HaproxyCreateCfgError,
-                          self.manager._create_lb_haproxy_cfg, args)
-
-    def test_create_lb_haproxy_cfg_with_execute_failed(self):
-        args = self.requests['create_lb']['args']
-        self.manager._create_haproxy_listen_cfg = mock.MagicMock()
-        utils.execute = mock.MagicMock(
-            side_effect=exception.ProcessExecutionError)
-
-        self.assertRaises(exception.HaproxyCreateCfgError,
-                          self.manager._create_lb_haproxy_cfg, args)
-
-    @mock.patch('__builtin__.open', mock.MagicMock(side_effect=IOError))
-    def test_create_lb_haproxy_cfg_with_io_failed(self):
-        args = self.requests['create_lb']['args']
-        self.manager._create_haproxy_listen_cfg = mock.MagicMock()
-        utils.execute = mock.MagicMock()
-
-        self.assertRaises(exception.HaproxyCreateCfgError,
-                          self.manager._create_lb_haproxy_cfg, args)
 
-    def test_create_haproxy_listen_cfg(self):
+    def test_format_haproxy_listen_cfg(self):
         args = self.requests['create_lb']['args']
-        base_cfg_path = '/etc/haproxy/haproxy.cfg'
         lb_name = "%s_%s_%s" % (args['user_id'],
                                 args['tenant_id'],
                                 args['uuid'])
@@ -545,11 +595,10 @@ class TestHaproxyConfigurer(unittest.TestCase):
                    for i in range(len(args['instance_uuids']))]
         server_directives = '\n'.join(servers)
         self.manager._get_lb_name = mock.MagicMock(return_value=lb_name)
-        self.manager._is_lb_in_use = mock.MagicMock(return_value=False)
         self.manager._create_haproxy_lb_server_directive = mock.MagicMock(
             return_value=server_directives)
 
-        ret = self.manager._create_haproxy_listen_cfg(args)
+        ret = self.manager._format_haproxy_listen_cfg(args)
 
         bind_ips = self.manager._bind_ip
         bind_directive = ','.join(map(lambda ip: "%s:%s" % (
@@ -561,57 +610,47 @@ class TestHaproxyConfigurer(unittest.TestCase):
                                      server_directives)
         self.assertEqual(expected, ret)
         self.manager._get_lb_name.assert_called_once_with(args)
-        self.manager._is_lb_in_use.assert_called_once_with(lb_name,
-                                                           base_cfg_path)
         ls_server_directive = self.manager._create_haproxy_lb_server_directive
         ls_server_directive.assert_called_once_with(args)
 
-    def test_create_haproxy_listen_cfg_with_is_lb_in_use_failed(self):
+    def test_format_haproxy_listen_cfg_with_policy(self):
         args = self.requests['create_lb']['args']
-        self.manager._get_lb_name = mock.MagicMock()
-        self.manager._is_lb_in_use = mock.MagicMock(return_value=True)
+        args.update({'connect_timeout_ms': 2000,
+                     'server_timeout_ms': 30000,
+                     'retries': 2,
+                     'redispatch': True})
+        self.manager._create_haproxy_lb_server_directive = mock.MagicMock(
+            return_value='\tserver servers')
 
-        self.assertRaises(exception.HaproxyLBExists,
-                          self.manager._create_haproxy_listen_cfg, args)
+        ret = self.manager._format_haproxy_listen_cfg(args)
 
-    def test_create_haproxy_listen_cfg_with_illegal_port(self):
+        self.assertTrue(ret.endswith(
+            '\ttimeout check %sms\n\ttimeout connect 2000ms\n'
+            '\ttimeout server 30000ms\n\tretries 2\n'
+            '\toption redispatch\n\tserver servers' %
+            args['health_check_timeout_ms']))
+        self.assertFalse('timeout client' in ret)
+
+    def test_create_haproxy_lb_server_directive_with_max_fails(self):
+        args = self.requests['create_lb']['args']
+        args['max_fails'] = 3
+
+        ret = self.manager._create_haproxy_lb_server_directive(args)
+
+        for line in ret.split('\n'):
+            self.assertTrue(line.endswith(
+                'fall %s observe layer4 error-limit 3 on-error mark-down' %
+                args['health_check_unhealthy_threshold']))
+
+    def test_format_haproxy_listen_cfg_with_illegal_port(self):
         args = self.requests['create_lb']['args']
         args['listen_port'] = '65535'
         self.manager.listen_port_min = 10000
         self.manager.listen_port_max = 61000
         self.manager._get_lb_name = mock.MagicMock()
-        self.manager._is_lb_in_use = mock.MagicMock(return_value=False)
 
         self.assertRaises(exception.HaproxyCreateError,
-                          self.manager._create_haproxy_listen_cfg, args)
-
-    def test_create_lb_deleted_haproxy_cfg(self):
-        args = self.requests['delete_lb']['args']
-        lb_name = 'user_name_tenant_load_balancer_id'
-        new_cfg_path = '/etc/haproxy/haproxy.cfg.new.lb_deleted'
-        cfg_body = {'listen app1': {'balance source'}}
-        cfg_header = ['global\n\tlog 127.0.0.1\tl0']
-        config = {}
-        config['body'] = cfg_body
-        config['header'] = cfg_header
-        new_config = '''global\n\tlog 127.0.0.1\tl0listen app1balance source'''
-        self.manager._get_lb_name = mock.MagicMock(return_value=lb_name)
-        self.manager._is_lb_in_use = mock.MagicMock(return_value=True)
-        self.manager._format_haproxy_config = mock.MagicMock(
-            return_value=config)
-        self.manager._del_one_lb_info = mock.MagicMock()
-
-        with mock.patch('__builtin__.open',
-                        return_fake_file(new=True), create=True):
-            self.manager._create_lb_deleted_haproxy_cfg(args)
-
-        self.manager._get_lb_name.assert_called_once_with(args)
-        self.manager._is_lb_in_use.assert_called_once_with(lb_name)
-        self.manager._format_haproxy_config.assert_called_once_with()
-        self.manager._del_one_lb_info.assert_called_once_with(config['body'],
-                                                              lb_name)
-        fake_file.assert_called_once_with(new_cfg_path, 'w')
-        fake_file().write.assert_called_once_with(new_config)
+                          self.manager._format_haproxy_listen_cfg, args)
 
     def test_get_haproxy_pid(self):
         with mock.patch('__builtin__.open',
@@ -626,40 +665,530 @@ class TestHaproxyConfigurer(unittest.TestCase):
     def test_get_haproxy_pid_with_value_error(self):
         self.assertRaises(ValueError, self.manager._get_haproxy_pid)
 
-    def test_test_haproxy_config(self):
+    @mock.patch.object(utils, 'execute')
+    def test_test_haproxy_config(self, execute):
         cfg_path = '/path/to/cfg'
-        utils.execute = mock.MagicMock()
 
         self.manager._test_haproxy_config(cfg_path)
 
         cmd = "haproxy -c -f %s" % cfg_path
-        utils.execute.assert_called_with(cmd)
+        execute.assert_called_with(cmd, timeout=60)
+
+    @mock.patch.object(utils, 'execute')
+    def test_test_haproxy_config_with_config_dir(self, execute):
+        self.manager._test_haproxy_config('/path/to/cfg', '/path/to/conf.d')
 
-    def test_test_haproxy_config_with_execute_failed(self):
+        cmd = "haproxy -c -f /path/to/cfg -f /path/to/conf.d"
+        execute.assert_called_with(cmd, timeout=60)
+
+    @mock.patch.object(utils, 'execute')
+    def test_test_haproxy_config_with_execute_failed(self, execute):
         cfg_path = '/path/to/cfg'
-        utils.execute = mock.MagicMock(
-            side_effect=exception.ProcessExecutionError)
+        execute.side_effect = exception.ProcessExecutionError
 
         self.assertRaises(exception.ProcessExecutionError,
                           self.manager._test_haproxy_config, cfg_path)
 
-    def test_reload_haproxy_cfg(self):
+    @mock.patch.object(utils, 'execute')
+    def test_reload_haproxy_cfg(self, execute):
         pid = 12345
         backup_path = '/path/to/cfg'
         self.manager._get_haproxy_pid = mock.MagicMock(return_value=pid)
-        utils.execute = mock.MagicMock()
 
         self.manager._reload_haproxy_cfg(backup_path)
 
         cmd = ("haproxy -f /etc/haproxy/haproxy.cfg -p "
                "/var/run/haproxy.pid -sf %s " % pid)
-        utils.execute.assert_called_with(cmd)
+        execute.assert_called_with(cmd)
+
+    @mock.patch.object(utils, 'execute')
+    def test_reload_haproxy_cfg_with_config_dir(self, execute):
+        pid = 12345
+        self.manager.config_dir = '/etc/haproxy/conf.d'
+        self.manager._get_haproxy_pid = mock.MagicMock(return_value=pid)
+
+        self.manager._reload_haproxy_cfg({})
+
+        cmd = ("haproxy -f /etc/haproxy/haproxy.cfg -f /etc/haproxy/conf.d "
+               "-p /var/run/haproxy.pid -sf %s " % pid)
+        execute.assert_called_with(cmd)
+
+    @mock.patch.object(utils, 'execute')
+    def test_reload_haproxy_cfg_with_seamless_mode(self, execute):
+        pid = 12345
+        self.manager._get_haproxy_pid = mock.MagicMock(return_value=pid)
+        haproxy.FLAGS.set_override('reload_mode', 'seamless', 'haproxy')
+        self.addCleanup(haproxy.FLAGS.clear_override, 'reload_mode',
+                        'haproxy')
+
+        self.assertEqual(self.manager._reload_haproxy_cfg({}), 0)
+
+        cmd = ("haproxy -f /etc/haproxy/haproxy.cfg -p /var/run/haproxy.pid "
+               "-x /var/run/haproxy.sock -sf %s " % pid)
+        execute.assert_called_with(cmd)
+
+    @mock.patch('os.kill')
+    @mock.patch.object(utils, 'execute')
+    def test_reload_haproxy_cfg_with_master_mode(self, execute, kill):
+        pid = 12345
+        self.manager._get_haproxy_pid = mock.MagicMock(return_value=pid)
+        haproxy.FLAGS.set_override('reload_mode', 'master', 'haproxy')
+        self.addCleanup(haproxy.FLAGS.clear_override, 'reload_mode',
+                        'haproxy')
+
+        self.assertEqual(self.manager._reload_haproxy_cfg({}), 0)
+
+        kill.assert_called_once_with(pid, signal.SIGUSR2)
+        self.assertFalse(execute.called)
+
+    @mock.patch.object(utils, 'execute')
+    def test_reload_haproxy_cfg_with_rollback(self, execute):
+        self.manager._get_haproxy_pid = mock.MagicMock(return_value=12345)
+        self.manager._restore_cfg = mock.MagicMock(return_value=True)
+        execute.side_effect = [exception.ProcessExecutionError, None]
+
+        # the original configuration is running again, but the changes
+        # were not applied.
+        self.assertEqual(self.manager._reload_haproxy_cfg({}), -1)
+        self.manager._restore_cfg.assert_called_once_with({})
+        self.assertEqual(execute.call_count, 2)
+
+    def test_reload_haproxy_cfg_with_pid_missing(self):
+        self.manager._get_haproxy_pid = mock.MagicMock(side_effect=IOError)
+        self.manager._restore_cfg = mock.MagicMock(return_value=True)
+
+        self.assertEqual(self.manager._reload_haproxy_cfg('/path/to/cfg'),
+                         -1)
+        self.manager._restore_cfg.assert_called_once_with('/path/to/cfg')
+
+    def _prepare_commit(self):
+        self.manager.config = mock.MagicMock()
+        self.manager._backup_original_cfg = mock.MagicMock(
+            return_value=(0, '/path/to/backup'))
+        self.manager._replace_original_cfg_with_new = mock.MagicMock(
+            return_value=(0, None))
+        self.manager._reload_haproxy_cfg = mock.MagicMock(return_value=0)
+
+    @mock.patch.object(utils, 'delete_if_exists')
+    def test_commit(self, delete_if_exists):
+        self._prepare_commit()
+
+        self.assertEqual(self.manager._commit({'lb': 'listen\tlb'}), None)
+
+        self.manager.config.write.assert_called_once_with(
+            '/etc/haproxy/haproxy.cfg.new', {'lb': 'listen\tlb'})
+        self.manager._replace_original_cfg_with_new.assert_called_once_with(
+            '/etc/haproxy/haproxy.cfg.new')
+        self.manager._reload_haproxy_cfg.assert_called_once_with(
+            '/path/to/backup')
+        self.manager.config.commit.assert_called_once_with(
+            {'lb': 'listen\tlb'})
+        self.assertFalse(delete_if_exists.called)
+
+    @mock.patch.object(utils, 'delete_if_exists')
+    def test_commit_with_write_failed(self, delete_if_exists):
+        self._prepare_commit()
+        self.manager.config.write.side_effect = IOError('disk full')
+
+        self.assertEqual(self.manager._commit({}), 'disk full')
+
+        self.assertFalse(self.manager._backup_original_cfg.called)
+        self.assertFalse(self.manager._reload_haproxy_cfg.called)
+        self.assertFalse(self.manager.config.commit.called)
+
+    @mock.patch.object(utils, 'delete_if_exists')
+    def test_commit_with_backup_failed(self, delete_if_exists):
+        self._prepare_commit()
+        self.manager._backup_original_cfg.return_value = (-1, 'no backup')
+
+        self.assertEqual(self.manager._commit({}), 'no backup')
+
+        # haproxy.cfg was not replaced, and the new file not left behind
+        self.assertFalse(self.manager._replace_original_cfg_with_new.called)
+        delete_if_exists.assert_called_once_with(
+            '/etc/haproxy/haproxy.cfg.new')
+        self.assertFalse(self.manager._reload_haproxy_cfg.called)
+        self.assertFalse(self.manager.config.commit.called)
+
+    @mock.patch.object(utils, 'delete_if_exists')
+    def test_commit_with_replace_failed(self, delete_if_exists):
+        self._prepare_commit()
+        self.manager._replace_original_cfg_with_new.return_value = \
+            (-1, 'no rename')
+
+        self.assertEqual(self.manager._commit({}), 'no rename')
+
+        delete_if_exists.assert_called_once_with(
+            '/etc/haproxy/haproxy.cfg.new')
+        self.assertFalse(self.manager._reload_haproxy_cfg.called)
+        self.assertFalse(self.manager.config.commit.called)
+
+    @mock.patch.object(utils, 'delete_if_exists')
+    def test_commit_with_reload_failed(self, delete_if_exists):
+        self._prepare_commit()
+        self.manager._reload_haproxy_cfg.return_value = -1
 
-    def test_format_haproxy_config(self):
-        pass
+        self.assertEqual(self.manager._commit({}),
+                         'Failed to reload haproxy')
 
-    def test_get_one_lb_info(self):
-        pass
+        # haproxy.cfg was restored from the backup by the reload
+        self.manager._reload_haproxy_cfg.assert_called_once_with(
+            '/path/to/backup')
+        self.assertFalse(self.manager.config.commit.called)
 
-    def test_del_one_lb_info(self):
-        pass
+    def test_commit_without_reload(self):
+        self._prepare_commit()
+
+        self.assertEqual(self.manager._commit({}, reload_haproxy=False),
+                         None)
+
+        self.assertFalse(self.manager._reload_haproxy_cfg.called)
+        self.manager.config.commit.assert_called_once_with({})
+
+
+class HaproxyConfigTestCase(unittest.TestCase):
+
+    def setUp(self):
+        cfg_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cfg_dir)
+        self.path = os.path.join(cfg_dir, 'haproxy.cfg')
+        with open(self.path, 'w') as cfg_file:
+            cfg_file.write('global\n\tdaemon\n\n'
+                           'listen\tlb_b\n\tmode tcp\n\n'
+                           'listen\tlb_a\n\tmode tcp\n')
+        self.config = haproxy.HaproxyConfig(self.path)
+
+    def test_load(self):
+        self.config.ensure_fresh()
+
+        self.assertEqual(self.config.header, 'global\n\tdaemon\n\n')
+        self.assertEqual(sorted(self.config.sections), ['lb_a', 'lb_b'])
+        self.assertEqual(self.config.sections['lb_a'],
+                         'listen\tlb_a\n\tmode tcp\n')
+        self.assertTrue('lb_b' in self.config)
+
+    def test_render(self):
+        self.config.ensure_fresh()
+
+        self.assertEqual(self.config.render(),
+                         'global\n\tdaemon\n'
+                         '\nlisten\tlb_a\n\tmode tcp\n'
+                         '\nlisten\tlb_b\n\tmode tcp\n')
+
+    def test_apply(self):
+        self.config.ensure_fresh()
+        changes = [{'cmd': 'create_lb', 'name': 'lb_c',
+                    'section': 'listen\tlb_c\n'},
+                   {'cmd': 'update_lb', 'name': 'lb_a',
+                    'section': 'listen\tlb_a\n\tmode http\n'},
+                   {'cmd': 'delete_lb', 'name': 'lb_b', 'section': None}]
+
+        sections = self.config.apply(changes)
+
+        self.assertEqual(sorted(sections), ['lb_a', 'lb_c'])
+        self.assertEqual(sections['lb_a'], 'listen\tlb_a\n\tmode http\n')
+        # the model only changes on commit
+        self.assertEqual(sorted(self.config.sections), ['lb_a', 'lb_b'])
+
+    def test_apply_with_conflicts(self):
+        self.config.ensure_fresh()
+
+        self.assertRaises(exception.HaproxyLBExists, self.config.apply,
+                          [{'cmd': 'create_lb', 'name': 'lb_a',
+                            'section': ''}])
+        self.assertRaises(exception.HaproxyLBNotExists, self.config.apply,
+                          [{'cmd': 'update_lb', 'name': 'lb_c',
+                            'section': ''}])
+
+    def test_commit(self):
+        self.config.ensure_fresh()
+        sections = self.config.apply([{'cmd': 'delete_lb', 'name': 'lb_b',
+                                       'section': None}])
+        self.config.write(self.path, sections)
+        self.config.commit(sections)
+        self.config.load = mock.MagicMock()
+
+        self.config.ensure_fresh()
+
+        self.assertFalse(self.config.load.called)
+        self.assertEqual(self.config.sections.keys(), ['lb_a'])
+
+    def test_ensure_fresh_with_file_changed(self):
+        self.config.ensure_fresh()
+        with open(self.path, 'a') as cfg_file:
+            cfg_file.write('\nlisten\tlb_c\n\tmode tcp\n')
+
+        self.config.ensure_fresh()
+
+        self.assertTrue('lb_c' in self.config)
+
+
+class HaproxyConfigDirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.path = os.path.join(root, 'haproxy.cfg')
+        self.config_dir = os.path.join(root, 'conf.d')
+        self.backup_dir = os.path.join(root, 'backup')
+        os.mkdir(self.backup_dir)
+        with open(self.path, 'w') as cfg_file:
+            cfg_file.write('global\n\tdaemon\n\n'
+                           'listen\tlb_b\n\tmode tcp\n')
+        self.config = haproxy.HaproxyConfigDir(self.path, self.config_dir)
+        with open(self.config.section_path('lb_a'), 'w') as cfg_file:
+            cfg_file.write('\nlisten\tlb_a\n\tmode tcp\n')
+
+        self.manager = haproxy.HaproxyConfigurer()
+        self.manager.config_dir = self.config_dir
+        self.manager.config = self.config
+        self.manager.cfg_backup_dir = self.backup_dir
+        self.manager._reload_haproxy_cfg = mock.MagicMock(return_value=0)
+
+    def _read(self, path):
+        with open(path) as cfg_file:
+            return cfg_file.read()
+
+    def test_load(self):
+        self.config.ensure_fresh()
+
+        self.assertEqual(self.config.header, 'global\n\tdaemon\n\n')
+        self.assertEqual(sorted(self.config.sections), ['lb_a', 'lb_b'])
+        self.assertEqual(self.config.inline, set(['lb_b']))
+
+    def test_diff(self):
+        self.config.ensure_fresh()
+        sections = self.config.apply(
+            [{'cmd': 'create_lb', 'name': 'lb_c', 'section': 'listen\tlb_c'},
+             {'cmd': 'delete_lb', 'name': 'lb_a', 'section': None}])
+
+        updated, removed = self.config.diff(sections)
+
+        # lb_b is still in haproxy.cfg, it has to be moved
+        self.assertEqual(sorted(updated), ['lb_b', 'lb_c'])
+        self.assertEqual(removed, ['lb_a'])
+
+    def test_commit(self):
+        self.config.ensure_fresh()
+        sections = self.config.apply(
+            [{'cmd': 'create_lb', 'name': 'lb_c',
+              'section': 'listen\tlb_c\n\tmode tcp\n'},
+             {'cmd': 'delete_lb', 'name': 'lb_a', 'section': None}])
+
+        self.assertEqual(self.manager._commit(sections), None)
+
+        self.assertEqual(self._read(self.path), 'global\n\tdaemon\n\n')
+        self.assertEqual(sorted(os.listdir(self.config_dir)),
+                         ['lb_b.cfg', 'lb_c.cfg'])
+        self.assertEqual(self._read(self.config.section_path('lb_c')),
+                         '\nlisten\tlb_c\n\tmode tcp\n')
+        backups = sorted(os.listdir(self.backup_dir))
+        self.assertEqual(len(backups), 2)
+        self.assertTrue(backups[0].startswith('haproxy.cfg_'))
+        self.assertTrue(backups[1].startswith('lb_a.cfg_'))
+        self.assertEqual(self.config.inline, set())
+        self.assertEqual(self.manager._reload_haproxy_cfg.call_count, 1)
+
+    def test_restore_cfg(self):
+        self.config.ensure_fresh()
+        sections = self.config.apply(
+            [{'cmd': 'create_lb', 'name': 'lb_c', 'section': 'listen\tlb_c'},
+             {'cmd': 'delete_lb', 'name': 'lb_a', 'section': None}])
+        backups = dict()
+
+        def reload_haproxy_cfg(backup):
+            backups.update(backup)
+            return -1
+
+        self.manager._reload_haproxy_cfg = mock.MagicMock(
+            side_effect=reload_haproxy_cfg)
+
+        self.assertNotEqual(self.manager._commit(sections), None)
+        self.assertTrue(self.manager._restore_cfg(backups))
+
+        self.assertEqual(self._read(self.path),
+                         'global\n\tdaemon\n\nlisten\tlb_b\n\tmode tcp\n')
+        self.assertEqual(os.listdir(self.config_dir), ['lb_a.cfg'])
+
+    def _changes(self):
+        self.config.ensure_fresh()
+        return self.config.apply(
+            [{'cmd': 'create_lb', 'name': 'lb_c',
+              'section': 'listen\tlb_c\n\tmode tcp\n'},
+             {'cmd': 'delete_lb', 'name': 'lb_a', 'section': None}])
+
+    def _assert_unchanged(self):
+        self.assertEqual(self._read(self.path),
+                         'global\n\tdaemon\n\nlisten\tlb_b\n\tmode tcp\n')
+        # no partial or temporary file left behind
+        self.assertEqual(os.listdir(self.config_dir), ['lb_a.cfg'])
+        self.assertEqual(self._read(self.config.section_path('lb_a')),
+                         '\nlisten\tlb_a\n\tmode tcp\n')
+        self.assertEqual(sorted(self.config.sections), ['lb_a', 'lb_b'])
+        self.assertEqual(self.config.inline, set(['lb_b']))
+
+    def test_commit_with_backup_failed(self):
+        sections = self._changes()
+
+        with mock.patch.object(haproxy.fileutils, 'backup',
+                               mock.MagicMock(side_effect=OSError('ro'))):
+            self.assertEqual(self.manager._commit(sections), 'ro')
+
+        self._assert_unchanged()
+        self.assertFalse(self.manager._reload_haproxy_cfg.called)
+
+    def test_commit_with_write_failed(self):
+        sections = self._changes()
+        write_section = self.config.write_section
+
+        def fail_on_lb_c(cfg_path, section):
+            if cfg_path == self.config.section_path('lb_c'):
+                raise IOError('disk full')
+            write_section(cfg_path, section)
+
+        self.config.write_section = mock.MagicMock(side_effect=fail_on_lb_c)
+
+        self.assertEqual(self.manager._commit(sections), 'disk full')
+
+        self._assert_unchanged()
+        self.assertFalse(self.manager._reload_haproxy_cfg.called)
+
+    def test_commit_with_remove_failed(self):
+        sections = self._changes()
+        remove = os.remove
+
+        def fail_on_lb_a(path):
+            if path == self.config.section_path('lb_a'):
+                raise OSError('busy')
+            remove(path)
+
+        with mock.patch('os.remove', mock.MagicMock(side_effect=fail_on_lb_a)):
+            self.assertEqual(self.manager._commit(sections), 'busy')
+
+        self._assert_unchanged()
+        self.assertFalse(self.manager._reload_haproxy_cfg.called)
+
+    def test_commit_with_reload_failed(self):
+        sections = self._changes()
+        del self.manager._reload_haproxy_cfg
+        self.manager._get_haproxy_pid = mock.MagicMock(return_value=12345)
+        self.manager._load_haproxy_cfg = mock.MagicMock(
+            side_effect=[exception.ProcessExecutionError, None])
+
+        self.assertEqual(self.manager._commit(sections),
+                         'Failed to reload haproxy')
+
+        self._assert_unchanged()
+        # loaded again with the restored configuration
+        self.assertEqual(self.manager._load_haproxy_cfg.call_count, 2)
+
+    def test_commit_with_pid_missing(self):
+        sections = self._changes()
+        del self.manager._reload_haproxy_cfg
+        self.manager._get_haproxy_pid = mock.MagicMock(side_effect=IOError)
+
+        self.assertEqual(self.manager._commit(sections),
+                         'Failed to reload haproxy')
+
+        self._assert_unchanged()
+
+    def test_stage_config(self):
+        with open(self.config.section_path('lb_d'), 'w') as cfg_file:
+            cfg_file.write('\nlisten\tlb_d\n\tmode tcp\n')
+        self.config.ensure_fresh()
+        self.config.inline = set()
+        sections = self.config.apply(
+            [{'cmd': 'create_lb', 'name': 'lb_c', 'section': 'listen\tlb_c'},
+             {'cmd': 'delete_lb', 'name': 'lb_d', 'section': None}])
+
+        cfg_paths = self.manager._stage_config(sections)
+
+        stage_dir = '%s.new' % self.config_dir
+        self.assertEqual(cfg_paths, [self.path, stage_dir])
+        # the live files, with the changed ones replaced and the deleted
+        # ones left out
+        self.assertEqual(sorted(os.listdir(stage_dir)),
+                         ['lb_a.cfg', 'lb_b.cfg', 'lb_c.cfg'])
+        self.assertEqual(
+            os.readlink(os.path.join(stage_dir, 'lb_a.cfg')),
+            self.config.section_path('lb_a'))
+        self.assertEqual(self._read(os.path.join(stage_dir, 'lb_c.cfg')),
+                         '\nlisten\tlb_c\n')
+
+    def test_stage_config_with_inline_sections(self):
+        self.config.ensure_fresh()
+        sections = self.config.apply(
+            [{'cmd': 'delete_lb', 'name': 'lb_a', 'section': None}])
+        self.config.write_header = mock.MagicMock()
+
+        cfg_paths = self.manager._stage_config(sections)
+
+        stage_dir = '%s.new' % self.config_dir
+        self.assertEqual(cfg_paths, ['/etc/haproxy/haproxy.cfg.new',
+                                     stage_dir])
+        self.config.write_header.assert_called_once_with(
+            '/etc/haproxy/haproxy.cfg.new')
+        # lb_b moves out of haproxy.cfg
+        self.assertEqual(os.listdir(stage_dir), ['lb_b.cfg'])
+        self.assertFalse(os.path.islink(os.path.join(stage_dir, 'lb_b.cfg')))
+
+
+class HaproxyRuntimeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        sock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, sock_dir)
+        self.path = os.path.join(sock_dir, 'haproxy.sock')
+        self.commands = []
+        self.responses = []
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen(1)
+        self.addCleanup(self.server.close)
+        self.runtime = haproxy.HaproxyRuntime(self.path, timeout=1)
+
+    def _serve(self, *responses):
+        """Answer one connection per response, like the stats socket."""
+        def serve():
+            for response in responses:
+                conn, _addr = self.server.accept()
+                self.commands.append(conn.makefile().readline().strip())
+                conn.sendall(response)
+                conn.close()
+
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(thread.join, 1)
+
+    def test_set_server_addr(self):
+        self._serve("IP changed from '0.0.0.0' to '10.1.2.3' by "
+                    "'stats socket command'\n")
+
+        self.runtime.set_server_addr('lb', 'slot0', '10.1.2.3')
+
+        self.assertEqual(self.commands,
+                         ['set server lb/slot0 addr 10.1.2.3'])
+
+    def test_set_server_state(self):
+        self._serve('\n', '\n')
+
+        self.runtime.set_server_state('lb', 'slot0', 'drain')
+        self.runtime.set_server_state('lb', 'slot0', 'maint')
+
+        self.assertEqual(self.commands,
+                         ['set server lb/slot0 state drain',
+                          'set server lb/slot0 state maint'])
+
+    def test_set_server_state_with_error(self):
+        self._serve('No such server.\n')
+
+        self.assertRaises(exception.HaproxyRuntimeError,
+                          self.runtime.set_server_state,
+                          'lb', 'slot9', 'ready')
+
+    def test_execute_with_socket_missing(self):
+        runtime = haproxy.HaproxyRuntime(self.path + '.missing', timeout=1)
+
+        self.assertRaises(exception.HaproxyRuntimeError,
+                          runtime.execute, 'show info')
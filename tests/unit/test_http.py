@@ -1,4 +1,5 @@
 import copy
+import datetime
 import mox
 import unittest
 
@@ -7,15 +8,25 @@ from nozzle.db.sqlalchemy import models
 from nozzle.common import context
 from nozzle.common import exception
 from nozzle.common import utils
+from nozzle.server import resolver
 from nozzle.server import state
 from nozzle.server.protocol import http
 
 
+class FakeResolver(object):
+
+    def resolve(self, instance_uuids, strict=True):
+        return dict([(uuid, 'ip-of-%s' % uuid) for uuid in instance_uuids])
+
+
 class HttpTestCase(unittest.TestCase):
 
     def setUp(self):
         super(HttpTestCase, self).setUp()
         self.mox = mox.Mox()
+        self.now = datetime.datetime(2013, 1, 1)
+        self.mox.stubs.Set(resolver, 'get_resolver', FakeResolver)
+        self.mox.stubs.Set(utils, 'utcnow', lambda: self.now)
         self.load_balancer_id = '123'
         self.uuid = 'lb-uuid-1'
         self.name = 'test-lb-1'
@@ -117,6 +128,8 @@ class HttpTestCase(unittest.TestCase):
             association_values = {
                 'load_balancer_id': self.load_balancer_id,
                 'instance_uuid': uuid,
+                'instance_ip': 'ip-of-%s' % uuid,
+                'instance_ip_resolved_at': self.now,
             }
             association_ref = models.LoadBalancerInstanceAssociation()
             association_ref.update(association_values)
@@ -233,6 +246,99 @@ class HttpTestCase(unittest.TestCase):
                           http.create_load_balancer,
                           self.ctxt, **self.create_kwargs)
 
+    def test_create_load_balancer_with_invalid_keepalive(self):
+        invalid_configs = [
+            ('keepalive_connections', -1),
+            ('keepalive_connections', 1025),
+            ('keepalive_connections', '32'),
+            ('keepalive_timeout_ms', 999),
+            ('keepalive_requests', 0),
+        ]
+        for key, value in invalid_configs:
+            config = copy.deepcopy(self.config)
+            config[key] = value
+            self.create_kwargs['config'] = config
+            self.assertRaises(exception.InvalidParameter,
+                              http.create_load_balancer,
+                              self.ctxt, **self.create_kwargs)
+
+    def test_create_load_balancer_with_invalid_policy(self):
+        invalid_configs = [
+            ('connect_timeout_ms', 99),
+            ('server_timeout_ms', 3600001),
+            ('retries', -1),
+            ('max_fails', '3'),
+            ('next_upstream', ''),
+            ('next_upstream', 'error http_501'),
+            ('next_upstream', 'error off'),
+            ('next_upstream', ['error']),
+        ]
+        for key, value in invalid_configs:
+            config = copy.deepcopy(self.config)
+            config[key] = value
+            self.create_kwargs['config'] = config
+            self.assertRaises(exception.InvalidParameter,
+                              http.create_load_balancer,
+                              self.ctxt, **self.create_kwargs)
+
+    def test_update_load_balancer_config_with_policy(self):
+        update_kwargs = copy.deepcopy(self.delete_kwargs)
+        update_kwargs['config'] = copy.deepcopy(self.config)
+        update_kwargs['config'].update({'server_timeout_ms': 30000,
+                                        'retries': 1,
+                                        'next_upstream': ' error  timeout'})
+        config_values = copy.deepcopy(self.config)
+        config_values.update({'server_timeout_ms': 30000,
+                              'retries': 1,
+                              'next_upstream': 'error timeout'})
+
+        self.mox.StubOutWithMock(db, 'load_balancer_get_by_uuid')
+        self.mox.StubOutWithMock(db, 'load_balancer_config_create')
+        self.mox.StubOutWithMock(db, 'load_balancer_config_destroy')
+        self.mox.StubOutWithMock(db, 'load_balancer_update_state')
+
+        load_balancer_ref = self.lb_ref
+        load_balancer_ref.config = self.config_ref
+        db.load_balancer_get_by_uuid(
+            self.ctxt, self.uuid).AndReturn(load_balancer_ref)
+        db.load_balancer_config_destroy(
+            self.ctxt, load_balancer_ref.config.id).AndReturn(None)
+        db.load_balancer_config_create(
+            self.ctxt, config_values).AndReturn(self.config_ref)
+        db.load_balancer_update_state(
+            self.ctxt, self.uuid, state.UPDATING).AndReturn(None)
+        self.mox.ReplayAll()
+        r = http.update_load_balancer_config(self.ctxt, **update_kwargs)
+        self.mox.VerifyAll()
+        self.assertEqual(r, None)
+
+    def test_update_load_balancer_config_with_keepalive(self):
+        update_kwargs = copy.deepcopy(self.delete_kwargs)
+        update_kwargs['config'] = copy.deepcopy(self.config)
+        update_kwargs['config']['keepalive_connections'] = 32
+        config_values = copy.deepcopy(self.config)
+        config_values['keepalive_connections'] = 32
+
+        self.mox.StubOutWithMock(db, 'load_balancer_get_by_uuid')
+        self.mox.StubOutWithMock(db, 'load_balancer_config_create')
+        self.mox.StubOutWithMock(db, 'load_balancer_config_destroy')
+        self.mox.StubOutWithMock(db, 'load_balancer_update_state')
+
+        load_balancer_ref = self.lb_ref
+        load_balancer_ref.config = self.config_ref
+        db.load_balancer_get_by_uuid(
+            self.ctxt, self.uuid).AndReturn(load_balancer_ref)
+        db.load_balancer_config_destroy(
+            self.ctxt, load_balancer_ref.config.id).AndReturn(None)
+        db.load_balancer_config_create(
+            self.ctxt, config_values).AndReturn(self.config_ref)
+        db.load_balancer_update_state(
+            self.ctxt, self.uuid, state.UPDATING).AndReturn(None)
+        self.mox.ReplayAll()
+        r = http.update_load_balancer_config(self.ctxt, **update_kwargs)
+        self.mox.VerifyAll()
+        self.assertEqual(r, None)
+
     def test_update_load_balancer_config(self):
         update_kwargs = copy.deepcopy(self.delete_kwargs)
         update_kwargs['config'] = self.config
@@ -312,6 +418,8 @@ class HttpTestCase(unittest.TestCase):
             association_values = {
                 'load_balancer_id': load_balancer_ref.id,
                 'instance_uuid': instance_uuid,
+                'instance_ip': 'ip-of-%s' % instance_uuid,
+                'instance_ip_resolved_at': self.now,
             }
             db.load_balancer_instance_association_create(
                 self.ctxt, association_values).AndReturn(None)
@@ -0,0 +1,56 @@
+import threading
+import unittest
+
+from nozzle.worker import lane
+
+
+class LaneTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(LaneTestCase, self).setUp()
+        self.batches = []
+        self.lane = lane.Lane('tcp', self._handler, 2)
+
+    def _handler(self, changes):
+        self.batches.append(changes)
+        if 'bad' in changes:
+            raise ValueError('bad change')
+
+    def test_changes_are_handled_in_order(self):
+        self.lane.put(['a', 'b', 'c'])
+        self.lane.start()
+        self.lane.join()
+
+        self.assertEqual(self.batches, [['a', 'b'], ['c']])
+        stats = self.lane.get_stats()
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['batches'], 2)
+        self.assertTrue(stats['latency_max'] >= stats['latency_avg'] >= 0)
+
+    def test_lane_survives_handler_failure(self):
+        self.lane.start()
+        self.lane.put(['bad'])
+        self.lane.join()
+        self.lane.put(['a'])
+        self.lane.join()
+
+        self.assertEqual(self.batches, [['bad'], ['a']])
+
+    def test_lanes_do_not_wait_on_each_other(self):
+        blocked = threading.Event()
+        slow_lane = lane.Lane('http', lambda changes: blocked.wait(), 2)
+        slow_lane.start()
+        slow_lane.put(['slow'])
+        self.lane.start()
+        self.lane.put(['a'])
+        self.lane.join()
+
+        self.assertEqual(self.batches, [['a']])
+        self.assertEqual(slow_lane.get_stats()['batches'], 0)
+        blocked.set()
+        slow_lane.join()
+
+    def test_get_stats_without_changes(self):
+        self.assertEqual(self.lane.get_stats(),
+                         {'queue_depth': 0, 'batches': 0,
+                          'latency_avg': 0.0, 'latency_max': 0.0})
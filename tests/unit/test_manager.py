@@ -0,0 +1,63 @@
+import mock
+import unittest
+
+from nozzle.openstack.common import jsonutils
+
+from nozzle.server import api
+from nozzle.server import manager
+
+
+class ClientRoutineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(ClientRoutineTestCase, self).setUp()
+        self.handler = mock.MagicMock()
+        self.broadcast = mock.MagicMock()
+        self.envelope = ['client-identity', '']
+
+    def _handle(self, msg_body):
+        manager._handle_client_request(self.handler, self.broadcast,
+                                       self.envelope, 'lb', 'msg-uuid',
+                                       jsonutils.dumps(msg_body))
+        frames = self.handler.send_multipart.call_args[0][0]
+        self.assertEqual(frames[:2], self.envelope)
+        self.assertEqual(frames[2:4], ['lb', 'msg-uuid'])
+        return jsonutils.loads(frames[4])
+
+    @mock.patch.object(api, 'get_msg_to_worker',
+                       mock.MagicMock(return_value=None))
+    def test_reply_is_routed_by_envelope(self):
+        api.fake_method = mock.MagicMock(return_value={'data': 'x'})
+        try:
+            response = self._handle({'method': 'fake_method',
+                                     'args': {'tenant_id': 'a'}})
+        finally:
+            del api.fake_method
+        self.assertEqual(response['code'], 200)
+        self.assertEqual(response['data'], 'x')
+        self.assertFalse(self.broadcast.send.called)
+
+    def test_reply_on_failure(self):
+        response = self._handle({'method': 'no_such_method', 'args': {}})
+        self.assertEqual(response['code'], 500)
+
+
+class CheckerTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        manager.FLAGS.clear_override('checker_batch_size')
+        super(CheckerTestCase, self).tearDown()
+
+    @mock.patch.object(manager.db, 'load_balancer_get_all_by_states')
+    def test_get_load_balancers_by_states_in_pages(self, get_all):
+        manager.FLAGS.set_override('checker_batch_size', 2)
+        refs = [mock.MagicMock(id=i) for i in range(3)]
+        get_all.side_effect = [refs[:2], refs[2:]]
+
+        result = list(manager._get_load_balancers_by_states('ctxt',
+                                                            ['creating']))
+
+        self.assertEqual(result, refs)
+        self.assertEqual(get_all.call_args_list, [
+            mock.call('ctxt', ['creating'], batch_size=2, marker=None),
+            mock.call('ctxt', ['creating'], batch_size=2, marker=1)])
@@ -2,7 +2,9 @@ import unittest
 import copy
 import mock
 import os
+import shutil
 import subprocess
+import tempfile
 
 from nozzle.common import exception
 from nozzle.common import utils
@@ -85,31 +87,257 @@ class TestConfigureNginx(unittest.TestCase):
             self.assertRaises(exception.NginxConfigureError,
                               self.manager.do_config, self.requests[method])
 
-    def test_reload_http_ngx_cfg(self):
-        utils.execute = mock.MagicMock()
+    @mock.patch('lockfile.FileLock', mock.MagicMock())
+    @mock.patch('os.path.exists', mock.MagicMock(return_value=False))
+    @mock.patch('os.path.realpath', lambda path: path)
+    @mock.patch('os.listdir', mock.MagicMock(return_value=['lb-1']))
+    @mock.patch('os.symlink', mock.MagicMock())
+    @mock.patch.object(nginx.fileutils, 'write_atomic')
+    def test_do_config_batch(self, write_atomic):
+        good = return_create_lb_request()
+        bad = return_update_lb_request()
+        bad['args']['uuid'] = 'badLB'
+        staged_dir = '/etc/nginx/sites-staged/'
+        staged = []
+
+        def test_main(sites_dir, suffix, hash_path=None):
+            self.assertEqual((sites_dir, suffix), (staged_dir, 'staged'))
+            if staged_dir + 'badLB' in staged:
+                raise exception.ProcessExecutionError
+            return True
+
+        self.manager._clear_sites_dir = mock.MagicMock(
+            side_effect=lambda sites_dir: staged.__delitem__(slice(None)))
+        write_atomic.side_effect = lambda path, cfg: staged.append(path)
+        self.manager._test_main_ngx_cfg = mock.MagicMock(
+            side_effect=test_main)
+        self.manager._save_http_ngx_cfg = mock.MagicMock(
+            side_effect=lambda msg: msg['uuid'])
+        self.manager._restore_http_ngx_cfg = mock.MagicMock()
+        self.manager._write_http_ngx_cfg = mock.MagicMock()
+        self.manager._test_http_ngx_cfg = mock.MagicMock()
+        self.manager._reload_http_ngx_cfg = mock.MagicMock()
 
-        self.manager._reload_http_ngx_cfg()
+        results = self.manager.do_config_batch([good, bad])
 
-        utils.execute.assert_called_once_with('nginx -s reload')
+        self.assertEqual(results[0], None)
+        self.assertNotEqual(results[1], None)
+        # only tested staged, the enabled sites were not touched then
+        for call in write_atomic.call_args_list:
+            self.assertTrue(call[0][0].startswith(staged_dir))
+        self.assertFalse(self.manager._test_http_ngx_cfg.called)
+        self.assertFalse(self.manager._restore_http_ngx_cfg.called)
+        self.manager._write_http_ngx_cfg.assert_called_once_with(good['args'])
+        self.manager._reload_http_ngx_cfg.assert_called_once_with()
 
-    def test_reload_http_ngx_cfg_with_exec_failed(self):
-        utils.execute = mock.MagicMock(
+    @mock.patch('lockfile.FileLock', mock.MagicMock())
+    def test_do_config_batch_without_staged_test(self):
+        self.manager._test_staged_http_ngx_cfg = mock.MagicMock(
+            return_value=False)
+        self.manager._save_http_ngx_cfg = mock.MagicMock(return_value='saved')
+        self.manager._restore_http_ngx_cfg = mock.MagicMock()
+        self.manager._apply_change = mock.MagicMock()
+        self.manager._test_http_ngx_cfg = mock.MagicMock(
             side_effect=exception.ProcessExecutionError)
+        self.manager._reload_http_ngx_cfg = mock.MagicMock()
+
+        results = self.manager.do_config_batch([return_update_lb_request()])
+
+        self.assertNotEqual(results[0], None)
+        # applied to test the whole configuration, and restored
+        self.manager._restore_http_ngx_cfg.assert_called_once_with('saved')
+        self.assertFalse(self.manager._reload_http_ngx_cfg.called)
+
+    @mock.patch('lockfile.FileLock', mock.MagicMock())
+    @mock.patch('os.path.lexists', mock.MagicMock(return_value=True))
+    def test_do_config_batch_with_noop(self):
+        request = return_update_lb_request()
+        ngx_cfg = self.manager._create_http_ngx_cfg_buffer(request['args'])
+        self.manager._digests['testLB'] = nginx._digest(ngx_cfg)
+        self.manager._apply_change = mock.MagicMock()
+        self.manager._test_http_ngx_cfg = mock.MagicMock()
+        self.manager._reload_http_ngx_cfg = mock.MagicMock()
+
+        results = self.manager.do_config_batch([request])
+
+        self.assertEqual(results, [None])
+        self.assertFalse(self.manager._apply_change.called)
+        self.assertFalse(self.manager._test_http_ngx_cfg.called)
+        self.assertFalse(self.manager._reload_http_ngx_cfg.called)
+        self.assertEqual(self.manager.stats, {'changes': 1, 'skipped': 1})
+
+    @mock.patch('os.path.lexists', mock.MagicMock(return_value=True))
+    def test_is_noop_with_changed_cfg(self):
+        request = return_update_lb_request()
+        self.manager._digests['testLB'] = nginx._digest('old')
+
+        self.assertFalse(self.manager._is_noop('update_lb', request['args']))
+
+    @mock.patch('os.path.lexists', mock.MagicMock(return_value=False))
+    @mock.patch('os.path.exists', mock.MagicMock(return_value=False))
+    def test_is_noop_with_deleted_lb(self):
+        request = return_delete_lb_request()
+
+        self.assertTrue(self.manager._is_noop('delete_lb', request['args']))
+
+    @mock.patch('lockfile.FileLock', mock.MagicMock())
+    def test_do_config_batch_with_scoped_validation(self):
+        nginx.FLAGS.set_override('validation', 'scoped', 'nginx')
+        self.addCleanup(nginx.FLAGS.clear_override, 'validation', 'nginx')
+        self.manager._save_http_ngx_cfg = mock.MagicMock(return_value='saved')
+        self.manager._restore_http_ngx_cfg = mock.MagicMock()
+        self.manager._apply_change = mock.MagicMock()
+        self.manager._test_scoped_http_ngx_cfg = mock.MagicMock()
+        self.manager._test_staged_http_ngx_cfg = mock.MagicMock(
+            return_value=True)
+        self.manager._reload_http_ngx_cfg = mock.MagicMock()
+
+        self.manager.do_config_batch([return_update_lb_request()])
+        self.manager.do_config_batch([return_update_lb_request()])
+
+        # the whole configuration is only tested for the first batch
+        self.assertEqual(self.manager._test_scoped_http_ngx_cfg.call_count,
+                         2)
+        self.assertEqual(
+            self.manager._test_staged_http_ngx_cfg.call_count, 1)
+        self.assertEqual(self.manager._reload_http_ngx_cfg.call_count, 2)
+
+    def test_lint_changes(self):
+        request = return_update_lb_request()
+        request['args']['dns_names'] = [u'abc.lb.com.cn;']
+        changes = [{'cmd': 'update_lb', 'msg': request['args']}]
+
+        self.assertEqual(self.manager._lint_changes(changes),
+                         'Invalid server_name: abc.lb.com.cn;')
+
+    @mock.patch('os.path.exists', mock.MagicMock(return_value=False))
+    def test_lint_changes_with_duplicate_create(self):
+        request = return_create_lb_request()
+        changes = [{'cmd': 'create_lb', 'msg': request['args']},
+                   {'cmd': 'create_lb', 'msg': request['args']}]
+
+        self.assertNotEqual(self.manager._lint_changes(changes), None)
+        self.assertEqual(self.manager._lint_changes(changes[:1]), None)
+
+    @mock.patch('lockfile.FileLock', mock.MagicMock())
+    def test_do_config_batch_with_reload_failed(self):
+        self.manager._save_http_ngx_cfg = mock.MagicMock(return_value='saved')
+        self.manager._restore_http_ngx_cfg = mock.MagicMock()
+        self.manager._apply_change = mock.MagicMock()
+        self.manager._test_staged_http_ngx_cfg = mock.MagicMock(
+            return_value=True)
+        self.manager._reload_http_ngx_cfg = mock.MagicMock(
+            side_effect=exception.ProcessExecutionError)
+
+        results = self.manager.do_config_batch([return_create_lb_request()])
+
+        self.assertNotEqual(results[0], None)
+        self.manager._restore_http_ngx_cfg.assert_called_once_with('saved')
+
+    @mock.patch('lockfile.FileLock', mock.MagicMock())
+    def test_do_bootstrap(self):
+        request = return_create_lb_request()
+        bad = return_create_lb_request()
+        bad['args']['uuid'] = 'badLB'
+        stale = '212269a0-8f4f-11e1-acdf-001c234d5fd1'
+
+        def validate_request(request):
+            if request is bad:
+                raise exception.BadRequest
+
+        self.manager._validate_request = mock.MagicMock(
+            side_effect=validate_request)
+        self.manager._test_staged_http_ngx_cfg = mock.MagicMock(
+            return_value=True)
+        self.manager._save_http_ngx_cfg = mock.MagicMock()
+        self.manager._write_http_ngx_cfg = mock.MagicMock()
+        self.manager._delete_http_ngx_cfg = mock.MagicMock()
+        self.manager._reload_http_ngx_cfg = mock.MagicMock()
+
+        with mock.patch('os.listdir',
+                        mock.MagicMock(return_value=['default', 'testLB',
+                                                     stale])):
+            failed = self.manager.do_bootstrap([request, bad])
+
+        self.assertEqual(failed.keys(), ['badLB'])
+        self.manager._test_staged_http_ngx_cfg.assert_called_once_with(
+            [{'cmd': 'update_lb', 'msg': request['args']},
+             {'cmd': 'delete_lb', 'msg': {'uuid': stale}}])
+        self.manager._write_http_ngx_cfg.assert_called_once_with(
+            request['args'])
+        self.manager._delete_http_ngx_cfg.assert_called_once_with(
+            {'uuid': stale})
+        self.manager._reload_http_ngx_cfg.assert_called_once_with()
+
+    @mock.patch('lockfile.FileLock', mock.MagicMock())
+    def test_do_bootstrap_with_test_ngx_cfg_failed(self):
+        request = return_create_lb_request()
+        broken = return_create_lb_request()
+        broken['args']['uuid'] = 'brokenLB'
+        other = return_create_lb_request()
+        other['args']['uuid'] = 'otherLB'
+
+        def test_staged(changes):
+            if broken['args'] in [change['msg'] for change in changes]:
+                raise exception.ProcessExecutionError
+            return True
+
+        self.manager._test_staged_http_ngx_cfg = mock.MagicMock(
+            side_effect=test_staged)
+        self.manager._save_http_ngx_cfg = mock.MagicMock()
+        self.manager._write_http_ngx_cfg = mock.MagicMock()
+        self.manager._reload_http_ngx_cfg = mock.MagicMock()
+
+        with mock.patch('os.listdir', mock.MagicMock(return_value=[])):
+            failed = self.manager.do_bootstrap([request, broken, other])
+
+        # the broken load balancer is left out, the others are applied
+        self.assertEqual(failed.keys(), ['brokenLB'])
+        self.assertEqual(self.manager._write_http_ngx_cfg.call_args_list,
+                         [mock.call(request['args']),
+                          mock.call(other['args'])])
+        self.manager._reload_http_ngx_cfg.assert_called_once_with()
+
+    @mock.patch('lockfile.FileLock', mock.MagicMock())
+    def test_do_bootstrap_with_reload_failed(self):
+        self.manager._test_staged_http_ngx_cfg = mock.MagicMock(
+            return_value=True)
+        self.manager._save_http_ngx_cfg = mock.MagicMock(return_value='saved')
+        self.manager._restore_http_ngx_cfg = mock.MagicMock()
+        self.manager._write_http_ngx_cfg = mock.MagicMock()
+        self.manager._reload_http_ngx_cfg = mock.MagicMock(
+            side_effect=exception.ProcessExecutionError)
+
+        with mock.patch('os.listdir', mock.MagicMock(return_value=[])):
+            self.assertRaises(exception.NginxConfigureError,
+                              self.manager.do_bootstrap,
+                              [return_create_lb_request()])
+        self.manager._restore_http_ngx_cfg.assert_called_once_with('saved')
+
+    @mock.patch.object(utils, 'execute')
+    def test_reload_http_ngx_cfg(self, execute):
+        self.manager._reload_http_ngx_cfg()
+
+        execute.assert_called_once_with('nginx -s reload')
+
+    @mock.patch.object(utils, 'execute')
+    def test_reload_http_ngx_cfg_with_exec_failed(self, execute):
+        execute.side_effect = exception.ProcessExecutionError
 
         self.assertRaises(exception.ProcessExecutionError,
                           self.manager._reload_http_ngx_cfg)
 
-    def test_delete_http_ngx_cfg(self):
+    @mock.patch.object(utils, 'backup_config')
+    @mock.patch.object(utils, 'delete_if_exists')
+    def test_delete_http_ngx_cfg(self, delete_if_exists, backup_config):
         args = self.requests['delete_lb']['args']
         confname = self.manager._conf_file_name(args)
-        utils.delete_if_exists = mock.MagicMock()
-        utils.backup_config = mock.MagicMock()
 
         self.manager._delete_http_ngx_cfg(args)
 
-        utils.delete_if_exists.assert_called_once_with(
+        delete_if_exists.assert_called_once_with(
             '/etc/nginx/sites-enabled/%s' % confname)
-        utils.backup_config.assert_called_once_with(
+        backup_config.assert_called_once_with(
             '/etc/nginx/sites-available/%s' % confname,
             self.manager.backup_dir)
 
@@ -168,6 +396,83 @@ server {
 
         self.assertEquals(server_directive, expected)
 
+    @mock.patch.object(nginx.LOG, 'warn')
+    def test_create_ngx_directives_with_keepalive(self, warn):
+        args = self.requests['create_lb']['args']
+        args['keepalive_connections'] = 32
+        args['keepalive_timeout_ms'] = 30000
+        ngx_upstream_name = self.manager._upstream_name(args)
+
+        upstream_directive = self.manager._create_ngx_upstream_directive(
+            ngx_upstream_name, args)
+        server_directive = self.manager._create_ngx_server_directive(
+            ngx_upstream_name, args)
+
+        self.assertTrue(upstream_directive.endswith(
+            'fail_timeout=10s;\n\tkeepalive 32;\n}\n'))
+        # keepalive_timeout_ms needs upstream_keepalive_limits
+        self.assertTrue(warn.called)
+        self.assertTrue('proxy_http_version 1.1;' in server_directive)
+        self.assertTrue('proxy_set_header Connection "";' in server_directive)
+
+    def test_create_ngx_upstream_directive_with_keepalive_limits(self):
+        nginx.FLAGS.set_override('upstream_keepalive_limits', True, 'nginx')
+        self.addCleanup(nginx.FLAGS.clear_override,
+                        'upstream_keepalive_limits', 'nginx')
+        args = self.requests['create_lb']['args']
+        args['keepalive_connections'] = 32
+        args['keepalive_timeout_ms'] = 30000
+
+        with mock.patch.object(nginx.LOG, 'warn') as warn:
+            upstream_directive = self.manager._create_ngx_upstream_directive(
+                self.manager._upstream_name(args), args)
+
+        self.assertTrue(upstream_directive.endswith(
+            'fail_timeout=10s;\n\tkeepalive 32;\n'
+            '\tkeepalive_timeout 30000ms;\n\tkeepalive_requests 100;\n}\n'))
+        self.assertFalse(warn.called)
+
+    def test_create_ngx_directives_with_policy(self):
+        args = self.requests['create_lb']['args']
+        args.update({'connect_timeout_ms': 2000,
+                     'client_timeout_ms': 60000,
+                     'server_timeout_ms': 30000,
+                     'retries': 1,
+                     'next_upstream': 'error timeout http_502',
+                     'max_fails': 5,
+                     'fail_timeout_ms': 30000})
+        ngx_upstream_name = self.manager._upstream_name(args)
+
+        upstream_directive = self.manager._create_ngx_upstream_directive(
+            ngx_upstream_name, args)
+        server_directive = self.manager._create_ngx_server_directive(
+            ngx_upstream_name, args)
+
+        self.assertTrue('max_fails=5 fail_timeout=30000ms;'
+                        in upstream_directive)
+        self.assertTrue('''
+       proxy_connect_timeout 2000ms;
+       proxy_read_timeout    30000ms;
+       proxy_send_timeout    30000ms;
+       client_body_timeout   60000ms;
+       send_timeout          60000ms;
+       proxy_next_upstream   error timeout http_502;
+       proxy_next_upstream_tries 2;
+
+       location / {''' in server_directive)
+
+    def test_create_ngx_server_directive_without_retries(self):
+        args = self.requests['create_lb']['args']
+        args.update({'retries': 0, 'next_upstream': 'error timeout'})
+        ngx_upstream_name = self.manager._upstream_name(args)
+
+        server_directive = self.manager._create_ngx_server_directive(
+            ngx_upstream_name, args)
+
+        self.assertTrue('proxy_next_upstream   off;' in server_directive)
+        self.assertFalse('error timeout' in server_directive)
+        self.assertFalse('proxy_next_upstream_tries' in server_directive)
+
     def test_create_lb(self):
         args = self.requests['create_lb']['args']
         self.manager._create_http_ngx_cfg = mock.MagicMock()
@@ -264,56 +569,108 @@ server {
 
         self.manager._delete_http_ngx_cfg.assert_called_with(args)
 
+    def _prepare_update(self):
+        self.manager._save_http_ngx_cfg = mock.MagicMock(
+            return_value='saved')
+        self.manager._restore_http_ngx_cfg = mock.MagicMock()
+        self.manager._write_http_ngx_cfg = mock.MagicMock()
+        self.manager._test_staged_http_ngx_cfg = mock.MagicMock(
+            return_value=True)
+        self.manager._test_http_ngx_cfg = mock.MagicMock()
+        self.manager._reload_http_ngx_cfg = mock.MagicMock()
+
     def test_update_lb(self):
         args = self.requests['update_lb']['args']
-
-        self.manager._delete_http_ngx_cfg = mock.MagicMock()
-        self.manager._create_lb = mock.MagicMock()
+        self._prepare_update()
 
         self.manager._update_lb(args)
 
-        self.manager._delete_http_ngx_cfg.assert_called_with(args)
-        self.manager._create_lb.assert_called_with(args)
+        self.manager._test_staged_http_ngx_cfg.assert_called_once_with(
+            [{'cmd': 'update_lb', 'msg': args}])
+        self.manager._write_http_ngx_cfg.assert_called_once_with(args)
+        self.assertEqual(self.manager._reload_http_ngx_cfg.call_count, 1)
+        self.assertFalse(self.manager._test_http_ngx_cfg.called)
+        self.assertFalse(self.manager._restore_http_ngx_cfg.called)
 
-    def test_update_lb_with_delete_ngx_cfg_failed(self):
+    def test_update_lb_with_test_failed(self):
         args = self.requests['update_lb']['args']
+        self._prepare_update()
+        self.manager._test_staged_http_ngx_cfg.side_effect = \
+            exception.ProcessExecutionError
 
-        self.manager._delete_http_ngx_cfg = mock.MagicMock(
-            side_effect=OSError)
+        self.assertRaises(exception.NginxUpdateProxyError,
+                          self.manager._update_lb, args)
 
-        self.manager._create_lb = mock.MagicMock()
+        # the enabled configuration was not touched
+        self.assertFalse(self.manager._write_http_ngx_cfg.called)
+        self.assertFalse(self.manager._restore_http_ngx_cfg.called)
+        self.assertFalse(self.manager._reload_http_ngx_cfg.called)
+
+    def test_update_lb_without_staged_test(self):
+        args = self.requests['update_lb']['args']
+        self._prepare_update()
+        self.manager._test_staged_http_ngx_cfg.return_value = False
+        self.manager._test_http_ngx_cfg.side_effect = \
+            exception.ProcessExecutionError
 
         self.assertRaises(exception.NginxUpdateProxyError,
                           self.manager._update_lb, args)
 
-    def test_update_lb_with_create_lb_failed(self):
-        args = self.requests['update_lb']['args']
+        self.manager._write_http_ngx_cfg.assert_called_once_with(args)
+        self.manager._restore_http_ngx_cfg.assert_called_once_with('saved')
+        self.assertFalse(self.manager._reload_http_ngx_cfg.called)
 
-        self.manager._delete_http_ngx_cfg = mock.MagicMock()
-        self.manager._create_lb = mock.MagicMock(
-            side_effect=exception.NginxCreateProxyError)
+    def test_update_lb_with_reload_failed(self):
+        args = self.requests['update_lb']['args']
+        self._prepare_update()
+        self.manager._reload_http_ngx_cfg.side_effect = \
+            exception.ProcessExecutionError
 
         self.assertRaises(exception.NginxUpdateProxyError,
                           self.manager._update_lb, args)
 
-        self.manager._delete_http_ngx_cfg.assert_called_with(args)
+        self.manager._restore_http_ngx_cfg.assert_called_once_with('saved')
+
+    @mock.patch('os.path.realpath', lambda path: path + '.real')
+    @mock.patch('os.listdir',
+                mock.MagicMock(return_value=['lb-1', 'testLB', '.lb-2.tmp',
+                                             'lb-3']))
+    @mock.patch('os.symlink')
+    @mock.patch.object(nginx.fileutils, 'write_atomic')
+    def test_test_staged_http_ngx_cfg(self, write_atomic, symlink):
+        self.manager._clear_sites_dir = mock.MagicMock()
+        self.manager._create_http_ngx_cfg_buffer = mock.MagicMock(
+            return_value='ngx_cfg')
+        self.manager._test_main_ngx_cfg = mock.MagicMock(return_value=True)
+        changes = [{'cmd': 'update_lb',
+                    'msg': self.requests['update_lb']['args']},
+                   {'cmd': 'delete_lb', 'msg': {'uuid': 'lb-3'}}]
+
+        self.assertTrue(self.manager._test_staged_http_ngx_cfg(changes))
+
+        staged_dir = '/etc/nginx/sites-staged/'
+        symlink.assert_called_once_with('/etc/nginx/sites-enabled/lb-1.real',
+                                        staged_dir + 'lb-1')
+        write_atomic.assert_called_once_with(staged_dir + 'testLB',
+                                             'ngx_cfg')
+        self.manager._test_main_ngx_cfg.assert_called_once_with(
+            staged_dir, 'staged', None)
 
     @mock.patch('os.path.exists', mock.MagicMock(return_value=False))
-    @mock.patch('__builtin__.open', mock.MagicMock())
-    def test_create_http_ngx_cfg(self):
+    @mock.patch.object(nginx.fileutils, 'symlink_atomic')
+    @mock.patch.object(nginx.fileutils, 'write_atomic')
+    def test_create_http_ngx_cfg(self, write_atomic, symlink_atomic):
         args = self.requests['create_lb']['args']
+        cfile_path = '/etc/nginx/sites-available/testLB'
 
-        self.manager._create_ngx_upstream_directive = mock.MagicMock()
-        self.manager._create_ngx_server_directive = mock.MagicMock()
-
-        utils.execute = mock.MagicMock()
+        self.manager._create_http_ngx_cfg_buffer = mock.MagicMock(
+            return_value='ngx_cfg')
 
         self.manager._create_http_ngx_cfg(args)
 
-        self.assertTrue(self.manager._create_ngx_upstream_directive.called)
-        self.assertTrue(self.manager._create_ngx_server_directive.called)
-        self.assertTrue(open.called)
-        self.assertTrue(utils.execute)
+        write_atomic.assert_called_once_with(cfile_path, 'ngx_cfg')
+        symlink_atomic.assert_called_once_with(
+            cfile_path, '/etc/nginx/sites-enabled/testLB')
 
     @mock.patch('os.path.exists', mock.MagicMock(return_value=True))
     def test_create_http_ngx_cfg_with_file_exists(self):
@@ -322,22 +679,209 @@ server {
                           self.manager._create_http_ngx_cfg, args)
 
     @mock.patch('os.path.exists', mock.MagicMock(return_value=False))
-    @mock.patch('__builtin__.open', mock.MagicMock(side_effect=IOError))
-    def test_create_http_ngx_cfg_with_open_error(self):
+    @mock.patch.object(nginx.fileutils, 'write_atomic',
+                       mock.MagicMock(side_effect=IOError))
+    def test_create_http_ngx_cfg_with_write_error(self):
         args = self.requests['create_lb']['args']
 
         self.assertRaises(IOError, self.manager._create_http_ngx_cfg, args)
 
     @mock.patch('os.path.exists', mock.MagicMock(return_value=False))
-    @mock.patch('__builtin__.open', mock.MagicMock())
+    @mock.patch.object(nginx.fileutils, 'write_atomic', mock.MagicMock())
+    @mock.patch.object(nginx.fileutils, 'symlink_atomic',
+                       mock.MagicMock(side_effect=OSError))
     def test_create_http_ngx_cfg_with_mk_soft_link(self):
         args = self.requests['create_lb']['args']
 
-        utils.execute = mock.MagicMock(
-            side_effect=exception.ProcessExecutionError)
+        self.assertRaises(OSError, self.manager._create_http_ngx_cfg, args)
 
-        self.assertRaises(exception.ProcessExecutionError,
-                          self.manager._create_http_ngx_cfg, args)
+    def _set_map_mode(self):
+        nginx.FLAGS.set_override('render_mode', 'map', 'nginx')
+        self.addCleanup(nginx.FLAGS.clear_override, 'render_mode', 'nginx')
+
+    def test_create_http_ngx_cfg_buffer_with_map_mode(self):
+        self._set_map_mode()
+        args = self.requests['create_lb']['args']
+
+        ngx_cfg = self.manager._create_http_ngx_cfg_buffer(args)
+
+        self.assertTrue(ngx_cfg.startswith(
+            '# server_name abc.lb.com.cn abc.interal.lb.com.cn g.cn t.cn\n'))
+        self.assertTrue('upstream testLB {' in ngx_cfg)
+        self.assertFalse('server {' in ngx_cfg)
+
+    def test_create_http_ngx_cfg_buffer_with_map_mode_and_policy(self):
+        self._set_map_mode()
+        args = self.requests['create_lb']['args']
+        args.update({'connect_timeout_ms': 2000, 'retries': 1})
+
+        ngx_cfg = self.manager._create_http_ngx_cfg_buffer(args)
+
+        # the policy is honoured in a server block of its own
+        self.assertFalse(ngx_cfg.startswith('# server_name'))
+        self.assertTrue('upstream testLB {' in ngx_cfg)
+        self.assertTrue('server_name abc.lb.com.cn abc.interal.lb.com.cn '
+                        'g.cn t.cn;' in ngx_cfg)
+        self.assertTrue('proxy_connect_timeout 2000ms;' in ngx_cfg)
+        self.assertTrue('proxy_next_upstream_tries 2;' in ngx_cfg)
+        self.assertEqual(self.manager._read_server_names(
+            'testLB', self._write_cfg(ngx_cfg)),
+            ['abc.lb.com.cn', 'abc.interal.lb.com.cn', 'g.cn', 't.cn'])
+
+    def _write_cfg(self, content):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        cfile_path = os.path.join(tmp_dir, 'testLB')
+        with open(cfile_path, 'w') as cfile:
+            cfile.write(content)
+        return cfile_path
+
+    def test_read_server_names(self):
+        args = self.requests['create_lb']['args']
+        cfile_path = self._write_cfg(
+            self.manager._create_http_ngx_cfg_buffer(args))
+
+        server_names = self.manager._read_server_names('testLB', cfile_path)
+        self.assertEqual(server_names, ['abc.lb.com.cn',
+                                        'abc.interal.lb.com.cn',
+                                        'g.cn', 't.cn'])
+
+        # not read again while the file is the same
+        with mock.patch('__builtin__.open', side_effect=IOError):
+            self.assertEqual(
+                self.manager._read_server_names('testLB', cfile_path),
+                server_names)
+
+    def test_read_server_names_with_map_mode(self):
+        cfile_path = self._write_cfg(
+            '# server_name g.cn t.cn\nupstream testLB {\n}\n')
+
+        self.assertEqual(
+            self.manager._read_server_names('testLB', cfile_path),
+            ['g.cn', 't.cn'])
+        self.assertFalse(self.manager._server_names['testLB'][2])
+
+    def test_read_server_names_with_map_mode_and_keepalive(self):
+        self._set_map_mode()
+        args = self.requests['create_lb']['args']
+        args['keepalive_connections'] = 32
+        cfile_path = self._write_cfg(
+            self.manager._create_http_ngx_cfg_buffer(args))
+
+        self.assertEqual(
+            self.manager._read_server_names('testLB', cfile_path),
+            ['abc.lb.com.cn', 'abc.interal.lb.com.cn', 'g.cn', 't.cn'])
+        self.assertTrue(self.manager._server_names['testLB'][2])
+
+    def test_scan_server_names(self):
+        self.manager._read_server_names = mock.MagicMock(
+            side_effect=lambda confname, cfile_path: [confname])
+        self.manager._server_names = {'lb-0': None}
+
+        with mock.patch('os.listdir', mock.MagicMock(
+                return_value=['lb-2', 'nozzle-map.conf', '.lb-3.tmp',
+                              'lb-1'])):
+            server_names = self.manager._scan_server_names()
+
+        self.assertEqual(server_names, [('lb-1', ['lb-1']),
+                                        ('lb-2', ['lb-2'])])
+        # forget the files not enabled any more
+        self.assertEqual(self.manager._server_names, {})
+
+    @mock.patch.object(nginx.fileutils, 'write_atomic')
+    def test_write_map_ngx_cfg(self, write_atomic):
+        server_names = [('lb-1', ['G.cn', 't.cn']),
+                        ('lb-2', ['t.cn', 'x.cn'])]
+
+        self.manager._write_map_ngx_cfg(server_names)
+        self.manager._write_map_ngx_cfg(server_names)
+
+        # written once, the second time it is the same
+        self.assertEqual(write_atomic.call_count, 1)
+        path, ngx_cfg = write_atomic.call_args[0]
+        self.assertEqual(path, '/etc/nginx/sites-enabled/nozzle-map.conf')
+        self.assertTrue('\tg.cn lb-1;\n\tt.cn lb-1;\n\tx.cn lb-2;\n' in
+                        ngx_cfg)
+        self.assertTrue('proxy_pass http://$nozzle_upstream;' in ngx_cfg)
+        # HTTP/1.0 to the upstreams without keepalive
+        self.assertFalse('$nozzle_connection' in ngx_cfg)
+        self.assertFalse('proxy_http_version' in ngx_cfg)
+
+    @mock.patch.object(nginx.fileutils, 'write_atomic')
+    def test_write_map_ngx_cfg_with_keepalive(self, write_atomic):
+        self.manager._server_names = {'lb-1': (None, ['g.cn'], True),
+                                      'lb-2': (None, ['x.cn'], False)}
+
+        self.manager._write_map_ngx_cfg([('lb-1', ['g.cn']),
+                                         ('lb-2', ['x.cn'])])
+
+        ngx_cfg = write_atomic.call_args[0][1]
+        self.assertTrue('map $nozzle_upstream $nozzle_connection {\n'
+                        '\tdefault close;\n\tlb-1 "";\n}\n' in ngx_cfg)
+        self.assertTrue('proxy_http_version 1.1;' in ngx_cfg)
+        self.assertTrue('proxy_set_header Connection $nozzle_connection;' in
+                        ngx_cfg)
+
+    @mock.patch('os.listdir', mock.MagicMock(return_value=[]))
+    @mock.patch('os.symlink', mock.MagicMock())
+    @mock.patch.object(nginx.fileutils, 'write_atomic')
+    def test_test_staged_http_ngx_cfg_with_hash_sizes(self, write_atomic):
+        nginx.FLAGS.set_override('hash_sizes_config', '/path/to/hash.conf',
+                                 'nginx')
+        self.addCleanup(nginx.FLAGS.clear_override, 'hash_sizes_config',
+                        'nginx')
+        self.manager._clear_sites_dir = mock.MagicMock()
+        self.manager._read_server_names = mock.MagicMock(return_value=[])
+        main_cfg = ('http {\n\tinclude /path/to/hash.conf;\n'
+                    '\tinclude /etc/nginx/sites-enabled/*;\n}\n')
+        changes = [{'cmd': 'update_lb',
+                    'msg': self.requests['update_lb']['args']}]
+
+        with mock.patch('__builtin__.open',
+                        mock.mock_open(read_data=main_cfg), create=True):
+            with mock.patch.object(utils, 'execute') as execute:
+                self.assertTrue(
+                    self.manager._test_staged_http_ngx_cfg(changes))
+
+        # the live hash sizes are left to the commit
+        paths = [call[0][0] for call in write_atomic.call_args_list]
+        self.assertFalse('/path/to/hash.conf' in paths)
+        self.assertTrue('/path/to/hash.conf.staged' in paths)
+        test_cfg = write_atomic.call_args_list[-1][0][1]
+        self.assertTrue('include /path/to/hash.conf.staged;' in test_cfg)
+        self.assertTrue('include /etc/nginx/sites-staged/*;' in test_cfg)
+        self.assertTrue(execute.called)
+
+    def test_write_managed_ngx_cfg_with_defaults(self):
+        self.manager._scan_server_names = mock.MagicMock()
+
+        self.manager._write_managed_ngx_cfg()
+
+        self.assertFalse(self.manager._scan_server_names.called)
+
+    def test_hash_sizes(self):
+        self.assertEqual(nginx._hash_sizes(0, 0), (512, 64))
+        self.assertEqual(nginx._hash_sizes(300, 20), (1024, 64))
+        self.assertEqual(nginx._hash_sizes(5000, 60), (16384, 128))
+
+    @mock.patch.object(nginx.fileutils, 'write_atomic')
+    def test_write_hash_ngx_cfg(self, write_atomic):
+        nginx.FLAGS.set_override('hash_sizes_config', '/path/to/hash.conf',
+                                 'nginx')
+        self.addCleanup(nginx.FLAGS.clear_override, 'hash_sizes_config',
+                        'nginx')
+
+        self.manager._write_hash_ngx_cfg([('lb-1', ['a.cn'] * 300)])
+        self.manager._write_hash_ngx_cfg([('lb-1', ['a.cn'] * 400)])
+        self.assertEqual(write_atomic.call_count, 1)
+
+        # crossing a power of two
+        self.manager._write_hash_ngx_cfg([('lb-1', ['a.cn'] * 600)])
+        self.assertEqual(write_atomic.call_count, 2)
+        path, ngx_cfg = write_atomic.call_args[0]
+        self.assertEqual(path, '/path/to/hash.conf')
+        self.assertTrue('server_names_hash_max_size 2048;' in ngx_cfg)
+        self.assertTrue('map_hash_bucket_size 64;' in ngx_cfg)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,124 @@
+import unittest
+
+from novaclient import exceptions as nova_exceptions
+
+from nozzle.common import exception
+from nozzle.server import resolver
+
+
+class FakeServer(object):
+
+    def __init__(self, uuid, ip):
+        self.id = uuid
+        self.addresses = {'private': [{'addr': ip, 'version': 4}]}
+
+
+class FakeServerManager(object):
+
+    def __init__(self, servers):
+        self.servers = servers
+        self.get_calls = 0
+        self.list_calls = 0
+
+    def get(self, uuid):
+        self.get_calls += 1
+        if uuid not in self.servers:
+            raise nova_exceptions.NotFound(404)
+        return self.servers[uuid]
+
+    def list(self, search_opts=None):
+        self.list_calls += 1
+        search_opts = search_opts or {}
+        uuids = sorted(self.servers)
+        if 'marker' in search_opts:
+            uuids = uuids[uuids.index(search_opts['marker']) + 1:]
+        if 'limit' in search_opts:
+            uuids = uuids[:search_opts['limit']]
+        return [self.servers[uuid] for uuid in uuids]
+
+
+class FakeNovaClient(object):
+
+    def __init__(self, servers):
+        self.servers = FakeServerManager(servers)
+
+
+class InstanceIpResolverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(InstanceIpResolverTestCase, self).setUp()
+        servers = dict()
+        for i in range(20):
+            uuid = 'instance-%d' % i
+            servers[uuid] = FakeServer(uuid, '10.0.0.%d' % i)
+        self.nova = FakeNovaClient(servers)
+        self.resolver = resolver.InstanceIpResolver(
+            client_factory=lambda: self.nova)
+        resolver.FLAGS.set_override('nova_list_threshold', 5)
+
+    def tearDown(self):
+        resolver.FLAGS.clear_override('nova_list_threshold')
+        resolver.FLAGS.clear_override('nova_list_page_size')
+        resolver.FLAGS.clear_override('instance_ip_cache_ttl')
+        super(InstanceIpResolverTestCase, self).tearDown()
+
+    def test_resolve_few_with_get(self):
+        result = self.resolver.resolve(['instance-1', 'instance-2'])
+        self.assertEqual(result, {'instance-1': '10.0.0.1',
+                                  'instance-2': '10.0.0.2'})
+        self.assertEqual(self.nova.servers.get_calls, 2)
+        self.assertEqual(self.nova.servers.list_calls, 0)
+
+    def test_resolve_many_with_one_list(self):
+        uuids = ['instance-%d' % i for i in range(10)]
+        result = self.resolver.resolve(uuids)
+        self.assertEqual(len(result), 10)
+        self.assertEqual(self.nova.servers.list_calls, 1)
+        self.assertEqual(self.nova.servers.get_calls, 0)
+
+    def test_resolve_many_with_pages(self):
+        resolver.FLAGS.set_override('nova_list_page_size', 8)
+        uuids = ['instance-%d' % i for i in range(10)]
+        result = self.resolver.resolve(uuids)
+        self.assertEqual(len(result), 10)
+        # instance-9 sorts last of the 20, on the third page
+        self.assertEqual(self.nova.servers.list_calls, 3)
+        self.assertEqual(self.nova.servers.get_calls, 0)
+
+    def test_resolve_many_in_big_cloud_with_get(self):
+        resolver.FLAGS.set_override('nova_list_page_size', 1)
+        uuids = ['instance-0', 'instance-1', 'instance-10', 'instance-11',
+                 'instance-12']
+        result = self.resolver.resolve(uuids)
+        self.assertEqual(len(result), 5)
+        # the listing stops before it costs as many calls as the gets
+        self.assertEqual(self.nova.servers.list_calls, 4)
+        self.assertEqual(self.nova.servers.get_calls, 1)
+
+        self.resolver.invalidate()
+        self.nova.servers.list_calls = 0
+        self.nova.servers.get_calls = 0
+        self.resolver.resolve(uuids)
+        self.assertEqual(self.nova.servers.list_calls, 0)
+        self.assertEqual(self.nova.servers.get_calls, 5)
+
+    def test_resolve_from_cache(self):
+        self.resolver.resolve(['instance-1'])
+        self.resolver.resolve(['instance-1'])
+        self.assertEqual(self.nova.servers.get_calls, 1)
+
+    def test_resolve_after_ttl(self):
+        resolver.FLAGS.set_override('instance_ip_cache_ttl', 0)
+        self.resolver.resolve(['instance-1'])
+        self.resolver.resolve(['instance-1'])
+        self.assertEqual(self.nova.servers.get_calls, 2)
+
+    def test_invalidate(self):
+        self.resolver.resolve(['instance-1', 'instance-2'])
+        self.resolver.invalidate(['instance-1'])
+        self.resolver.resolve(['instance-1', 'instance-2'])
+        self.assertEqual(self.nova.servers.get_calls, 3)
+
+    def test_resolve_not_found(self):
+        self.assertRaises(exception.InstanceFixedIpNotFound,
+                          self.resolver.resolve, ['instance-1', 'missing'])
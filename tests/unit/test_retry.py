@@ -0,0 +1,54 @@
+import unittest
+
+from nozzle.server import retry
+
+
+class RetrySchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(RetrySchedulerTestCase, self).setUp()
+        retry.FLAGS.set_override('retry_base_interval', 6)
+        retry.FLAGS.set_override('retry_max_interval', 20)
+        retry.FLAGS.set_override('retry_budget', 3)
+        self.scheduler = retry.RetryScheduler()
+
+    def tearDown(self):
+        retry.FLAGS.clear_override('retry_base_interval')
+        retry.FLAGS.clear_override('retry_max_interval')
+        retry.FLAGS.clear_override('retry_budget')
+        super(RetrySchedulerTestCase, self).tearDown()
+
+    def test_unknown_is_due(self):
+        self.assertTrue(self.scheduler.is_due('lb-1', now=100))
+        self.assertFalse(self.scheduler.is_exhausted('lb-1'))
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_exponential_backoff(self):
+        self.scheduler.start('lb-1', now=100)
+        self.assertFalse(self.scheduler.is_due('lb-1', now=105))
+        self.assertTrue(self.scheduler.is_due('lb-1', now=106))
+        self.scheduler.dispatched('lb-1', now=106)
+        self.assertFalse(self.scheduler.is_due('lb-1', now=117))
+        self.assertTrue(self.scheduler.is_due('lb-1', now=118))
+        self.scheduler.dispatched('lb-1', now=118)
+        # capped by retry_max_interval
+        self.assertTrue(self.scheduler.is_due('lb-1', now=138))
+
+    def test_budget(self):
+        for i in range(3):
+            self.assertFalse(self.scheduler.is_exhausted('lb-1'))
+            self.scheduler.dispatched('lb-1')
+        self.assertTrue(self.scheduler.is_exhausted('lb-1'))
+
+    def test_start_resets_attempts(self):
+        self.scheduler.dispatched('lb-1')
+        self.scheduler.dispatched('lb-1')
+        self.scheduler.start('lb-1')
+        self.assertEqual(self.scheduler.attempts('lb-1'), 1)
+
+    def test_retain(self):
+        self.scheduler.dispatched('lb-1')
+        self.scheduler.dispatched('lb-2')
+        self.scheduler.retain(set(['lb-2']))
+        self.assertEqual(len(self.scheduler), 1)
+        self.assertEqual(self.scheduler.attempts('lb-1'), 0)
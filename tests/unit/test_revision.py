@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from nozzle.worker import revision
+
+
+class RevisionStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(RevisionStoreTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'revisions.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        super(RevisionStoreTestCase, self).tearDown()
+
+    def test_is_applied(self):
+        store = revision.RevisionStore(self.path)
+        self.assertFalse(store.is_applied('lb-1', 1))
+        store.record('lb-1', 2)
+        self.assertTrue(store.is_applied('lb-1', 1))
+        self.assertTrue(store.is_applied('lb-1', 2))
+        self.assertFalse(store.is_applied('lb-1', 3))
+
+    def test_no_revision(self):
+        store = revision.RevisionStore(self.path)
+        store.record('lb-1', None)
+        self.assertFalse(store.is_applied('lb-1', None))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_never_goes_back(self):
+        store = revision.RevisionStore(self.path)
+        store.record('lb-1', 3)
+        store.record('lb-1', 2)
+        self.assertEqual(store.get('lb-1'), 3)
+
+    def test_survives_restart(self):
+        revision.RevisionStore(self.path).record('lb-1', 5)
+        store = revision.RevisionStore(self.path)
+        self.assertEqual(store.get('lb-1'), 5)
+
+    def test_corrupted_file(self):
+        with open(self.path, 'w') as store_file:
+            store_file.write('{not json')
+        store = revision.RevisionStore(self.path)
+        self.assertEqual(store.get('lb-1'), 0)
@@ -1,4 +1,5 @@
 import copy
+import datetime
 import mox
 import unittest
 
@@ -7,15 +8,25 @@ from nozzle.db.sqlalchemy import models
 from nozzle.common import context
 from nozzle.common import exception
 from nozzle.common import utils
+from nozzle.server import resolver
 from nozzle.server import state
 from nozzle.server.protocol import tcp
 
 
+class FakeResolver(object):
+
+    def resolve(self, instance_uuids, strict=True):
+        return dict([(uuid, 'ip-of-%s' % uuid) for uuid in instance_uuids])
+
+
 class TcpTestCase(unittest.TestCase):
 
     def setUp(self):
         super(TcpTestCase, self).setUp()
         self.mox = mox.Mox()
+        self.now = datetime.datetime(2013, 1, 1)
+        self.mox.stubs.Set(resolver, 'get_resolver', FakeResolver)
+        self.mox.stubs.Set(utils, 'utcnow', lambda: self.now)
         self.load_balancer_id = '123'
         self.uuid = 'lb-uuid-1'
         self.name = 'test-lb-1'
@@ -106,6 +117,8 @@ class TcpTestCase(unittest.TestCase):
             association_values = {
                 'load_balancer_id': self.load_balancer_id,
                 'instance_uuid': uuid,
+                'instance_ip': 'ip-of-%s' % uuid,
+                'instance_ip_resolved_at': self.now,
             }
             association_ref = models.LoadBalancerInstanceAssociation()
             association_ref.update(association_values)
@@ -140,6 +153,51 @@ class TcpTestCase(unittest.TestCase):
         self.mox.VerifyAll()
         self.assertEqual(r, None)
 
+    def test_update_load_balancer_config_with_policy(self):
+        config_values = copy.deepcopy(self.config_values)
+        config_values.update({'connect_timeout_ms': 2000,
+                              'retries': 2,
+                              'redispatch': True,
+                              'max_fails': 3})
+        update_kwargs = copy.deepcopy(self.delete_kwargs)
+        update_kwargs['config'] = config_values
+
+        self.mox.StubOutWithMock(db, 'load_balancer_get_by_uuid')
+        self.mox.StubOutWithMock(db, 'load_balancer_config_create')
+        self.mox.StubOutWithMock(db, 'load_balancer_config_destroy')
+        self.mox.StubOutWithMock(db, 'load_balancer_update_state')
+
+        load_balancer_ref = self.lb_ref
+        load_balancer_ref.config = self.config_ref
+        db.load_balancer_get_by_uuid(
+            self.ctxt, self.uuid).AndReturn(load_balancer_ref)
+        db.load_balancer_config_destroy(
+            self.ctxt, load_balancer_ref.config.id).AndReturn(None)
+        db.load_balancer_config_create(
+            self.ctxt, config_values).AndReturn(self.config_ref)
+        db.load_balancer_update_state(
+            self.ctxt, self.uuid, state.UPDATING).AndReturn(None)
+        self.mox.ReplayAll()
+        r = tcp.update_load_balancer_config(self.ctxt, **update_kwargs)
+        self.mox.VerifyAll()
+        self.assertEqual(r, None)
+
+    def test_update_load_balancer_config_with_invalid_policy(self):
+        invalid_configs = [
+            ('connect_timeout_ms', 75001),
+            ('client_timeout_ms', 999),
+            ('retries', 11),
+            ('redispatch', 2),
+            ('max_fails', -1),
+        ]
+        for key, value in invalid_configs:
+            update_kwargs = copy.deepcopy(self.delete_kwargs)
+            update_kwargs['config'] = copy.deepcopy(self.config_values)
+            update_kwargs['config'][key] = value
+            self.assertRaises(exception.InvalidParameter,
+                              tcp.update_load_balancer_config,
+                              self.ctxt, **update_kwargs)
+
     def test_update_load_balancer_config_with_invalid_uuid(self):
         def _raise_exception(*args):
             raise exception.LoadBalancerNotFoundByUUID(
@@ -196,6 +254,8 @@ class TcpTestCase(unittest.TestCase):
             association_values = {
                 'load_balancer_id': load_balancer_ref.id,
                 'instance_uuid': instance_uuid,
+                'instance_ip': 'ip-of-%s' % instance_uuid,
+                'instance_ip_resolved_at': self.now,
             }
             db.load_balancer_instance_association_create(
                 self.ctxt, association_values).AndReturn(None)
@@ -58,3 +58,21 @@ class ApiTestCase(unittest.TestCase):
 
     def tearDown(self):
         self.mox.UnsetStubs()
+
+
+class ExecuteTestCase(unittest.TestCase):
+
+    def test_execute(self):
+        self.assertEqual(utils.execute('echo nozzle'), 'nozzle\n')
+
+    def test_execute_with_failure(self):
+        self.assertRaises(exception.ProcessExecutionError,
+                          utils.execute, 'false')
+
+    def test_execute_with_timeout(self):
+        try:
+            utils.execute('sleep 10', timeout=0.1)
+        except exception.ProcessExecutionError as e:
+            self.assertTrue('killed after 0.1 seconds' in e.output)
+        else:
+            self.fail('sleep was not killed')
@@ -0,0 +1,146 @@
+import mock
+import unittest
+
+from nozzle.openstack.common import jsonutils
+
+from nozzle.worker import manager
+
+
+class CheckSequenceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(CheckSequenceTestCase, self).setUp()
+        self.worker = manager.WorkerManager()
+        self.worker.epoch = 'epoch-1'
+        self.worker.last_seq = 5
+        self.worker._resync = mock.MagicMock()
+        self.worker.bootstrap = mock.MagicMock()
+
+    def _check(self, message):
+        return self.worker._check_sequence('lb', 'msg-uuid', message)
+
+    def test_in_order(self):
+        message = {'epoch': 'epoch-1', 'seq': 6}
+        self.assertEqual(self._check(message),
+                         [('lb', 'msg-uuid', message)])
+        self.assertEqual(self.worker.last_seq, 6)
+        self.assertFalse(self.worker._resync.called)
+
+    def test_duplicate(self):
+        self.assertEqual(self._check({'epoch': 'epoch-1', 'seq': 5}), [])
+
+    def test_no_sequence(self):
+        self.assertEqual(len(self._check({'cmd': 'create_lb'})), 1)
+        self.assertEqual(self.worker.last_seq, 5)
+
+    def test_gap_is_resynced(self):
+        missed = [['lb', 'msg-6', jsonutils.dumps({'seq': 6})],
+                  ['lb', 'msg-7', jsonutils.dumps({'seq': 7})]]
+        self.worker._resync.return_value = missed
+        result = self._check({'epoch': 'epoch-1', 'seq': 8})
+        self.worker._resync.assert_called_once_with(6, 7)
+        self.assertEqual([x[1] for x in result],
+                         ['msg-6', 'msg-7', 'msg-uuid'])
+        self.assertEqual(self.worker.last_seq, 8)
+
+    def test_gap_falls_back_to_bootstrap(self):
+        self.worker._resync.return_value = None
+
+        def bootstrap():
+            self.worker.last_seq = 9
+        self.worker.bootstrap.side_effect = bootstrap
+        self.assertEqual(self._check({'epoch': 'epoch-1', 'seq': 8}), [])
+        self.worker.bootstrap.assert_called_once_with()
+
+    def test_server_restarted(self):
+        self.worker._resync.return_value = []
+        self._check({'epoch': 'epoch-2', 'seq': 3})
+        self.worker._resync.assert_called_once_with(1, 2)
+        self.assertEqual(self.worker.epoch, 'epoch-2')
+
+
+class HandleBatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(HandleBatchTestCase, self).setUp()
+        self.worker = manager.WorkerManager()
+        self.worker.feedback = mock.MagicMock()
+        self.worker.revisions = mock.MagicMock()
+        self.worker.revisions.is_applied.return_value = False
+        self.worker.ha_configurer = mock.MagicMock()
+        self.worker.ngx_configurer = mock.MagicMock()
+
+    def _request(self, uuid, protocol='tcp', revision=1):
+        message = {'cmd': 'update_lb',
+                   'args': {'uuid': uuid, 'protocol': protocol,
+                            'revision': revision}}
+        return ('lb', 'msg-%s' % uuid, message)
+
+    def _feedbacks(self):
+        result = dict()
+        for call in self.worker.feedback.send_multipart.call_args_list:
+            response = jsonutils.loads(call[0][0][2])
+            result[response['uuid']] = response['code']
+        return result
+
+    def test_one_call_per_driver(self):
+        self.worker.ha_configurer.do_config_batch.return_value = [None,
+                                                                  'bad']
+        self.worker.ngx_configurer.do_config_batch.return_value = [None]
+        self.worker._handle_batch([self._request('lb-1'),
+                                   self._request('lb-2'),
+                                   self._request('lb-3', protocol='http')])
+        self.assertEqual(
+            self.worker.ha_configurer.do_config_batch.call_count, 1)
+        self.assertEqual(
+            self.worker.ngx_configurer.do_config_batch.call_count, 1)
+        self.assertEqual(self._feedbacks(),
+                         {'lb-1': 200, 'lb-2': 500, 'lb-3': 200})
+        self.worker.revisions.record_many.assert_any_call([('lb-1', 1)])
+
+    def test_applied_revision_is_acked(self):
+        self.worker.revisions.is_applied.return_value = True
+        self.worker._handle_batch([self._request('lb-1')])
+        self.assertFalse(self.worker.ha_configurer.do_config_batch.called)
+        self.assertEqual(self._feedbacks(), {'lb-1': 200})
+
+    def test_duplicate_in_batch(self):
+        self.worker.ha_configurer.do_config_batch.return_value = [None]
+        self.worker._handle_batch([self._request('lb-1'),
+                                   self._request('lb-1')])
+        requests = self.worker.ha_configurer.do_config_batch.call_args[0][0]
+        self.assertEqual(len(requests), 1)
+
+    def test_get_stats(self):
+        self.worker.ha_configurer.stats = {'changes': 4, 'skipped': 1}
+        self.worker.ngx_configurer.stats = {'changes': 0, 'skipped': 0}
+        stats = self.worker.get_stats()
+        self.assertEqual(stats['tcp']['skip_rate'], 0.25)
+        self.assertEqual(stats['http']['skip_rate'], 0.0)
+
+    def test_dispatch_to_lanes(self):
+        tcp_lane = mock.MagicMock()
+        self.worker.lanes = {'tcp': tcp_lane}
+        self.worker.ngx_configurer.do_config_batch.return_value = [None]
+        self.worker._handle_batch([self._request('lb-1'),
+                                   self._request('lb-2', protocol='http')])
+        tcp_lane.put.assert_called_once_with([self._request('lb-1')])
+        self.assertFalse(self.worker.ha_configurer.do_config_batch.called)
+        self.assertEqual(self._feedbacks(), {'lb-2': 200})
+
+    def test_apply_changes_with_lane_feedback(self):
+        feedback = mock.MagicMock()
+        self.worker.ha_configurer.do_config_batch.return_value = [None]
+        self.worker._apply_changes('tcp', [self._request('lb-1')],
+                                   feedback=feedback)
+        self.assertEqual(feedback.send_multipart.call_count, 1)
+        self.assertFalse(self.worker.feedback.send_multipart.called)
+
+    def test_get_stats_with_lanes(self):
+        self.worker.ha_configurer.stats = {'changes': 0, 'skipped': 0}
+        self.worker.ngx_configurer.stats = {'changes': 0, 'skipped': 0}
+        self.worker.lanes = {'tcp': mock.MagicMock()}
+        self.worker.lanes['tcp'].get_stats.return_value = {'queue_depth': 3}
+        stats = self.worker.get_stats()
+        self.assertEqual(stats['tcp']['queue_depth'], 3)
+        self.assertFalse('queue_depth' in stats['http'])
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#
+# Measure nginx -t, reload time and worker memory with many load
+# balancers, for each render_mode of the worker:
+#
+#   tools/bench-nginx.py --counts 1000,10000,50000 --modes server,map
+#
+# The configuration is rendered by the nginx driver into a private prefix
+# and run by a private nginx, run it from the top of the source tree.
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+# the tree being measured, rather than an installed nozzle
+sys.path.insert(0, os.getcwd())
+
+from nozzle.common import flags  # noqa: imported from the path above
+from nozzle.worker.driver import nginx  # noqa
+
+MAIN_CONFIG = """worker_processes 1;
+error_log %(prefix)s/error.log;
+pid %(prefix)s/nginx.pid;
+
+events {
+    worker_connections 1024;
+}
+
+http {
+    log_format sws_proxy_log_fmt '$remote_addr [$time_local] "$request"';
+    server_names_hash_max_size 262144;
+    server_names_hash_bucket_size 128;
+    map_hash_max_size 262144;
+    map_hash_bucket_size 128;
+    include %(prefix)s/sites/*;
+}
+"""
+
+
+def render(configurer, prefix, count):
+    sites_dir = os.path.join(prefix, 'sites')
+    os.makedirs(sites_dir)
+    upstreams = dict()
+    for i in xrange(count):
+        lb_uuid = str(uuid.uuid4())
+        msg = {
+            'uuid': lb_uuid,
+            'balancing_method': 'round_robin',
+            'instance_port': 80,
+            'instance_ips': ['10.0.%d.%d' % (i / 250 % 250, i % 250 + 1)],
+            'dns_names': ['lb%d.bench.lb.com' % i],
+            'http_server_names': ['www%d.bench.com' % i],
+        }
+        with open(os.path.join(sites_dir, lb_uuid), 'w') as cfile:
+            cfile.write(configurer._create_http_ngx_cfg_buffer(msg))
+        for host in msg['dns_names'] + msg['http_server_names']:
+            upstreams[host] = lb_uuid
+    if flags.FLAGS.nginx.render_mode == 'map':
+        with open(os.path.join(sites_dir, 'nozzle-map.conf'), 'w') as cfile:
+            cfile.write(configurer._create_map_ngx_cfg_buffer(upstreams))
+    with open(os.path.join(prefix, 'nginx.conf'), 'w') as main_file:
+        main_file.write(MAIN_CONFIG % {'prefix': prefix})
+
+
+def nginx_cmd(prefix, *args):
+    return ['nginx', '-p', prefix, '-c', os.path.join(prefix, 'nginx.conf')
+            ] + list(args)
+
+
+def timed(cmd):
+    start = time.time()
+    subprocess.check_call(cmd, stdout=open(os.devnull, 'w'),
+                          stderr=subprocess.STDOUT)
+    return time.time() - start
+
+
+def get_workers(master_pid):
+    workers = []
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % pid) as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except IOError:
+            continue
+        if int(fields[1]) == master_pid:
+            workers.append(int(pid))
+    return set(workers)
+
+
+def get_rss_kb(pid):
+    with open('/proc/%s/status' % pid) as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def measure_reload(prefix, timeout=600):
+    """Seconds from the reload signal to the first new worker."""
+    with open(os.path.join(prefix, 'nginx.pid')) as pidfile:
+        master_pid = int(pidfile.read())
+    old_workers = get_workers(master_pid)
+    start = time.time()
+    subprocess.check_call(nginx_cmd(prefix, '-s', 'reload'))
+    while time.time() - start < timeout:
+        new_workers = get_workers(master_pid) - old_workers
+        if new_workers:
+            return time.time() - start, get_rss_kb(new_workers.pop())
+        time.sleep(0.01)
+    raise RuntimeError('nginx did not reload in %ss' % timeout)
+
+
+def bench(configurer, count):
+    prefix = tempfile.mkdtemp()
+    try:
+        render(configurer, prefix, count)
+        test_time = timed(nginx_cmd(prefix, '-t'))
+        start_time = timed(nginx_cmd(prefix))
+        try:
+            reload_time, rss_kb = measure_reload(prefix)
+        finally:
+            subprocess.call(nginx_cmd(prefix, '-s', 'stop'))
+    finally:
+        shutil.rmtree(prefix)
+    return test_time, start_time, reload_time, rss_kb
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--counts', default='1000,10000,50000',
+                      help='numbers of load balancers, comma separated')
+    parser.add_option('--modes', default='server,map',
+                      help='render modes, comma separated')
+    parser.add_option('--listen', default='127.0.0.1:18090')
+    options, args = parser.parse_args()
+
+    flags.FLAGS([sys.argv[0]])
+    log_dir = tempfile.mkdtemp()
+    flags.FLAGS.set_override('access_log_dir', os.path.join(log_dir, 'logs'),
+                             'nginx')
+    flags.FLAGS.set_override('listen', [options.listen], 'nginx')
+    os.makedirs(flags.FLAGS.nginx.access_log_dir)
+
+    print '%-8s %8s %10s %10s %10s %12s' % ('mode', 'lbs', 'test (s)',
+                                            'start (s)', 'reload (s)',
+                                            'worker rss')
+    try:
+        for mode in options.modes.split(','):
+            flags.FLAGS.set_override('render_mode', mode, 'nginx')
+            configurer = nginx.NginxProxyConfigurer()
+            for count in options.counts.split(','):
+                result = bench(configurer, int(count))
+                print '%-8s %8s %10.2f %10.2f %10.2f %9d kB' % (
+                    (mode, count) + result)
+    finally:
+        shutil.rmtree(log_dir)
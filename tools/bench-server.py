@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+#
+# Measure idle CPU usage and request round-trip latency of a running
+# nozzle-server. Run it against the old and the new build to compare:
+#
+#   tools/bench-server.py --pid `pgrep -f nozzle-server` --requests 2000
+#
+
+import optparse
+import os
+import sys
+import time
+import uuid
+
+import zmq
+
+
+def cpu_seconds(pid):
+    """utime + stime of the process, in seconds."""
+    with open('/proc/%s/stat' % pid) as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    ticks = int(fields[11]) + int(fields[12])
+    return float(ticks) / os.sysconf('SC_CLK_TCK')
+
+
+def measure_idle_cpu(pid, seconds):
+    start_cpu = cpu_seconds(pid)
+    start = time.time()
+    time.sleep(seconds)
+    used = cpu_seconds(pid) - start_cpu
+    return 100.0 * used / (time.time() - start)
+
+
+def measure_latency(url, requests, method):
+    context = zmq.Context()
+    handler = context.socket(zmq.REQ)
+    handler.connect(url)
+    body = ('{"method": "%s", "args": {"user_id": "bench", '
+            '"tenant_id": "bench", "is_admin": true}}' % method)
+
+    samples = []
+    for i in xrange(requests):
+        start = time.time()
+        handler.send_multipart(['lb', str(uuid.uuid4()), body])
+        handler.recv_multipart()
+        samples.append((time.time() - start) * 1000.0)
+    handler.close()
+    return sorted(samples)
+
+
+def percentile(samples, pct):
+    index = int(round(pct / 100.0 * (len(samples) - 1)))
+    return samples[index]
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--url', default='tcp://127.0.0.1:5557',
+                      help='nozzle-server client endpoint')
+    parser.add_option('--pid', type='int',
+                      help='pid of nozzle-server, for idle CPU usage')
+    parser.add_option('--idle-seconds', type='int', default=10)
+    parser.add_option('--requests', type='int', default=1000)
+    parser.add_option('--method', default='get_all_http_servers',
+                      help='server api method to call')
+    options, args = parser.parse_args()
+
+    if options.pid:
+        usage = measure_idle_cpu(options.pid, options.idle_seconds)
+        print 'idle cpu: %.2f%% over %ss' % (usage, options.idle_seconds)
+
+    samples = measure_latency(options.url, options.requests, options.method)
+    if not samples:
+        sys.exit(0)
+    print 'round trip (ms): p50=%.2f p90=%.2f p99=%.2f max=%.2f' % (
+        percentile(samples, 50), percentile(samples, 90),
+        percentile(samples, 99), samples[-1])
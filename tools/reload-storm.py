@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+# Count the connections refused by haproxy while it is reloaded again and
+# again, for each reload_mode of the worker:
+#
+#   tools/reload-storm.py --mode sf --reloads 100
+#   tools/reload-storm.py --mode seamless --reloads 100
+#   tools/reload-storm.py --mode master --reloads 100
+#
+# It runs a private haproxy on local ports, in front of a backend of its
+# own, and needs haproxy >= 1.8 for seamless and master.
+
+import errno
+import optparse
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+CONFIG = """global
+    maxconn 4096
+    pidfile %(pid_path)s
+    stats socket %(sock_path)s level admin expose-fd listeners
+
+defaults
+    mode tcp
+    timeout connect 1s
+    timeout client 5s
+    timeout server 5s
+
+listen storm
+    bind 127.0.0.1:%(port)d
+    server backend 127.0.0.1:%(backend_port)d
+"""
+
+
+def run_backend(server, stop):
+    server.settimeout(0.2)
+    while not stop.is_set():
+        try:
+            conn, addr = server.accept()
+        except socket.timeout:
+            continue
+        try:
+            conn.sendall('ok\n')
+        except socket.error:
+            pass
+        conn.close()
+
+
+def run_client(port, stop, counts, lock):
+    while not stop.is_set():
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.settimeout(2)
+        try:
+            client.connect(('127.0.0.1', port))
+            result = 'ok' if client.recv(3) == 'ok\n' else 'closed'
+        except socket.error as e:
+            if e.errno == errno.ECONNREFUSED:
+                result = 'refused'
+            elif e.errno == errno.ECONNRESET:
+                result = 'reset'
+            else:
+                result = 'error'
+        finally:
+            client.close()
+        with lock:
+            counts[result] = counts.get(result, 0) + 1
+
+
+def read_pids(pid_path):
+    with open(pid_path) as pidfile:
+        return [int(pid) for pid in pidfile.read().split()]
+
+
+def reload_haproxy(mode, cfg_path, pid_path, sock_path):
+    pids = read_pids(pid_path)
+    if mode == 'master':
+        os.kill(pids[0], signal.SIGUSR2)
+        return
+    cmd = ['haproxy', '-D', '-f', cfg_path, '-p', pid_path]
+    if mode == 'seamless':
+        cmd += ['-x', sock_path]
+    subprocess.check_call(cmd + ['-sf'] + [str(pid) for pid in pids])
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--mode', default='sf',
+                      help='sf, seamless or master, like reload_mode')
+    parser.add_option('--reloads', type='int', default=50)
+    parser.add_option('--interval', type='float', default=0.1,
+                      help='seconds between two reloads')
+    parser.add_option('--clients', type='int', default=4,
+                      help='threads connecting in a loop')
+    parser.add_option('--port', type='int', default=18080)
+    parser.add_option('--backend-port', type='int', default=18081)
+    options, args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    cfg_path = os.path.join(tmp_dir, 'haproxy.cfg')
+    pid_path = os.path.join(tmp_dir, 'haproxy.pid')
+    sock_path = os.path.join(tmp_dir, 'haproxy.sock')
+    with open(cfg_path, 'w') as cfg_file:
+        cfg_file.write(CONFIG % {'pid_path': pid_path,
+                                 'sock_path': sock_path,
+                                 'port': options.port,
+                                 'backend_port': options.backend_port})
+
+    stop = threading.Event()
+    backend = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    backend.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    backend.bind(('127.0.0.1', options.backend_port))
+    backend.listen(128)
+    threads = [threading.Thread(target=run_backend, args=(backend, stop))]
+
+    cmd = ['haproxy', '-D', '-f', cfg_path, '-p', pid_path]
+    if options.mode == 'master':
+        cmd.insert(1, '-W')
+    subprocess.check_call(cmd)
+    # wait for the listener and the stats socket
+    time.sleep(0.5)
+
+    counts = dict()
+    lock = threading.Lock()
+    for i in xrange(options.clients):
+        threads.append(threading.Thread(
+            target=run_client, args=(options.port, stop, counts, lock)))
+    for thread in threads:
+        thread.start()
+
+    start = time.time()
+    try:
+        for i in xrange(options.reloads):
+            reload_haproxy(options.mode, cfg_path, pid_path, sock_path)
+            time.sleep(options.interval)
+    finally:
+        elapsed = time.time() - start
+        stop.set()
+        for thread in threads:
+            thread.join()
+        for pid in read_pids(pid_path):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        backend.close()
+        shutil.rmtree(tmp_dir)
+
+    total = sum(counts.values())
+    print '%s: %d reloads in %.1fs, %d connections' % (
+        options.mode, options.reloads, elapsed, total)
+    for result in sorted(counts):
+        print '  %-8s %8d (%.3f%%)' % (
+            result, counts[result], 100.0 * counts[result] / max(total, 1))
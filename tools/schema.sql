@@ -11,10 +11,12 @@ CREATE TABLE `load_balancers` (
   `free` tinyint(1)  DEFAULT NULL,
   `protocol` varchar(255) DEFAULT NULL,
   `state` varchar(255) NOT NULL,
+  `revision` int(11) NOT NULL DEFAULT 1,
   `dns_prefix` varchar(255) NOT NULL,
   `listen_port` int(11) DEFAULT NULL,
   `instance_port` int(11) DEFAULT NULL,
   KEY (`uuid`),
+  KEY (`state`),
   PRIMARY KEY (`id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
@@ -31,6 +33,17 @@ CREATE TABLE `load_balancer_configs` (
   `health_check_target_path` varchar(255) DEFAULT NULL,
   `health_check_unhealthy_threshold` int(11) DEFAULT NULL,
   `health_check_healthy_threshold` int(11) DEFAULT NULL,
+  `keepalive_connections` int(11) NOT NULL DEFAULT 0,
+  `keepalive_timeout_ms` int(11) NOT NULL DEFAULT 60000,
+  `keepalive_requests` int(11) NOT NULL DEFAULT 100,
+  `connect_timeout_ms` int(11) DEFAULT NULL,
+  `client_timeout_ms` int(11) DEFAULT NULL,
+  `server_timeout_ms` int(11) DEFAULT NULL,
+  `retries` int(11) DEFAULT NULL,
+  `redispatch` tinyint(1) DEFAULT NULL,
+  `next_upstream` varchar(255) DEFAULT NULL,
+  `max_fails` int(11) DEFAULT NULL,
+  `fail_timeout_ms` int(11) DEFAULT NULL,
   PRIMARY KEY (`id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
  
@@ -53,5 +66,8 @@ CREATE TABLE `load_balancer_instance_association` (
   `deleted` tinyint(1)  DEFAULT NULL,
   `load_balancer_id` int(11) NOT NULL,
   `instance_uuid` varchar(36) NOT NULL,
+  `instance_ip` varchar(64) DEFAULT NULL,
+  `instance_ip_resolved_at` datetime DEFAULT NULL,
+  KEY (`instance_ip_resolved_at`),
   PRIMARY KEY (`load_balancer_id`, `instance_uuid`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;